@@ -0,0 +1,91 @@
+import asyncio
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import time
+import fdms
+import fdms.fdms_protocol as protocol
+import fdms.site_net_protocol as site_net
+
+DEPOSIT_INQUIRY_REQUEST = b'\x02*1PIM1.4266962000000048#0239\x1c@09\x1c\x1c\x1c\x1c\x1c\x1c0\x03\x1a'
+INFO_RECORD = b'CUST01,4266962000000048,1,2'
+
+SESSION_COUNT = 500
+
+
+def site_net_packet(packet_type: bytes, data: bytes) -> bytes:
+    return struct.pack('!H', len(data)) + packet_type + data
+
+
+@asyncio.coroutine
+def terminal(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # ENQ <- request -> ACK <- EOT -> response <- ACK -> EOT <-
+    writer.write(site_net_packet(b'01', INFO_RECORD))
+    yield from site_net.read_site_net_packet(reader)
+    for data in (DEPOSIT_INQUIRY_REQUEST, bytes((protocol.EOT,)), bytes((protocol.ACK,))):
+        writer.write(site_net_packet(b'22', data))
+        yield from site_net.read_site_net_packet(reader)
+    writer.close()
+
+
+@asyncio.coroutine
+def run_sessions(loop, connect, session_count: int, release=None) -> float:
+    start = time.perf_counter()
+    for _ in range(session_count):
+        a, b = socket.socketpair()
+        client = yield from asyncio.open_connection(sock=a)
+        proxy_reader, proxy_writer = yield from asyncio.open_connection(sock=b)
+        session = asyncio.Task(site_net.site_net_session(proxy_reader, proxy_writer, connect, release))
+        yield from terminal(*client)
+        yield from session
+        proxy_writer.close()
+    return time.perf_counter() - start
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    path = tempfile.mkdtemp()
+    socket_path = os.path.join(path, 'fdms.bench')
+
+    def accept_fdms_client(reader, writer):
+        asyncio.Task(fdms.fdms_session(reader, writer)).add_done_callback(lambda fut: writer.close())
+
+    engines = (
+        ('stream', lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader(loop=loop), accept_fdms_client, loop=loop)),
+        ('protocol', lambda: fdms.FdmsProtocol(loop=loop)),
+    )
+    try:
+        for engine, factory in engines:
+            server = loop.run_until_complete(loop.create_unix_server(factory, path=socket_path))
+
+            def connect_socket(client_info):
+                return asyncio.open_unix_connection(path=socket_path)
+
+            def connect_memory(client_info):
+                return fdms.open_memory_connection(factory, loop=loop)
+
+            pool = fdms.FdmsConnectionPool(lambda: asyncio.open_unix_connection(path=socket_path),
+                                           min_size=4, loop=loop)
+            pool.start()
+
+            def connect_pool(client_info):
+                return pool.acquire()
+
+            modes = (('unix socket', connect_socket, None), ('pooled socket', connect_pool, pool.release),
+                     ('memory bridge', connect_memory, None))
+            for name, connect, release in modes:
+                elapsed = loop.run_until_complete(run_sessions(loop, connect, SESSION_COUNT, release))
+                print('%-8s %-13s %8.1f us/session' % (engine, name, elapsed * 1e6 / SESSION_COUNT))
+            pool.close()
+
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            os.remove(socket_path)
+    finally:
+        shutil.rmtree(path, True)
+
+
+if __name__ == '__main__':
+    main()
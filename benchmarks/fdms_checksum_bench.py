@@ -0,0 +1,38 @@
+import functools
+import timeit
+import fdms.fdms_checksum as checksum
+
+FRAME_SIZES = (16, 64, 128, 256, 1024)
+
+
+def reduce_lrc(frame: bytes) -> int:
+    return functools.reduce(lambda x, y: x ^ int(y), frame[2:-1], int(frame[1]))
+
+
+def reduce_parity(frame: bytes) -> bytes:
+    return bytes((b & 0x7f for b in frame))
+
+
+def make_frame(size: int) -> bytes:
+    return bytes((0x02,)) + bytes(0x20 + (i % 0x5f) for i in range(size - 3)) + bytes((0x03, 0x00))
+
+
+def measure(func, frame: bytes, number: int) -> float:
+    return min(timeit.repeat(lambda: func(frame), number=number, repeat=3)) * 1e6 / number
+
+
+def main():
+    print('%6s %14s %14s %14s %14s' % ('size', 'reduce lrc', 'lrc', 'loop parity', 'translate'))
+    for size in FRAME_SIZES:
+        frame = make_frame(size)
+        number = max(1000, 200000 // size)
+        print('%6d %11.2f us %11.2f us %11.2f us %11.2f us' % (
+            size,
+            measure(reduce_lrc, frame, number),
+            measure(lambda f: checksum.lrc(f, 1, -1), frame, number),
+            measure(reduce_parity, frame, number),
+            measure(checksum.strip_parity, frame, number)))
+
+
+if __name__ == '__main__':
+    main()
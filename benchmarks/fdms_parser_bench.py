@@ -0,0 +1,174 @@
+import sys
+import time
+import tracemalloc
+import fdms.fdms_protocol as protocol
+import fdms.fdms_processor as processor
+from fdms.fdms_protocol import FS, US, SEP, STX
+from fdms.fdms_checksum import lrc
+
+SWIPED_SALE_REQUEST = b'\x02*1PIM1.4266962000000048#0239\x1cC01\x1c6011202300201767=14111011000058900000' \
+                      b'\x1c10.00\x1cMK71BB7M\x1c22222\x1c6\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c' \
+                      b'\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x03L'
+KEYED_SALE_REQUEST = b'\x02*1PIM1.4266962000000048#0239\x1cB01\x1c4111111111111111\x1f1\x1f123 \x1c1214' \
+                     b'\x1c10.00\x1cMK71BCEA\x1c22222\x1c6\x1c\x1c\x1c\x1c\x1c95630\x1c\x1c\x1c\x1c\x1c\x1c' \
+                     b'\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x03\x08'
+BATCH_CLOSE_REQUEST = b'\x02*2PIM1.4266962000000048#0239\x1c@00\x1c11.00\x1c000\x1c002\x1c2.00\x1c10020\x1c0\x03\x13'
+
+FRAME_COUNT = 5000
+
+
+def with_lrc(frame: bytes) -> bytes:
+    return frame[:-1] + bytes((lrc(frame, 1, -1),))
+
+
+# Reference copies of the byte-at-a-time parsers the current ones replaced
+
+def legacy_sep_gen(sep: int, buffer: bytes, offset=0, count=-1):
+    for i in range(offset, len(buffer)):
+        if count == 0:
+            break
+        if buffer[i] == sep:
+            yield i
+            if count > 0:
+                count -= 1
+
+
+def legacy_parse_header(data: bytes) -> (int, processor.FdmsHeader):
+    pos = 1 if data[0] == STX else 0
+    if data[pos:pos+1].decode() != '*':
+        raise ValueError('Protocol flag * expected')
+    pos += 1
+    p_type = data[pos:pos+1].decode()
+    pos += 1
+    term_id = data[pos:pos+6].decode()
+    pos += 5
+    p_sep = data.index(SEP, pos, pos + 20)
+    merch_num = data[pos:p_sep].decode()
+    pos = p_sep + 1
+    p_sep = data.index(FS, pos, pos+5)
+    device_id = data[pos:p_sep].decode()
+    pos = p_sep + 1
+    header = processor.FdmsHeader()
+    header.protocol_type = p_type
+    header.terminal_id = term_id
+    header.merchant_number = merch_num
+    header.device_id = device_id
+    header.wcc = data[pos:pos+1].decode()
+    header.txn_type = data[pos+1:pos+2].decode()
+    header.txn_code = data[pos+2:pos+3].decode()
+    return pos + 4, header
+
+
+def legacy_monetary_parse(self, data: bytes):
+    fs_pos = list(legacy_sep_gen(FS, data, 0, 3))
+    aux_data = data[0:fs_pos[2]]
+    fs_pos.pop()
+    fields = list(protocol.buf_chop(aux_data, fs_pos))
+    self.total_amount = float(fields[0])
+    self.invoice_no = fields[1]
+    self.batch_no = fields[2][0:1]
+    self.item_no = fields[2][1:4]
+    self.revision_no = fields[2][4:5]
+    pos = len(aux_data) + 1
+    fs_pos = list(legacy_sep_gen(FS, data, pos))
+    self.format_code = data[pos:fs_pos[0]].decode()
+    aux_data = bytes()
+    if self.format_code == '6':
+        self.transaction_id = data[fs_pos[11]+1:fs_pos[12]].decode()
+        aux_data = data[fs_pos[14]+1:fs_pos[15]]
+    if len(aux_data) > 0:
+        fields = list(protocol.buf_chop(aux_data, legacy_sep_gen(US, aux_data)))
+        self.pin_block = fields[0]
+        self.card_type = fields[1]
+        self.authorization_code = fields[5]
+        self.smid_block = fields[6]
+
+
+def legacy_swiped_parse(self, data: bytes):
+    fs_pos = data.index(FS, 0, 77)
+    self.track_data = data[0:fs_pos].decode()
+    legacy_monetary_parse(self, data[fs_pos + 1:])
+
+
+def legacy_keyed_parse(self, data: bytes):
+    fs_pos = list(legacy_sep_gen(FS, data, 0, 2))
+    data1 = data[0:fs_pos[0]]
+    fields = list(protocol.buf_chop(data1, legacy_sep_gen(US, data1)))
+    self.cvv = fields[2]
+    self.cv_presence = fields[1]
+    self.account_no = fields[0]
+    self.exp_date = data[fs_pos[0]+1:fs_pos[1]].decode()
+    legacy_monetary_parse(self, data[fs_pos[1]+1:])
+
+
+def legacy_batch_close_parse(self, data: bytes):
+    fields = list(protocol.buf_chop(data, legacy_sep_gen(FS, data)))
+    self.credit_batch_amount = float(fields[0])
+    self.offline_items = int(fields[1])
+    self.debit_batch_count = int(fields[2])
+    self.debit_batch_amount = float(fields[3])
+    self.batch_no = fields[4][0:1]
+    self.item_no = fields[4][1:4]
+
+
+LEGACY_PARSERS = {
+    processor.SwipedMonetaryTransaction: legacy_swiped_parse,
+    processor.KeyedMonetaryTransaction: legacy_keyed_parse,
+    processor.BatchCloseTransaction: legacy_batch_close_parse,
+}
+
+
+def parse_legacy(request: bytes):
+    pos, header = legacy_parse_header(request)
+    txn = header.create_txn()
+    LEGACY_PARSERS[txn.__class__](txn, request[pos:-2])
+    return header, txn
+
+
+def parse_current(request: bytes):
+    pos, header = protocol.parse_header(request)
+    txn = header.create_txn()
+    txn.parse(request, pos, len(request) - 2)
+    return header, txn
+
+
+def read_fields(header: processor.FdmsHeader, txn: processor.FdmsTransaction):
+    # fields the processor looks at on an authorization or batch close
+    fields = [header.merchant_number, header.device_id, header.txn_code, txn.batch_no, txn.item_no]
+    if isinstance(txn, processor.MonetaryTransaction):
+        fields.extend((txn.revision_no, txn.card_type, txn.authorization_code))
+    return fields
+
+
+def measure(parse, request: bytes) -> (float, float, float):
+    start = time.perf_counter()
+    for _ in range(FRAME_COUNT):
+        read_fields(*parse(request))
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    read_fields(*parse(request))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    parsed = []
+    blocks = sys.getallocatedblocks()
+    for _ in range(1000):
+        parsed.append(parse(request))
+    retained = (sys.getallocatedblocks() - blocks) / 1000
+
+    return elapsed * 1e6 / FRAME_COUNT, peak, retained
+
+
+def main():
+    print('%-12s %-8s %10s %12s %16s' % ('frame', 'parser', 'us/frame', 'peak bytes', 'blocks/frame'))
+    for name, request in (('swiped sale', SWIPED_SALE_REQUEST), ('keyed sale', KEYED_SALE_REQUEST),
+                          ('batch close', BATCH_CLOSE_REQUEST)):
+        request = with_lrc(request)
+        assert read_fields(*parse_legacy(request)) == read_fields(*parse_current(request))
+        for parser_name, parse in (('legacy', parse_legacy), ('current', parse_current)):
+            print('%-12s %-8s %10.2f %12d %16.1f' % ((name, parser_name) + measure(parse, request)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import asyncio
+import time
+import fdms.fdms_protocol as protocol
+
+SALE_REQUEST = b'\x02*1PIM1.4266962000000048#0239\x1cC01\x1c6011202300201767=14111011000058900000' \
+               b'\x1c10.00\x1cMK71BB7M\x1c22222\x1c6\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c' \
+               b'\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x03L'
+
+FRAME_COUNT = 2000
+
+
+def with_parity(data: bytes) -> bytes:
+    return bytes(b | 0x80 if bin(b).count('1') % 2 == 0 else b for b in data)
+
+
+def make_stream(loop, frame_count: int) -> asyncio.StreamReader:
+    stream = asyncio.StreamReader(loop=loop)
+    frame = with_parity(SALE_REQUEST) + with_parity(bytes((protocol.ACK,)))
+    stream.feed_data(frame * frame_count)
+    stream.feed_eof()
+    return stream
+
+
+@asyncio.coroutine
+def read_legacy(stream: asyncio.StreamReader, frame_count: int):
+    for _ in range(frame_count * 2):
+        yield from protocol.read_fdms_packet(stream)
+
+
+@asyncio.coroutine
+def read_buffered(stream: asyncio.StreamReader, frame_count: int):
+    frames = protocol.FdmsFrameReader(stream)
+    for _ in range(frame_count * 2):
+        yield from frames.read_packet()
+
+
+def measure(loop, reader, frame_count: int) -> float:
+    stream = make_stream(loop, frame_count)
+    start = time.perf_counter()
+    loop.run_until_complete(reader(stream, frame_count))
+    return time.perf_counter() - start
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    legacy = measure(loop, read_legacy, FRAME_COUNT)
+    buffered = measure(loop, read_buffered, FRAME_COUNT)
+    print('read_fdms_packet: %8.2f us/frame' % (legacy * 1e6 / FRAME_COUNT))
+    print('FdmsFrameReader:  %8.2f us/frame' % (buffered * 1e6 / FRAME_COUNT))
+    print('speedup:          %8.2fx' % (legacy / buffered))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import functools
+import timeit
+import fdms.fdms_protocol as protocol
+import fdms.fdms_processor as processor
+from fdms.fdms_protocol import STX, ETX, FS
+
+
+# Reference copies of the byte-by-byte response builders the encoder replaced
+
+def legacy_response(rs: processor.FdmsResponse) -> bytes:
+    ba = bytearray()
+    ba.append(STX)
+    ba.append(rs.action_code.value.encode()[0])
+    ba.append(rs.response_code.encode()[0])
+    ba.append(rs.batch_no.encode()[0])
+    ba.extend(rs.item_no.encode()[0:4])
+    ba.append(rs.revision_no.encode()[0])
+    ba.extend(LEGACY_BODIES[rs.__class__](rs))
+    ba.append(ETX)
+    ba.append(functools.reduce(lambda x, y: x ^ y, ba[2:], ba[1]))
+    return ba
+
+
+def legacy_text_body(rs: processor.FdmsTextResponse) -> bytes:
+    text = rs.response_text
+    if len(text) < 16:
+        text = text.ljust(16, ' ')
+    if len(text) > 16:
+        text = text[0:16]
+    ba = bytes([FS])
+    ba += text.encode()
+    return ba
+
+
+def legacy_deposit_body(rs: processor.BatchResponse) -> bytes:
+    ba = legacy_text_body(rs)
+    ba += bytes([FS])
+    ba += rs.batch_id_number.encode()
+    text = rs.response_text2
+    if text is not None and len(text) > 0:
+        if len(text) < 16:
+            text = text.ljust(16, ' ')
+        if len(text) > 16:
+            text = text[0:16]
+        ba += bytes([FS])
+        ba += text.encode()
+    return ba
+
+
+def legacy_credit_body(rs: processor.CreditResponse) -> bytes:
+    ba = legacy_text_body(rs)
+    ba += rs.avc_rs_code.encode() if len(rs.avc_rs_code) > 0 else b'0'
+    if len(rs.cvv_rs_code) > 0:
+        ba += rs.cvv_rs_code.encode()
+    ba += bytes([FS])
+    ba += bytes([FS])
+    if len(rs.transaction_id) > 0:
+        ba += rs.transaction_id.encode()[0:15]
+    ba += bytes([FS])
+    ba += bytes([FS])
+    return ba
+
+
+LEGACY_BODIES = {
+    processor.FdmsTextResponse: legacy_text_body,
+    processor.BatchResponse: legacy_deposit_body,
+    processor.CreditResponse: legacy_credit_body,
+}
+
+
+def approved_response() -> processor.FdmsResponse:
+    rs = processor.CreditResponse()
+    rs.batch_no = '0'
+    rs.item_no = '000'
+    rs.response_text = 'APPROVED 000123'
+    return rs
+
+
+def auth_ticket_response() -> processor.FdmsResponse:
+    rs = processor.CreditResponse()
+    rs.batch_no = '1'
+    rs.item_no = '007'
+    rs.response_text = 'AUTH/TKT 000124'
+    rs.transaction_id = '0000000042'
+    rs.approved_amount = 10.0
+    rs.requested_amount = 10.0
+    return rs
+
+
+def close_response() -> processor.FdmsResponse:
+    rs = processor.BatchResponse()
+    rs.batch_no = '1'
+    rs.set_item_number(12)
+    rs.set_batch_id_number(17)
+    rs.response_text = 'CLOSE %8.2f' % 125.5
+    rs.response_text2 = 'CLOSE %8.2f' % 20.0
+    return rs
+
+
+def deposit_response() -> processor.FdmsResponse:
+    rs = processor.BatchResponse()
+    rs.batch_no = '1'
+    rs.set_item_number(12)
+    rs.response_text = 'DEP %8.2f' % 145.5
+    rs.batch_id_number = '17'
+    return rs
+
+
+RESPONSES = (('APPROVED', approved_response()), ('AUTH/TKT', auth_ticket_response()),
+             ('CLOSE', close_response()), ('DEP', deposit_response()))
+
+
+def measure(func, rs: processor.FdmsResponse, number=20000) -> float:
+    return min(timeit.repeat(lambda: func(rs), number=number, repeat=3)) * 1e6 / number
+
+
+def main():
+    print('%-10s %12s %12s' % ('response', 'legacy', 'encoder'))
+    for name, rs in RESPONSES:
+        assert bytes(legacy_response(rs)) == bytes(rs.response())
+        print('%-10s %9.2f us %9.2f us' % (name, measure(legacy_response, rs), measure(lambda r: r.response(), rs)))
+
+
+if __name__ == '__main__':
+    main()
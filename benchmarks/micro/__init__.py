@@ -0,0 +1,85 @@
+"""Microbenchmarks for the protocol, processor and storage hot paths.
+
+    python -m benchmarks.micro --save results.json
+    python -m benchmarks.micro --baseline baseline.json --save results.json
+
+A case is a (name, run) pair: run(number) performs the operation `number` times and returns the
+seconds spent in it, so a case can keep its per-call setup out of the measurement.
+"""
+import json
+import platform
+import statistics
+import sys
+import time
+
+MIN_TIME = 0.05
+REPEAT = 5
+REGRESSION_THRESHOLD = 1.25
+
+
+def timed(func, *args, **kwargs):
+    def run(number: int) -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args, **kwargs)
+        return time.perf_counter() - start
+    return run
+
+
+def calibrate(run, min_time=MIN_TIME) -> int:
+    # like timeit's autorange: the smallest power of ten that runs for at least min_time
+    number = 1
+    while True:
+        if run(number) >= min_time or number >= 10 ** 6:
+            return number
+        number *= 10
+
+
+def measure(run, repeat=REPEAT, min_time=MIN_TIME) -> dict:
+    number = calibrate(run, min_time)
+    samples = [run(number) * 1e6 / number for _ in range(repeat)]
+    return {
+        'number': number,
+        'best_us': min(samples),
+        'median_us': statistics.median(samples),
+    }
+
+
+def run_cases(cases, repeat=REPEAT, min_time=MIN_TIME, out=sys.stdout) -> dict:
+    results = dict()
+    for name, run in cases:
+        results[name] = result = measure(run, repeat, min_time)
+        out.write('%-48s %12.2f us %12.2f us %10d\n' % (name, result['best_us'], result['median_us'],
+                                                        result['number']))
+        out.flush()
+    return results
+
+
+def save_results(path: str, results: dict):
+    document = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+
+
+def load_results(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare_results(results: dict, baseline: dict, threshold=REGRESSION_THRESHOLD) -> list:
+    # (name, baseline us, current us, ratio) for every case slower than threshold x its baseline;
+    # best-of-repeat timings are compared, they are the least noisy
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or base['best_us'] <= 0.0:
+            continue
+        ratio = result['best_us'] / base['best_us']
+        if ratio > threshold:
+            regressions.append((name, base['best_us'], result['best_us'], ratio))
+    return regressions
@@ -0,0 +1,64 @@
+import argparse
+import sys
+from benchmarks.micro import run_cases, save_results, load_results, compare_results, REPEAT, MIN_TIME, \
+    REGRESSION_THRESHOLD
+from benchmarks.micro import protocol_cases, model_cases, storage_cases
+
+GROUPS = (
+    ('protocol', protocol_cases),
+    ('model', model_cases),
+    ('storage', storage_cases),
+)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.micro',
+                                     description='FDMS protocol, processor and storage microbenchmarks')
+    parser.add_argument('--save', metavar='FILE', help='write the results as JSON')
+    parser.add_argument('--baseline', metavar='FILE', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='slowdown over the baseline reported as a regression (default %(default)s)')
+    parser.add_argument('--filter', default='', help='only run cases whose name contains this text')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help='seconds per timed run')
+    parser.add_argument('groups', nargs='*', metavar='group',
+                        help='case groups to run: %s (all by default)' % ', '.join(name for name, _ in GROUPS))
+    args = parser.parse_args(argv)
+    unknown = set(args.groups) - set(name for name, _ in GROUPS)
+    if len(unknown) > 0:
+        parser.error('unknown group: %s' % ', '.join(sorted(unknown)))
+
+    print('%-48s %15s %15s %10s' % ('case', 'best', 'median', 'number'))
+    results = dict()
+    for name, module in GROUPS:
+        if len(args.groups) > 0 and name not in args.groups:
+            continue
+        cases = [(case_name, run) for case_name, run in module.cases() if args.filter in case_name]
+        results.update(run_cases(cases, args.repeat, args.min_time))
+
+    if args.save is not None:
+        save_results(args.save, results)
+
+    if args.baseline is not None:
+        baseline = load_results(args.baseline)
+        print()
+        print('%-48s %12s %12s %8s' % ('case', 'baseline us', 'current us', 'ratio'))
+        for name in sorted(results):
+            if name in baseline:
+                print('%-48s %12.2f %12.2f %8.2f' % (name, baseline[name]['best_us'], results[name]['best_us'],
+                                                     results[name]['best_us'] / baseline[name]['best_us']))
+        regressions = compare_results(results, baseline, args.threshold)
+        missing = sorted(set(baseline) - set(results)) if args.filter == '' and len(args.groups) == 0 else []
+        for name in missing:
+            print('%-48s missing' % name)
+        if len(regressions) > 0:
+            print()
+            print('%d regression(s) over %.2fx:' % (len(regressions), args.threshold))
+            for name, base, current, ratio in regressions:
+                print('  %-46s %10.2f -> %10.2f us (%.2fx)' % (name, base, current, ratio))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
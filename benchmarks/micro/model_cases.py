@@ -0,0 +1,54 @@
+import json
+from fdms.fdms_model import card_info_md5, extract_card_info, Authorization, BatchRecord, OpenBatch
+from fdms.leveldb_storage import CustomEncoder, CustomDecoder
+from benchmarks.micro import timed
+
+TRACK1 = '%B4393410316009875^KOLUPAEV/ SERGEY^17061211000000762000000?'
+TRACK2 = ';4393410316009875=170612110000762?'
+
+
+def authorization() -> Authorization:
+    auth = Authorization()
+    auth.id = 1234
+    auth.merchant_number = '4266962000000048'
+    auth.authorization_code = '001234'
+    auth.card_hash = card_info_md5('4393410316009875', '1706')
+    auth.amount = 10.0
+    return auth
+
+
+def batch_record() -> BatchRecord:
+    record = BatchRecord()
+    record.id = 4321
+    record.batch_id = 17
+    record.auth_id = 1234
+    record.item_no = '012'
+    record.revision_no = '0'
+    record.txn_code = '1'
+    record.amount = 10.0
+    return record
+
+
+def open_batch() -> OpenBatch:
+    batch = OpenBatch('4266962000000048', '0239', '1')
+    batch.id = 17
+    return batch
+
+
+def round_trip(obj):
+    return json.loads(json.dumps(obj, cls=CustomEncoder), cls=CustomDecoder)
+
+
+def cases() -> list:
+    result = [
+        ('card_info_md5', timed(card_info_md5, '4393410316009875', '1706')),
+        ('extract_card_info: track 1', timed(extract_card_info, TRACK1)),
+        ('extract_card_info: track 2', timed(extract_card_info, TRACK2)),
+    ]
+    for obj in (authorization(), batch_record(), open_batch()):
+        text = json.dumps(obj, cls=CustomEncoder)
+        name = obj.__class__.__name__
+        result.append(('CustomEncoder: %s' % name, timed(json.dumps, obj, cls=CustomEncoder)))
+        result.append(('CustomDecoder: %s' % name, timed(json.loads, text, cls=CustomDecoder)))
+        result.append(('json round trip: %s' % name, timed(round_trip, obj)))
+    return result
@@ -0,0 +1,46 @@
+import fdms.fdms_protocol as protocol
+import fdms.fdms_processor as processor
+from benchmarks.micro import timed
+from benchmarks.fdms_parser_bench import SWIPED_SALE_REQUEST, KEYED_SALE_REQUEST, BATCH_CLOSE_REQUEST, with_lrc
+from benchmarks.fdms_response_bench import RESPONSES
+from benchmarks.fdms_bridge_bench import DEPOSIT_INQUIRY_REQUEST
+
+REVISION_INQUIRY_REQUEST = b'\x02*2PIM1.4266962000000048#0239\x1c@0I\x1c001\x1c0\x1c0\x1c1\x1c0\x1c0\x1c0\x1c0' \
+                           b'\x1c0\x1c0\x1c0\x03\x00'
+
+REQUESTS = (
+    ('swiped sale', SWIPED_SALE_REQUEST),
+    ('keyed sale', KEYED_SALE_REQUEST),
+    ('batch close', BATCH_CLOSE_REQUEST),
+    ('revision inquiry', REVISION_INQUIRY_REQUEST),
+    ('deposit inquiry', DEPOSIT_INQUIRY_REQUEST),
+)
+
+
+def poll_response() -> processor.FdmsResponse:
+    rs = processor.SpecificPollResponse()
+    rs.batch_no = '1'
+    rs.item_no = '004'
+    rs.action_code = processor.FdmsActionCode.HostSpecificPoll
+    return rs
+
+
+def parse_body(txn_class, request: bytes, pos: int):
+    txn = txn_class()
+    txn.parse(request, pos, len(request) - 2)
+    return txn
+
+
+def cases() -> list:
+    result = []
+    for name, request in REQUESTS:
+        request = with_lrc(request)
+        pos, header = protocol.parse_header(request)
+        result.append(('parse_header: %s' % name, timed(protocol.parse_header, request)))
+        txn_class = header.create_txn().__class__
+        parser = txn_class.parse.__name__
+        result.append(('%s: %s' % (parser, name), timed(parse_body, txn_class, request, pos)))
+
+    for name, rs in RESPONSES + (('POLL', poll_response()),):
+        result.append(('response: %s' % name, timed(rs.response)))
+    return result
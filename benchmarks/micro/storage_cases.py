@@ -0,0 +1,173 @@
+import atexit
+import itertools
+import os
+import shutil
+import tempfile
+import time
+import fdms
+from fdms.fdms_model import Authorization, BatchRecord, card_info_md5
+from fdms.sqlite_storage import SqlFdmsStorage
+from fdms.sql_core_storage import SqlCoreStorage
+from fdms.leveldb_storage import LevelDbStorage
+from fdms.fdms_cache import BatchCache, cached_storage
+
+MERCHANT_NUMBER = '4266962000000048'
+DEVICE_ID = '0239'
+BATCH_SIZE = 100
+SCRATCH_BATCH_ID = 10 ** 6  # new records go to scratch batches from here, so the measured batch keeps its size
+
+
+def open_backends(path: str) -> list:
+    # both backends keep module-wide connections, so they are pointed at the scratch
+    # directory before their first use
+    fdms.set_database_name('sqlite:///' + os.path.join(path, 'fdms.sqlite'))
+    fdms.set_level_db_path(os.path.join(path, 'level.db'))
+    with SqlFdmsStorage():
+        SqlFdmsStorage.engine.echo = False
+    # the Core backend gets a database file of its own, so both SQL backends start out empty
+    fdms.set_database_name('sqlite:///' + os.path.join(path, 'fdms-core.sqlite'))
+    with SqlCoreStorage():
+        pass
+    return [('SqlFdmsStorage', SqlFdmsStorage), ('SqlCoreStorage', SqlCoreStorage), ('LevelDbStorage', LevelDbStorage)]
+
+
+def new_authorization(storage_id: int) -> Authorization:
+    auth = Authorization()
+    auth.merchant_number = MERCHANT_NUMBER
+    auth.authorization_code = str(storage_id).rjust(6, '0')
+    auth.card_hash = card_info_md5('4393410316009875', '1706')
+    auth.amount = 10.0
+    return auth
+
+
+def new_batch_record(batch_id: int, auth_id: int, item_no: str) -> BatchRecord:
+    record = BatchRecord()
+    record.batch_id = batch_id
+    record.auth_id = auth_id
+    record.item_no = item_no
+    record.revision_no = '0'
+    record.txn_code = '1'
+    record.amount = 10.0
+    return record
+
+
+def populate(storage_class) -> (int, str, int, str):
+    # a closed batch, an open one with BATCH_SIZE captured sales and an auth-only
+    with storage_class() as storage:
+        batch = storage.create_batch(MERCHANT_NUMBER, DEVICE_ID, '1')
+        storage.close_batch(batch, (0, 0.0), (0, 0.0))
+        batch = storage.create_batch(MERCHANT_NUMBER, DEVICE_ID, '2')
+        for i in range(1, BATCH_SIZE + 1):
+            auth = new_authorization(i)
+            storage.put_authorization(auth)
+            storage.put_batch_record(new_batch_record(batch.id, auth.id, '%.3d' % i))
+        # and an auth-only waiting for its ticket-only
+        auth_only = new_authorization(BATCH_SIZE + 1)
+        auth_only.is_captured = False
+        storage.put_authorization(auth_only)
+        storage.save()
+        return batch.id, auth.authorization_code, auth.id, auth_only.authorization_code
+
+
+def storage_case(storage_class, op, prepare=None):
+    # every call runs in a storage session of its own, the way the processor uses it;
+    # opening the session and preparing the arguments are not timed
+    def run(number: int) -> float:
+        elapsed = 0.0
+        for _ in range(number):
+            with storage_class() as storage:
+                args = prepare(storage) if prepare is not None else ()
+                start = time.perf_counter()
+                op(storage, *args)
+                elapsed += time.perf_counter() - start
+        return elapsed
+    return run
+
+
+def session_case(storage_class):
+    def run(number: int) -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            with storage_class():
+                pass
+        return time.perf_counter() - start
+    return run
+
+
+def backend_cases(name: str, storage_class) -> list:
+    batch_id, authorization_code, auth_id, auth_only_code = populate(storage_class)
+    counter = itertools.count(BATCH_SIZE + 1)
+
+    def next_device() -> str:
+        return 'B%.3d' % (next(counter) % 1000)
+
+    def prepare_record(storage) -> tuple:
+        i = next(counter)
+        return new_batch_record(SCRATCH_BATCH_ID + i, 10 ** 6 + i, '%.3d' % (i % 1000)),
+
+    def prepare_record_with_batch(storage) -> tuple:
+        # the scratch record is added to a copy of the measured batch, whose stored totals
+        # are then rewritten with the record
+        record, = prepare_record(storage)
+        batch = storage.get_open_batch(MERCHANT_NUMBER, DEVICE_ID)
+        batch.add_record(record)
+        return record, batch
+
+    def prepare_authorization(storage) -> tuple:
+        return new_authorization(next(counter)),
+
+    def prepare_open_batch(storage) -> tuple:
+        return storage.create_batch(MERCHANT_NUMBER, next_device(), '1'), (1, 10.0), (0, 0.0)
+
+    def prepare_save(storage) -> tuple:
+        # one pending authorization to commit
+        storage.put_authorization(new_authorization(next(counter)))
+        return ()
+
+    cases = [
+        ('session', session_case(storage_class)),
+        ('last_closed_batch', storage_case(
+            storage_class, lambda storage: storage.last_closed_batch(MERCHANT_NUMBER, DEVICE_ID))),
+        ('get_open_batch', storage_case(
+            storage_class, lambda storage: storage.get_open_batch(MERCHANT_NUMBER, DEVICE_ID))),
+        ('create_batch', storage_case(
+            storage_class, lambda storage: storage.create_batch(MERCHANT_NUMBER, next_device(), '1'))),
+        ('get_batch_record', storage_case(
+            storage_class, lambda storage: storage.get_batch_record(batch_id, '%.3d' % (BATCH_SIZE // 2)))),
+        ('query_batch_items', storage_case(storage_class, lambda storage: storage.query_batch_items(batch_id))),
+        ('put_batch_record', storage_case(
+            storage_class, lambda storage, record: storage.put_batch_record(record), prepare_record)),
+        ('put_batch_record with batch', storage_case(
+            storage_class, lambda storage, *args: storage.put_batch_record(*args), prepare_record_with_batch)),
+        ('query_authorization', storage_case(
+            storage_class, lambda storage: storage.query_authorization(MERCHANT_NUMBER, authorization_code))),
+        ('query_uncaptured_authorizations', storage_case(
+            storage_class, lambda storage: storage.query_uncaptured_authorizations(MERCHANT_NUMBER, auth_only_code))),
+        ('get_authorization', storage_case(storage_class, lambda storage: storage.get_authorization(auth_id))),
+        ('put_authorization', storage_case(
+            storage_class, lambda storage, auth: storage.put_authorization(auth), prepare_authorization)),
+        ('close_batch', storage_case(
+            storage_class, lambda storage, *args: storage.close_batch(*args), prepare_open_batch)),
+        ('save', storage_case(storage_class, lambda storage: storage.save(), prepare_save)),
+    ]
+
+    # the same lookups answered by a warm batch cache
+    cached_class = cached_storage(storage_class, BatchCache())
+    cached_class.batch_cache.warm_up(storage_class)
+    cases += [
+        ('cached last_closed_batch', storage_case(
+            cached_class, lambda storage: storage.last_closed_batch(MERCHANT_NUMBER, DEVICE_ID))),
+        ('cached get_open_batch', storage_case(
+            cached_class, lambda storage: storage.get_open_batch(MERCHANT_NUMBER, DEVICE_ID))),
+    ]
+    return [('%s.%s' % (name, case_name), run) for case_name, run in cases]
+
+
+def cases() -> list:
+    # the databases are used until the cases have run, so they are removed at exit
+    path = tempfile.mkdtemp(prefix='fdms-bench-')
+    atexit.register(shutil.rmtree, path, True)
+    result = []
+    for name, storage_class in open_backends(path):
+        result.extend(backend_cases(name, storage_class))
+    return result
@@ -0,0 +1,145 @@
+import asyncio
+import socket
+import struct
+import time
+import fdms.fdms_protocol as protocol
+import fdms.site_net_protocol as site_net
+
+SALE_REQUEST = b'\x02*1PIM1.4266962000000048#0239\x1cC01\x1c6011202300201767=14111011000058900000' \
+               b'\x1c10.00\x1cMK71BB7M\x1c22222\x1c6\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c' \
+               b'\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x1c\x03L'
+INFO_RECORD = b'CUST01,4266962000000048,1,2'
+
+PACKET_COUNT = 2000
+
+
+@asyncio.coroutine
+def legacy_read_site_net_packet(reader: asyncio.StreamReader) -> (str, bytes):
+    h = yield from reader.read(4)
+    packet_length = h[0] * 256 + h[1]
+    packet_type = h[2:4].decode()
+    packet = yield from reader.read(packet_length)
+    return packet_type, packet
+
+
+@asyncio.coroutine
+def legacy_site_net_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, connect_task):
+    # the per-packet task proxy, kept for comparison
+    frame_type, data = yield from legacy_read_site_net_packet(reader)
+    fdms_reader, fdms_writer = yield from connect_task(None)
+    fdms_frames = protocol.FdmsFrameReader(fdms_reader)
+    outer_task = None
+    inner_task = None
+    while True:
+        if outer_task is None:
+            outer_task = asyncio.Task(legacy_read_site_net_packet(reader))
+        if inner_task is None:
+            inner_task = asyncio.Task(fdms_frames.read_packet())
+        tasks = (outer_task, inner_task)
+        yield from asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+        if outer_task.done():
+            try:
+                frame_type, request = outer_task.result()
+                if frame_type == '22':
+                    fdms_writer.write(request)
+                    yield from fdms_writer.drain()
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                break
+            outer_task = None
+
+        if inner_task.done():
+            try:
+                response = inner_task.result()
+                if len(response) == 0:
+                    break
+                writer.write(struct.pack('!H', len(response)))
+                writer.write('22'.encode())
+                writer.write(response)
+                yield from writer.drain()
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                break
+            inner_task = None
+
+    if outer_task is not None:
+        outer_task.cancel()
+    if inner_task is not None:
+        inner_task.cancel()
+    fdms_writer.close()
+
+
+@asyncio.coroutine
+def echo_fdms(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    frames = protocol.FdmsFrameReader(reader)
+    while True:
+        packets = yield from frames.read_packets()
+        if len(packets) == 0:
+            break
+        writer.writelines(packets)
+        yield from writer.drain()
+    writer.close()
+
+
+def site_net_packet(packet_type: bytes, data: bytes) -> bytes:
+    return struct.pack('!H', len(data)) + packet_type + data
+
+
+@asyncio.coroutine
+def open_pair(loop):
+    a, b = socket.socketpair()
+    left = yield from asyncio.open_connection(sock=a)
+    right = yield from asyncio.open_connection(sock=b)
+    return left, right
+
+
+@asyncio.coroutine
+def run_proxy(loop, session, pipelined: bool, packet_count: int) -> float:
+    (client_reader, client_writer), (proxy_reader, proxy_writer) = yield from open_pair(loop)
+    (fdms_reader, fdms_writer), (backend_reader, backend_writer) = yield from open_pair(loop)
+
+    @asyncio.coroutine
+    def connect(client_info):
+        return fdms_reader, fdms_writer
+
+    echo = asyncio.Task(echo_fdms(backend_reader, backend_writer))
+    proxy = asyncio.Task(session(proxy_reader, proxy_writer, connect))
+
+    client_writer.write(site_net_packet(b'01', INFO_RECORD))
+    request = site_net_packet(b'22', SALE_REQUEST)
+    response_size = len(request)
+
+    start = time.perf_counter()
+    if pipelined:
+        client_writer.write(request * packet_count)
+        yield from client_reader.readexactly(response_size * packet_count)
+    else:
+        for _ in range(packet_count):
+            client_writer.write(request)
+            yield from client_reader.readexactly(response_size)
+    elapsed = time.perf_counter() - start
+
+    client_writer.close()
+    yield from asyncio.wait((proxy, echo))
+    proxy_writer.close()
+    return elapsed
+
+
+def measure(loop, session, pipelined: bool) -> float:
+    return loop.run_until_complete(run_proxy(loop, session, pipelined, PACKET_COUNT))
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    for name, session in (('per-packet tasks', legacy_site_net_session), ('pump coroutines', site_net.site_net_session)):
+        latency = measure(loop, session, False)
+        throughput = measure(loop, session, True)
+        print('%-16s round trip: %8.2f us   pipelined: %9.0f packets/s' %
+              (name, latency * 1e6 / PACKET_COUNT, PACKET_COUNT / throughput))
+
+
+if __name__ == '__main__':
+    main()
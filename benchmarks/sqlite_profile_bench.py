@@ -0,0 +1,92 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import fdms.fdms_processor as processor
+import fdms.sqlite_storage as sqlite_storage
+from fdms.sqlite_storage import SqlFdmsStorage
+from fdms.sql_core_storage import SqlCoreStorage
+
+TERMINAL_COUNT = 8
+SALES_PER_TERMINAL = 250
+MERCHANT_NUMBER = '4266962000000048'
+
+
+def sale(device_id: str, item_no: int) -> (processor.FdmsHeader, processor.KeyedMonetaryTransaction):
+    header = processor.FdmsHeader()
+    header.protocol_type = '1'
+    header.terminal_id = 'POSHOME1.'
+    header.merchant_number = MERCHANT_NUMBER
+    header.device_id = device_id
+    header.wcc = '@'
+    header.txn_type = processor.FdmsTransactionType.Online.value
+    header.txn_code = processor.FdmsTxnCode.Sale.value
+    body = processor.KeyedMonetaryTransaction()
+    body.batch_no = '1'
+    body.item_no = '%.3d' % item_no
+    body.revision_no = '0'
+    body.invoice_no = 'Bench'
+    body.total_amount = 10.0
+    body.account_no = '4111111111111111'
+    body.exp_date = '1230'
+    return header, body
+
+
+def open_storage(storage_class, profile: str, path: str):
+    # every run gets a new database file and engine
+    SqlFdmsStorage.engine = None
+    SqlCoreStorage.engine = None
+    name = '%s-%s.sqlite' % (profile, storage_class.__name__)
+    sqlite_storage.set_database_name('sqlite:///' + os.path.join(path, name))
+    sqlite_storage.set_profile(profile)
+    if storage_class is SqlFdmsStorage:
+        sqlite_storage.open_database(echo=False)
+    else:
+        storage_class()
+    processor.Storage = storage_class
+
+
+def measure(storage_class, profile: str, path: str) -> (float, int):
+    # TERMINAL_COUNT terminals, each sending its sales from a thread of its own, as with --txn-threads
+    open_storage(storage_class, profile, path)
+    errors = []
+
+    def run(device_id):
+        for item_no in range(1, SALES_PER_TERMINAL + 1):
+            rs = processor.process_txn(sale(device_id, item_no))
+            if rs.response_code != '0':
+                errors.append(rs.response_text)
+
+    threads = [threading.Thread(target=run, args=('%.4d' % i,)) for i in range(TERMINAL_COUNT)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return elapsed, len(errors)
+
+
+def main():
+    profiles = sys.argv[1:] if len(sys.argv) > 1 else sorted(sqlite_storage.PROFILES)
+    path = tempfile.mkdtemp()
+    storage = processor.Storage
+    try:
+        for storage_class in (SqlFdmsStorage, SqlCoreStorage):
+            for profile in profiles:
+                elapsed, errors = measure(storage_class, profile, path)
+                checkpointer = sqlite_storage.CHECKPOINTER
+                checkpoints = checkpointer.metrics()['checkpoints'] if checkpointer is not None else 0
+                print('%-15s %-8s %8.0f txn/s %8.1f us/txn   errors: %d   checkpoints: %d' %
+                      (storage_class.__name__, profile, TERMINAL_COUNT * SALES_PER_TERMINAL / elapsed,
+                       elapsed * 1e6 / (TERMINAL_COUNT * SALES_PER_TERMINAL), errors, checkpoints))
+    finally:
+        sqlite_storage.set_profile('default')
+        processor.Storage = storage
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,446 @@
+"""Load generator that acts like a fleet of POS terminals.
+
+Each simulated terminal owns a merchant/device pair and runs its sessions one after another,
+keeping its own batch: sales and returns are numbered items, voids revise them, auth-only codes
+are later captured as ticket-only items, some sales are kept offline and are only delivered when
+the host polls for them during the (multi-round) batch close.
+
+    python -m benchmarks.terminal_simulator --unix fdms.1 --terminals 50 --duration 30
+    python -m benchmarks.terminal_simulator --tls localhost:8444 --terminals 50 --rate 200
+"""
+import argparse
+import asyncio
+import collections
+import os
+import random
+import ssl
+import struct
+import time
+import fdms.fdms_protocol as protocol
+import fdms.site_net_protocol as site_net
+from fdms.fdms_checksum import lrc
+from fdms.fdms_processor import FdmsTxnCode, FdmsTransactionType, TRANSACTION_VOID
+
+TERMINAL_ID = b'PIM1.'
+READ_TIMEOUT = 20.0
+CERT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cert.pem')
+
+TXN_TYPES = ('deposit', 'swiped', 'keyed', 'auth', 'ticket', 'void', 'close')
+DEFAULT_MIX = 'deposit=1,swiped=4,keyed=2,auth=1,ticket=1,void=1'
+
+FS_BYTES = bytes((protocol.FS,))
+US_BYTES = bytes((protocol.US,))
+
+
+def build_frame(protocol_type: str, merchant: str, device: str, wcc: str, txn_type: str, txn_code: str,
+                fields: list) -> bytes:
+    header = b'*' + protocol_type.encode() + TERMINAL_ID + merchant.encode() + b'#' + device.encode() + FS_BYTES + \
+        (wcc + txn_type + txn_code).encode()
+    data = bytes((protocol.STX,)) + header + FS_BYTES + FS_BYTES.join(fields) + bytes((protocol.ETX,))
+    return data + bytes((lrc(data, 1),))
+
+
+def additional_data(authorization_code='') -> bytes:
+    # pin block, card type, 3 reserved, authorization code, SMID block
+    return US_BYTES.join((b'', b'', b'', b'', b'', authorization_code.encode(), b''))
+
+
+class Item:
+    def __init__(self, item_no: str, keyed: bool, card: str, exp: str, amount: float, txn_code: str):
+        self.item_no = item_no
+        self.keyed = keyed
+        self.card = card
+        self.exp = exp
+        self.amount = amount
+        self.txn_code = txn_code
+        self.revision = 0
+        self.authorization_code = ''
+        self.online = True
+
+    def credit_amount(self) -> float:
+        code = FdmsTxnCode(self.txn_code)
+        if code in TRANSACTION_VOID:
+            return 0.0
+        return -self.amount if code == FdmsTxnCode.Return else self.amount
+
+
+class Terminal:
+    def __init__(self, merchant: str, device: str, rnd: random.Random):
+        self.merchant = merchant
+        self.device = device
+        self.random = rnd
+        self.batch_no = 1
+        self.items = collections.OrderedDict()
+        ''':type: dict of [str, Item]'''
+        self.authorizations = []
+        ''':type: list of [(str, float)]'''
+        self.invoice = 0
+
+    def next_invoice(self) -> bytes:
+        self.invoice += 1
+        return ('%s%04d' % (self.device, self.invoice % 10000)).encode()
+
+    def new_item(self, keyed: bool, txn_code: str, amount: float) -> Item:
+        card = '4%015d' % self.random.randrange(10 ** 15)
+        item = Item('%.3d' % (len(self.items) + 1), keyed, card, '1230', amount, txn_code)
+        self.items[item.item_no] = item
+        return item
+
+    def monetary_frame(self, item: Item, txn_type='0', batch_no=None, item_no=None, additional=b'') -> bytes:
+        sequence = '%s%s%d' % (self.batch_no if batch_no is None else batch_no,
+                               item.item_no if item_no is None else item_no, item.revision)
+        common = [('%.2f' % item.amount).encode(), self.next_invoice(), sequence.encode(), b'6']
+        retail = [b''] * 15
+        retail[-1] = additional
+        if item.keyed:
+            keyed_data = US_BYTES.join((item.card.encode(), b'1', b'123'))
+            fields = [keyed_data, item.exp.encode()] + common + retail
+            wcc = '@'
+        else:
+            track = ('%s=%s1011000058900000' % (item.card, item.exp[2:] + item.exp[:2])).encode()
+            fields = [track] + common + retail
+            wcc = 'A'
+        protocol_type = '1' if txn_type == '0' else '2'
+        return build_frame(protocol_type, self.merchant, self.device, wcc, txn_type, item.txn_code, fields)
+
+    def deposit_frame(self) -> bytes:
+        return build_frame('1', self.merchant, self.device, '@', '0', '9', [b'', b'', b'', b'', b'', b'0'])
+
+    def close_frame(self) -> bytes:
+        credit = sum(item.credit_amount() for item in self.items.values())
+        offline = sum(1 for item in self.items.values() if not item.online)
+        fields = [('%.2f' % credit).encode(), b'%.3d' % offline, b'000', b'0.00',
+                  ('%d%.3d0' % (self.batch_no, len(self.items) + 1)).encode(), b'0']
+        return build_frame('2', self.merchant, self.device, '@', '0', '0', fields)
+
+    def revision_inquiry_frame(self, start_item: str) -> bytes:
+        start = int(start_item)
+        revisions = []
+        for i in range(10):
+            item = self.items.get('%.3d' % (start + i))
+            revisions.append(b'' if item is None else str(item.revision).encode())
+        return build_frame('2', self.merchant, self.device, '@', '0', 'I', [start_item.encode()] + revisions)
+
+    def close_batch(self):
+        self.items.clear()
+        self.batch_no = self.batch_no % 9 + 1
+
+
+class UnixLink:
+    def __init__(self, path: str):
+        self.path = path
+        self.writer = None
+        self.frames = None
+
+    @asyncio.coroutine
+    def open(self, terminal: Terminal):
+        reader, self.writer = yield from asyncio.open_unix_connection(path=self.path)
+        self.frames = protocol.FdmsFrameReader(reader)
+
+    def send(self, frame: bytes):
+        self.writer.write(frame)
+
+    @asyncio.coroutine
+    def read(self) -> bytes:
+        frame = yield from asyncio.wait_for(self.frames.read_packet(), READ_TIMEOUT)
+        if len(frame) == 0:
+            raise ConnectionError('FDMS closed the session')
+        return frame
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class SiteNetLink:
+    def __init__(self, host: str, port: int, context: ssl.SSLContext):
+        self.host = host
+        self.port = port
+        self.context = context
+        self.reader = None
+        self.writer = None
+
+    @asyncio.coroutine
+    def open(self, terminal: Terminal):
+        self.reader, self.writer = yield from asyncio.open_connection(self.host, self.port, ssl=self.context)
+        info = ('SIM%s,%s,1,2' % (terminal.device, terminal.merchant)).encode()
+        self.writer.write(struct.pack('!H', len(info)) + b'01' + info)
+
+    def send(self, frame: bytes):
+        self.writer.write(struct.pack('!H', len(frame)) + b'22' + frame)
+
+    @asyncio.coroutine
+    def read(self) -> bytes:
+        packet_type, packet = yield from asyncio.wait_for(site_net.read_site_net_packet(self.reader), READ_TIMEOUT)
+        if packet_type != '22':
+            raise ConnectionError('SiteNET: %s' % packet.decode(errors='replace'))
+        return packet
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def control(byte: int) -> bytes:
+    return bytes((byte,))
+
+
+@asyncio.coroutine
+def expect(link, byte: int) -> bytes:
+    frame = yield from link.read()
+    if frame != control(byte):
+        raise ValueError('Expected %d, got %r' % (byte, frame))
+    return frame
+
+
+@asyncio.coroutine
+def online_exchange(link, frame: bytes) -> bytes:
+    # ENQ <- request -> ACK <- EOT -> response <- ACK -> EOT <-
+    yield from expect(link, protocol.ENQ)
+    link.send(frame)
+    yield from expect(link, protocol.ACK)
+    link.send(control(protocol.EOT))
+    response = yield from link.read()
+    if response[0] != protocol.STX:
+        raise ValueError('Response expected, got %r' % response)
+    link.send(control(protocol.ACK))
+    yield from link.read()
+    return response
+
+
+def response_text(response: bytes) -> str:
+    return response[9:25].decode(errors='replace').strip()
+
+
+def check_positive(response: bytes):
+    if response[2:3] != b'0':
+        raise ValueError('Declined: %s' % response_text(response))
+
+
+@asyncio.coroutine
+def close_exchange(link, terminal: Terminal) -> bytes:
+    # protocol type 2: no ACK for requests; the host answers every request with a poll, an inquiry
+    # or the final batch response
+    yield from expect(link, protocol.ENQ)
+    link.send(terminal.close_frame())
+    for _ in range(1000):
+        response = yield from link.read()
+        action = response[1:2]
+        if action == b'1':
+            item = terminal.items[response[4:7].decode()]
+            txn_type = response[9:10].decode() or FdmsTransactionType.SpecificPollTransaction.value
+            item.online = True
+            link.send(terminal.monetary_frame(item, txn_type=txn_type))
+        elif action == b'2':
+            link.send(terminal.revision_inquiry_frame(response[4:7].decode()))
+        else:
+            check_positive(response)
+            link.send(control(protocol.ACK))
+            yield from link.read()
+            return response
+    raise ValueError('Batch close did not finish')
+
+
+@asyncio.coroutine
+def run_transaction(link, terminal: Terminal, txn_type: str):
+    rnd = terminal.random
+    if txn_type == 'deposit':
+        response = yield from online_exchange(link, terminal.deposit_frame())
+        check_positive(response)
+
+    elif txn_type in ('swiped', 'keyed'):
+        code = FdmsTxnCode.Return if rnd.random() < 0.1 else FdmsTxnCode.Sale
+        item = terminal.new_item(txn_type == 'keyed', code.value, rnd.randrange(100, 20000) / 100.0)
+        response = yield from online_exchange(link, terminal.monetary_frame(item))
+        check_positive(response)
+        item.authorization_code = response_text(response).split(' ')[-1]
+
+    elif txn_type == 'auth':
+        item = Item('000', False, '4%015d' % rnd.randrange(10 ** 15), '1230', rnd.randrange(100, 20000) / 100.0,
+                    FdmsTxnCode.AuthOnly.value)
+        response = yield from online_exchange(link, terminal.monetary_frame(item, batch_no=0))
+        check_positive(response)
+        terminal.authorizations.append((response_text(response).split(' ')[-1], item.amount))
+
+    elif txn_type == 'ticket':
+        authorization_code, amount = terminal.authorizations.pop(0)
+        item = terminal.new_item(False, FdmsTxnCode.TicketOnly.value, amount)
+        response = yield from online_exchange(link, terminal.monetary_frame(item, additional=additional_data(
+            authorization_code)))
+        check_positive(response)
+
+    elif txn_type == 'void':
+        voids = {FdmsTxnCode.Sale.value: FdmsTxnCode.VoidSale.value,
+                 FdmsTxnCode.Return.value: FdmsTxnCode.VoidReturn.value,
+                 FdmsTxnCode.TicketOnly.value: FdmsTxnCode.VoidTicketOnly.value}
+        item = rnd.choice([item for item in terminal.items.values() if item.online and item.txn_code in voids])
+        item.txn_code = voids[item.txn_code]
+        item.revision += 1
+        response = yield from online_exchange(link, terminal.monetary_frame(item))
+        check_positive(response)
+
+    elif txn_type == 'close':
+        yield from close_exchange(link, terminal)
+        terminal.close_batch()
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.last_errors = dict()
+
+    def report(self, elapsed: float):
+        print('%-8s %7s %9s %9s %9s %9s %7s' % ('type', 'count', 'txn/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+        total = 0
+        for txn_type in TXN_TYPES:
+            latencies = sorted(self.latencies[txn_type])
+            count = len(latencies)
+            total += count
+            if count == 0 and self.errors[txn_type] == 0:
+                continue
+            print('%-8s %7d %9.1f %9.2f %9.2f %9.2f %7d' % (
+                txn_type, count, count / elapsed, percentile(latencies, 50) * 1e3,
+                percentile(latencies, 95) * 1e3, percentile(latencies, 99) * 1e3, self.errors[txn_type]))
+        print('%-8s %7d %9.1f' % ('total', total, total / elapsed))
+        for txn_type, error in sorted(self.last_errors.items()):
+            print('last %s error: %s' % (txn_type, error))
+
+
+def percentile(values: list, p: int) -> float:
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+
+class RateLimiter:
+    # starts at most `rate` sessions per second across all terminals; 0 means unlimited
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = time.perf_counter()
+
+    @asyncio.coroutine
+    def wait(self):
+        if self.interval == 0.0:
+            return
+        now = time.perf_counter()
+        start = max(now, self.next_time)
+        self.next_time = start + self.interval
+        if start > now:
+            yield from asyncio.sleep(start - now)
+
+
+def choose_txn(terminal: Terminal, mix: list, batch_size: int) -> str:
+    if len(terminal.items) >= batch_size and any(item.online for item in terminal.items.values()):
+        return 'close'
+    rnd = terminal.random
+    while True:
+        txn_type = weighted_choice(rnd, mix)
+        if txn_type == 'ticket' and len(terminal.authorizations) == 0:
+            return 'auth'
+        if txn_type == 'void' and not any(item.online and item.txn_code in '123' for item in terminal.items.values()):
+            continue
+        if txn_type == 'close' and not any(item.online for item in terminal.items.values()):
+            continue
+        return txn_type
+
+
+def weighted_choice(rnd: random.Random, mix: list) -> str:
+    point = rnd.uniform(0, sum(w for _, w in mix))
+    for txn_type, weight in mix:
+        point -= weight
+        if point <= 0:
+            return txn_type
+    return mix[-1][0]
+
+
+@asyncio.coroutine
+def run_terminal(terminal: Terminal, make_link, mix: list, args, limiter: RateLimiter, stats: Stats,
+                 deadline: float):
+    while time.perf_counter() < deadline:
+        txn_type = choose_txn(terminal, mix, args.batch_size)
+        if txn_type in ('swiped', 'keyed') and terminal.random.random() < args.offline:
+            # captured offline: the host learns about it from a specific poll at batch close
+            item = terminal.new_item(txn_type == 'keyed', FdmsTxnCode.Sale.value,
+                                     terminal.random.randrange(100, 20000) / 100.0)
+            item.online = False
+            continue
+
+        yield from limiter.wait()
+        link = make_link()
+        item_count = len(terminal.items)
+        start = time.perf_counter()
+        try:
+            yield from link.open(terminal)
+            yield from run_transaction(link, terminal, txn_type)
+            stats.latencies[txn_type].append(time.perf_counter() - start)
+        except Exception as e:
+            stats.errors[txn_type] += 1
+            stats.last_errors[txn_type] = '%s: %s' % (e.__class__.__name__, str(e))
+            if txn_type == 'close':
+                # the host may or may not have closed it; start over with a fresh batch
+                terminal.close_batch()
+            elif len(terminal.items) > item_count:
+                # a declined item is not part of the batch
+                terminal.items.popitem()
+        finally:
+            link.close()
+
+
+def parse_mix(text: str) -> list:
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in TXN_TYPES:
+            raise ValueError('Unknown transaction type: %s' % name)
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='FDMS terminal traffic simulator')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--unix', metavar='PATH', help='FDMS unix socket, e.g. fdms.1')
+    target.add_argument('--tls', metavar='HOST:PORT', help='SiteNet TLS listener, e.g. localhost:8444')
+    parser.add_argument('--cert', default=CERT_PATH, help='certificate the SiteNet listener presents')
+    parser.add_argument('--terminals', type=int, default=10, help='terminals running concurrently')
+    parser.add_argument('--rate', type=float, default=0.0, help='sessions started per second (0 = unlimited)')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to run')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='transaction weights, e.g. %s' % DEFAULT_MIX)
+    parser.add_argument('--batch-size', type=int, default=20, help='items per batch before it is closed')
+    parser.add_argument('--offline', type=float, default=0.05,
+                        help='share of sales kept offline until the host polls them at batch close')
+    parser.add_argument('--merchant', default=None, help='11-digit merchant prefix (random by default)')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    rnd = random.Random(args.seed)
+    prefix = args.merchant if args.merchant is not None else '4%010d' % rnd.randrange(10 ** 10)
+    mix = parse_mix(args.mix)
+
+    if args.unix is not None:
+        def make_link():
+            return UnixLink(args.unix)
+    else:
+        host, _, port = args.tls.rpartition(':')
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.check_hostname = False
+        context.load_verify_locations(args.cert)
+
+        def make_link():
+            return SiteNetLink(host or 'localhost', int(port), context)
+
+    terminals = [Terminal('%s%05d' % (prefix, i // 100), '%.4d' % (i % 100 + 1), random.Random(rnd.random()))
+                 for i in range(args.terminals)]
+    stats = Stats()
+    limiter = RateLimiter(args.rate)
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    deadline = start + args.duration
+    loop.run_until_complete(asyncio.wait([asyncio.Task(run_terminal(terminal, make_link, mix, args, limiter,
+                                                                    stats, deadline)) for terminal in terminals]))
+    stats.report(time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
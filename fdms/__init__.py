@@ -1,9 +1,27 @@
 LOG_NAME = 'FDMS Processor'
 
-from .site_net_protocol import site_net_session
-from .fdms_protocol import fdms_session
-from .sqlite_storage import fdms_metadata, set_database_name
-
-__all__ = (LOG_NAME, 'site_net_session', 'fdms_session', 'fdms_metadata', 'set_database_name')
-
+from .site_net_protocol import site_net_session, reject_site_net_session
+from .fdms_protocol import fdms_session, reject_session, set_terminal_timeouts, FdmsProtocol
+from .fdms_protocol import fdms_route_session, set_local_shard
+from .fdms_admission import AdmissionController, admit_session
+from .fdms_bridge import open_memory_connection
+from .fdms_pool import FdmsConnectionPool
+from .fdms_executor import TransactionExecutor, KeyedTransactionExecutor, set_txn_executor
+from .fdms_cache import BatchCache
+from .fdms_auth_index import AuthorizationIndex
+from .fdms_replay import ReplayCache, set_replay_cache
+from .fdms_processor import set_batch_cache, set_authorization_index
+from .sqlite_storage import fdms_metadata, set_database_name, set_group_commit as set_sql_group_commit
+from .sqlite_storage import set_profile as set_sqlite_profile, open_database as open_sql_database
+from .sqlite_profile import SqliteProfile
+from .leveldb_storage import set_database_path as set_level_db_path
+from .leveldb_storage import set_group_commit as set_level_db_group_commit
 
+__all__ = (LOG_NAME, 'site_net_session', 'reject_site_net_session', 'fdms_session', 'reject_session',
+           'set_terminal_timeouts', 'FdmsProtocol', 'fdms_route_session', 'set_local_shard',
+           'AdmissionController', 'admit_session', 'open_memory_connection',
+           'FdmsConnectionPool', 'TransactionExecutor', 'KeyedTransactionExecutor', 'set_txn_executor',
+           'BatchCache', 'set_batch_cache', 'AuthorizationIndex', 'set_authorization_index',
+           'ReplayCache', 'set_replay_cache',
+           'fdms_metadata', 'set_database_name', 'set_sql_group_commit', 'set_level_db_path',
+           'set_level_db_group_commit', 'SqliteProfile', 'set_sqlite_profile', 'open_sql_database')
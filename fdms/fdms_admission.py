@@ -0,0 +1,98 @@
+import asyncio
+import collections
+
+
+class AdmissionController:
+    # Caps the number of sessions running at once. Up to max_queued sessions over the cap wait
+    # for a slot, but no longer than max_wait seconds (the queueing latency target); sessions that
+    # find the queue full or wait too long are shed, so the caller can reject them right away.
+    def __init__(self, max_active: int, max_queued=0, max_wait=1.0, loop=None):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self._loop = loop
+        self._waiters = collections.deque()
+        ''':type: collections.deque of [asyncio.Future]'''
+        self.active = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.expired = 0
+
+    def request(self) -> asyncio.Future:
+        # resolves to True when the session may run, False when it is shed
+        loop = self._loop if self._loop is not None else asyncio.get_event_loop()
+        waiter = asyncio.Future(loop=loop)
+        if self.active < self.max_active and len(self._waiters) == 0:
+            self.active += 1
+            self.admitted += 1
+            waiter.set_result(True)
+        elif len(self._waiters) < self.max_queued:
+            self.queued += 1
+            self._waiters.append(waiter)
+            loop.call_later(self.max_wait, self._expire, waiter)
+        else:
+            self.shed += 1
+            waiter.set_result(False)
+        return waiter
+
+    @asyncio.coroutine
+    def acquire(self) -> bool:
+        waiter = self.request()
+        try:
+            result = yield from waiter
+        except asyncio.CancelledError:
+            self.cancel(waiter)
+            raise
+        return result
+
+    def _expire(self, waiter: asyncio.Future):
+        if not waiter.done():
+            self._waiters.remove(waiter)
+            self.shed += 1
+            self.expired += 1
+            waiter.set_result(False)
+
+    def cancel(self, waiter: asyncio.Future):
+        # the slot may have been handed over just before the session went away
+        if waiter.done() and not waiter.cancelled() and waiter.result():
+            self.release()
+        elif waiter in self._waiters:
+            self._waiters.remove(waiter)
+            waiter.cancel()
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # the slot passes straight to the oldest waiter
+                self.admitted += 1
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+    def metrics(self) -> dict:
+        return {
+            'max_active': self.max_active,
+            'active': self.active,
+            'waiting': len(self._waiters),
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'shed': self.shed,
+            'expired': self.expired,
+        }
+
+
+@asyncio.coroutine
+def admit_session(admission: AdmissionController, session, reject):
+    # runs the session coroutine if admitted, otherwise closes it unstarted and calls reject()
+    admitted = yield from admission.acquire()
+    if not admitted:
+        session.close()
+        reject()
+        return
+
+    try:
+        yield from session
+    finally:
+        admission.release()
@@ -0,0 +1,115 @@
+import asyncio
+import datetime
+import logging
+import threading
+from . import LOG_NAME
+from . import fdms_executor
+
+AUTH_EXPIRY = datetime.timedelta(days=7)
+AUTH_SWEEP_INTERVAL = 3600.0
+
+
+class AuthorizationIndex:
+    # The uncaptured auth-only authorizations by (merchant_number, authorization_code), so a
+    # ticket-only with a code that is not here is rejected without a storage lookup. Loaded from
+    # storage once, then updated by the processor after every save. Authorizations older than
+    # max_age are expired by the sweeper, in storage and here, which keeps the index small; the
+    # storage keeps their records, marked expired.
+    # Like the batch cache it relies on every merchant being served by a single process.
+    def __init__(self, max_age=AUTH_EXPIRY):
+        self.max_age = max_age
+        self._entries = dict()
+        ''':type: dict[(str, str), dict[int, datetime.datetime]]'''
+        self._lock = threading.Lock()
+        self._storage_class = None
+        self._timer = None
+        self.lookups = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def __len__(self):
+        return sum(len(ids) for ids in self._entries.values())
+
+    def load(self, storage_class) -> int:
+        # storage_class is kept for the sweeper
+        self._storage_class = storage_class
+        with storage_class() as storage:
+            authorizations = storage.query_uncaptured_authorizations()
+        with self._lock:
+            self._entries.clear()
+            for auth in authorizations:
+                self._entries.setdefault((auth.merchant_number, auth.authorization_code), dict())[auth.id] = auth.date
+        return len(authorizations)
+
+    def add(self, merchant_number: str, authorization_code: str, auth_id: int, date: datetime.datetime):
+        with self._lock:
+            self._entries.setdefault((merchant_number, authorization_code), dict())[auth_id] = date
+
+    def discard(self, merchant_number: str, authorization_code: str, auth_id: int):
+        key = (merchant_number, authorization_code)
+        with self._lock:
+            ids = self._entries.get(key)
+            if ids is not None:
+                ids.pop(auth_id, None)
+                if len(ids) == 0:
+                    del self._entries[key]
+
+    def might_contain(self, merchant_number: str, authorization_code: str) -> bool:
+        # False is final; True still needs the storage lookup
+        found = (merchant_number, authorization_code) in self._entries
+        with self._lock:
+            self.lookups += 1
+            if not found:
+                self.rejected += 1
+        return found
+
+    def expire(self, now: datetime.datetime=None) -> int:
+        before = (now if now is not None else datetime.datetime.now()) - self.max_age
+        with self._storage_class() as storage:
+            count = storage.expire_authorizations(before)
+            storage.save()
+        with self._lock:
+            for key in list(self._entries):
+                ids = self._entries[key]
+                for auth_id in [auth_id for auth_id, date in ids.items() if date < before]:
+                    del ids[auth_id]
+                if len(ids) == 0:
+                    del self._entries[key]
+            self.expired += count
+        return count
+
+    def _sweep(self):
+        try:
+            count = self.expire()
+            if count > 0:
+                logging.getLogger(LOG_NAME).debug('Expired %d uncaptured authorizations', count)
+        except Exception as e:
+            logging.getLogger(LOG_NAME).debug('Authorization sweep error: %s', str(e))
+
+    def start(self, interval=AUTH_SWEEP_INTERVAL, loop=None):
+        # sweeps every `interval` seconds, on the transaction executor when there is one
+        loop = loop if loop is not None else asyncio.get_event_loop()
+
+        def sweep():
+            executor = fdms_executor.TXN_EXECUTOR
+            if executor is not None:
+                executor.submit(self._sweep)
+            else:
+                self._sweep()
+            self._timer = loop.call_later(interval, sweep)
+
+        self._timer = loop.call_later(interval, sweep)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self),
+                'lookups': self.lookups,
+                'rejected': self.rejected,
+                'expired': self.expired,
+            }
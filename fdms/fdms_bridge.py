@@ -0,0 +1,87 @@
+import asyncio
+
+
+class MemoryTransport(asyncio.Transport):
+    # One end of an in-process connection: writes are handed straight to the peer protocol's
+    # data_received, so frames never touch a socket. Flow control is not needed in memory.
+    def __init__(self, loop: asyncio.AbstractEventLoop, protocol: asyncio.Protocol):
+        super().__init__()
+        self._loop = loop
+        self._protocol = protocol
+        self._closing = False
+        self._eof = False
+        self.peer = None
+        ''':type: MemoryTransport'''
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return 'memory'
+        return default
+
+    def is_closing(self):
+        return self._closing
+
+    def write(self, data):
+        if self._eof or self._closing or len(data) == 0:
+            return
+        peer = self.peer
+        if not peer._closing:
+            peer._protocol.data_received(bytes(data))
+
+    def can_write_eof(self):
+        return True
+
+    def write_eof(self):
+        if self._eof or self._closing:
+            return
+        self._eof = True
+        peer = self.peer
+        if not peer._closing and not peer._protocol.eof_received():
+            peer.close()
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.call_soon(self._protocol.connection_lost, None)
+        self.peer.close()
+
+    def abort(self):
+        self.close()
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+
+def connect_memory_transports(loop: asyncio.AbstractEventLoop, client: asyncio.Protocol,
+                              server: asyncio.Protocol) -> (MemoryTransport, MemoryTransport):
+    client_transport = MemoryTransport(loop, client)
+    server_transport = MemoryTransport(loop, server)
+    client_transport.peer = server_transport
+    server_transport.peer = client_transport
+    # the server may greet (ENQ) from connection_made, so the client has to be ready first
+    client.connection_made(client_transport)
+    server.connection_made(server_transport)
+    return client_transport, server_transport
+
+
+@asyncio.coroutine
+def open_memory_connection(protocol_factory, loop=None) -> (asyncio.StreamReader, asyncio.StreamWriter):
+    # Like asyncio.open_unix_connection, but the server side is protocol_factory() in this process:
+    # FdmsProtocol, or a StreamReaderProtocol whose callback starts fdms_session.
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(loop=loop)
+    protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+    transport, _ = connect_memory_transports(loop, protocol, protocol_factory())
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
@@ -0,0 +1,221 @@
+import collections
+import threading
+from .fdms_model import *
+
+BATCH_CACHE_SIZE = 10000
+
+_BATCH_FIELDS = ('id', 'merchant_number', 'device_id', 'batch_no', 'date_open', 'credit_count', 'debit_count',
+                 'credit_amount', 'debit_amount', 'max_item_no')
+_UNKNOWN = object()  # the slot has not been loaded, unlike None: the terminal has no such batch
+_OPEN, _CLOSED = 0, 1
+
+
+def copy_batch(batch: OpenBatch) -> OpenBatch:
+    # a plain copy of a batch, not bound to any storage session
+    if batch is None:
+        return None
+    if hasattr(batch, 'date_closed'):  # a ClosedBatch, or a row of SqlCoreStorage
+        result = ClosedBatch()
+        result.date_closed = batch.date_closed
+    else:
+        result = OpenBatch()
+        result.item_bitmap = batch.item_bitmap
+        result.revisions = batch.revisions
+    for name in _BATCH_FIELDS:
+        setattr(result, name, getattr(batch, name))
+    return result
+
+
+class BatchCache:
+    # The open batch and the last closed batch of each terminal, keyed by (merchant_number, device_id)
+    # and evicted least recently used first. It holds copies, never objects of a storage session.
+    # CachedStorage writes through it: batches a session stores reach the cache when the session
+    # saves and are dropped when it does not. Every merchant is served by one process (see
+    # fdms_supervisor), so the cache of that process is the only one that can go stale.
+    def __init__(self, max_size=BATCH_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        ''':type: collections.OrderedDict[(str, str), list]'''
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def generation(self) -> int:
+        # changes with every write, see fill()
+        return self._generation
+
+    def _get(self, key, slot: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[slot] is _UNKNOWN:
+                self.misses += 1
+                return _UNKNOWN
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy_batch(entry[slot])
+
+    def get_open_batch(self, key):
+        return self._get(key, _OPEN)
+
+    def last_closed_batch(self, key):
+        return self._get(key, _CLOSED)
+
+    def _set(self, key, open_batch, closed_batch):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = [_UNKNOWN, _UNKNOWN]
+            self._entries[key] = entry
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._entries.move_to_end(key)
+        if open_batch is not _UNKNOWN:
+            entry[_OPEN] = copy_batch(open_batch)
+        if closed_batch is not _UNKNOWN:
+            entry[_CLOSED] = copy_batch(closed_batch)
+
+    def update(self, key, open_batch=_UNKNOWN, closed_batch=_UNKNOWN):
+        with self._lock:
+            self._generation += 1
+            self._set(key, open_batch, closed_batch)
+
+    def fill(self, key, generation: int, open_batch=_UNKNOWN, closed_batch=_UNKNOWN):
+        # stores what was read from storage, unless a write went through the cache since
+        # `generation` was taken: the value read may be older than that write
+        with self._lock:
+            if generation == self._generation:
+                self._set(key, open_batch, closed_batch)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def warm_up(self, storage_class) -> int:
+        # loads the open batches, with the last closed batch of their terminals, up to max_size
+        count = 0
+        with storage_class() as storage:
+            for batch in storage.query_open_batches()[:self.max_size]:
+                key = (batch.merchant_number, batch.device_id)
+                generation = self._generation
+                closed_batch = storage.last_closed_batch(batch.merchant_number, batch.device_id)
+                self.fill(key, generation, open_batch=batch, closed_batch=closed_batch)
+                count += 1
+        return count
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'max_size': self.max_size,
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+class CachedStorage:
+    # Mixed in ahead of a storage backend by cached_storage(). Batch lookups are answered from
+    # the cache; create_batch, put_batch_record and close_batch write to the backend and keep the
+    # batches they wrote, which go to the cache when the session exits after saving them and are
+    # invalidated otherwise. A lookup the cache answers returns a copy, which the backend stores like
+    # the batch it loaded itself.
+    batch_cache = None
+    ''':type: BatchCache'''
+    storage_class = None
+
+    def __init__(self):
+        super().__init__()
+        self._cache_updates = {}
+        self._saved_updates = {}
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # with group commit the backend exits once the saved writes are durable
+        saved, self._saved_updates = self._saved_updates, {}
+        unsaved, self._cache_updates = self._cache_updates, {}
+        try:
+            result = super().__exit__(exc_type, exc_val, exc_tb)
+        except Exception:
+            for key in set(saved) | set(unsaved):
+                self.batch_cache.invalidate(key)
+            raise
+        for key, (open_batch, closed_batch) in saved.items():
+            self.batch_cache.update(key, open_batch=open_batch, closed_batch=closed_batch)
+        for key in unsaved:
+            self.batch_cache.invalidate(key)
+        return result
+
+    def save(self):
+        super().save()
+        for key, update in self._cache_updates.items():
+            saved = self._saved_updates.setdefault(key, [_UNKNOWN, _UNKNOWN])
+            for slot in (_OPEN, _CLOSED):
+                if update[slot] is not _UNKNOWN:
+                    saved[slot] = update[slot]
+        self._cache_updates.clear()
+
+    def _lookup(self, key, slot: int, load):
+        for updates in (self._cache_updates, self._saved_updates):
+            update = updates.get(key)
+            if update is not None and update[slot] is not _UNKNOWN:
+                return copy_batch(update[slot])
+
+        cache = self.batch_cache
+        generation = cache.generation
+        batch = cache.get_open_batch(key) if slot == _OPEN else cache.last_closed_batch(key)
+        if batch is _UNKNOWN:
+            batch = load(*key)
+            if slot == _OPEN:
+                cache.fill(key, generation, open_batch=batch)
+            else:
+                cache.fill(key, generation, closed_batch=batch)
+        return batch
+
+    def _cache_write(self, key, slot: int, batch):
+        update = self._cache_updates.setdefault(key, [_UNKNOWN, _UNKNOWN])
+        update[slot] = copy_batch(batch)
+
+    def get_open_batch(self, merchant_number, device_id) -> OpenBatch:
+        return self._lookup((merchant_number, device_id), _OPEN, super().get_open_batch)
+
+    def last_closed_batch(self, merchant_number, device_id) -> ClosedBatch:
+        return self._lookup((merchant_number, device_id), _CLOSED, super().last_closed_batch)
+
+    def create_batch(self, merchant_number, device_id, batch_no) -> OpenBatch:
+        batch = super().create_batch(merchant_number, device_id, batch_no)
+        self._cache_write((merchant_number, device_id), _OPEN, batch)
+        return batch
+
+    def put_batch_record(self, batch_record: BatchRecord, batch: OpenBatch=None):
+        super().put_batch_record(batch_record, batch)
+        if batch is not None:
+            self._cache_write((batch.merchant_number, batch.device_id), _OPEN, batch)
+
+    def close_batch(self, batch: OpenBatch, credit: (int, float), debit: (int, float)) -> ClosedBatch:
+        closed_batch = super().close_batch(batch, credit, debit)
+        key = (batch.merchant_number, batch.device_id)
+        self._cache_write(key, _OPEN, None)
+        self._cache_write(key, _CLOSED, closed_batch)
+        return closed_batch
+
+
+def cached_storage(storage_class, cache: BatchCache):
+    # a storage class that serves batches from `cache`, see CachedStorage
+    return type('Cached' + storage_class.__name__, (CachedStorage, storage_class),
+                {'batch_cache': cache, 'storage_class': storage_class})
@@ -0,0 +1,34 @@
+STX = 2
+
+PARITY_TABLE = bytes(b & 0x7f for b in range(256))
+
+
+def strip_parity(data: bytes) -> bytes:
+    return data.translate(PARITY_TABLE)
+
+
+def lrc(data: bytes, start=0, end=None) -> int:
+    if start == 0 and end is None:
+        size = len(data)
+        value = int.from_bytes(data, byteorder='big')
+    else:
+        with memoryview(data) as view:
+            part = view[start:end]
+            size = len(part)
+            value = int.from_bytes(part, byteorder='big')
+            part.release()
+
+    # XOR the upper half into the lower half until a single byte is left
+    while size > 1:
+        low_size = size - (size >> 1)
+        bits = low_size * 8
+        value = (value >> bits) ^ (value & ((1 << bits) - 1))
+        size = low_size
+
+    return value
+
+
+def validate_frame(frame: bytes) -> bool:
+    if len(frame) < 3 or frame[0] != STX:
+        return False
+    return lrc(frame, 1, -1) == frame[-1]
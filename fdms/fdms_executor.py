@@ -0,0 +1,153 @@
+import asyncio
+import collections
+import concurrent.futures
+import queue
+import threading
+
+TXN_EXECUTOR = None
+''':type: TransactionExecutor'''
+
+
+def set_txn_executor(executor):
+    global TXN_EXECUTOR
+    TXN_EXECUTOR = executor
+
+
+class TransactionExecutor:
+    # Runs transaction processing on a thread pool so storage I/O does not block the event loop.
+    # A session waits for its transactions before it reads the next request, so transactions
+    # of one session are processed in order; different sessions run concurrently.
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+
+    def _run(self, func, args):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        failed = True
+        try:
+            result = func(*args)
+            failed = False
+            return result
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                if failed:
+                    self.failed += 1
+
+    def submit(self, func, *args) -> concurrent.futures.Future:
+        with self._lock:
+            self.submitted += 1
+            self.queued += 1
+            if self.queued > self.max_queued:
+                self.max_queued = self.queued
+        return self._executor.submit(self._run, func, args)
+
+    def submit_keyed(self, key, func, *args) -> concurrent.futures.Future:
+        # the plain pool does not order jobs by key
+        return self.submit(func, *args)
+
+    @asyncio.coroutine
+    def run(self, func, *args, loop=None):
+        result = yield from asyncio.wrap_future(self.submit(func, *args), loop=loop)
+        return result
+
+    @asyncio.coroutine
+    def run_keyed(self, key, func, *args, loop=None):
+        result = yield from asyncio.wrap_future(self.submit_keyed(key, func, *args), loop=loop)
+        return result
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'queued': self.queued,
+                'running': self.running,
+                'max_queued': self.max_queued,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class KeyedTransactionExecutor(TransactionExecutor):
+    # Jobs submitted with the same key run one at a time in submission order; different keys
+    # run in parallel. A key holds at most one slot in the pool queue and goes back to its tail
+    # after every job, so busy keys are served round-robin and cannot starve quiet ones.
+    # A key may have max_pending jobs waiting, all keys together max_backlog; beyond either
+    # submit_keyed raises queue.Full and the session is turned away.
+    def __init__(self, max_workers=4, max_pending=16, max_backlog=256):
+        super().__init__(max_workers=max_workers)
+        self.max_pending = max_pending
+        self.max_backlog = max_backlog
+        self._pending = dict()
+        ''':type: dict[object, collections.deque]'''
+        self.rejected = 0
+
+    def submit_keyed(self, key, func, *args) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None and len(pending) >= self.max_pending:
+                self.rejected += 1
+                raise queue.Full('Too many pending jobs for %s' % str(key))
+            if self.queued >= self.max_backlog:
+                self.rejected += 1
+                raise queue.Full('Too many pending jobs')
+            self.submitted += 1
+            self.queued += 1
+            if self.queued > self.max_queued:
+                self.max_queued = self.queued
+            schedule = pending is None
+            if schedule:
+                pending = collections.deque()
+                self._pending[key] = pending
+            pending.append((future, func, args))
+        if schedule:
+            self._executor.submit(self._run_next, key)
+        return future
+
+    def _run_next(self, key):
+        with self._lock:
+            pending = self._pending[key]
+            future, func, args = pending[0]
+
+        if future.set_running_or_notify_cancel():
+            try:
+                result = self._run(func, args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+        else:
+            with self._lock:
+                self.queued -= 1
+
+        with self._lock:
+            pending.popleft()
+            schedule = len(pending) > 0
+            if not schedule:
+                del self._pending[key]
+        if schedule:
+            self._executor.submit(self._run_next, key)
+
+    def metrics(self) -> dict:
+        result = super().metrics()
+        with self._lock:
+            result['keys'] = len(self._pending)
+            result['max_pending'] = self.max_pending
+            result['max_backlog'] = self.max_backlog
+            result['rejected'] = self.rejected
+        return result
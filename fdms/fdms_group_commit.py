@@ -0,0 +1,113 @@
+import threading
+import time
+
+GROUP_COMMIT_DELAY = 0.002
+
+
+class CommitGroup:
+    __slots__ = ('items', 'done', 'error')
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+
+
+class GroupCommit:
+    # Makes the writes of concurrently finishing storage sessions durable with one commit.
+    # The first session to join a group leads it: it waits until no other session is running,
+    # or for max_delay at most, then closes the group and flushes it. The sessions that joined
+    # in the meantime block until the flush is done, so none of them returns before its data is
+    # durable, and a failed flush is raised in every one of them. Backends subclass it and
+    # implement _flush(); _commit_group() is theirs to override when closing the group has to
+    # be atomic with the flush.
+    def __init__(self, max_delay=GROUP_COMMIT_DELAY):
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        self._group = CommitGroup()
+        self._active = 0
+        self.commits = 0
+        self.sessions = 0
+        self.max_group = 0
+        self.failed = 0
+
+    def _flush(self, items: list):
+        raise NotImplementedError('%s._flush()' % self.__class__.__name__)
+
+    def _close(self, group: CommitGroup):
+        # sessions joining from now on go to the next group
+        with self._cond:
+            if self._group is group:
+                self._group = CommitGroup()
+
+    def _commit_group(self, group: CommitGroup):
+        self._close(group)
+        self._flush(group.items)
+
+    def begin(self):
+        # a session started: leaders wait for it, up to max_delay
+        with self._cond:
+            self._active += 1
+
+    def end(self):
+        # a session finished without anything to commit
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def join(self, item) -> (CommitGroup, bool):
+        # a session finished: its item goes to the open group, whose first session leads it
+        with self._cond:
+            self._active -= 1
+            group = self._group
+            group.items.append(item)
+            self._cond.notify_all()
+            return group, len(group.items) == 1
+
+    def wait(self, group: CommitGroup, leader: bool):
+        # blocks until the group is flushed, by its leader
+        with self._cond:
+            if not leader:
+                while not group.done:
+                    self._cond.wait()
+                if group.error is not None:
+                    raise group.error
+                return
+
+            deadline = time.monotonic() + self.max_delay
+            while self._active > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+        try:
+            self._commit_group(group)
+        except Exception as e:
+            group.error = e
+
+        with self._cond:
+            group.done = True
+            self.commits += 1
+            self.sessions += len(group.items)
+            self.max_group = max(self.max_group, len(group.items))
+            if group.error is not None:
+                self.failed += 1
+            self._cond.notify_all()
+        if group.error is not None:
+            raise group.error
+
+    def commit(self, item):
+        self.wait(*self.join(item))
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                'max_delay': self.max_delay,
+                'active': self._active,
+                'commits': self.commits,
+                'sessions': self.sessions,
+                'sessions_per_commit': self.sessions / self.commits if self.commits > 0 else 0.0,
+                'max_group': self.max_group,
+                'failed': self.failed,
+            }
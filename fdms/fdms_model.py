@@ -1,6 +1,11 @@
 import datetime
 import hashlib
 
+VOID_TXN_CODES = frozenset(('5', '6', '7'))
+RETURN_TXN_CODE = '2'
+ITEM_SLOTS = 1000
+
+
 class Authorization:
     def __init__(self):
         self.id = None
@@ -11,6 +16,7 @@ class Authorization:
         self.card_hash = ''
         self.date = datetime.datetime.now()
         self.amount = 0.0
+        self.is_expired = False  # uncaptured for too long, no ticket-only captures it
 
     def __repr__(self):
         return "<%s(authorization_code='%s', date='%s', amount='%.2f')>" % \
@@ -25,6 +31,74 @@ class OpenBatch:
         self.device_id = device_id
         self.batch_no = batch_no
         self.date_open = datetime.datetime.now()
+        # running totals of the batch records, kept up to date by add_record/remove_record
+        self.credit_count = 0
+        self.debit_count = 0
+        self.credit_amount = 0.0
+        self.debit_amount = 0.0
+        self.max_item_no = 0
+        ''':type: int max credit item number'''
+        # bit n of item_bitmap is set when item n is in the batch, revisions[n] is its revision
+        self.item_bitmap = bytes(ITEM_SLOTS // 8)
+        self.revisions = bytes(ITEM_SLOTS)
+
+    def add_record(self, record):
+        amount = record.batch_amount()
+        item_no = int(record.item_no)
+        if record.is_credit:
+            self.credit_count += 1
+            self.credit_amount += amount
+            if item_no > self.max_item_no:
+                self.max_item_no = item_no
+        else:
+            self.debit_count += 1
+            self.debit_amount += amount
+
+        # the arrays are replaced, not changed in place, so the SQL session sees the change
+        bitmap = bytearray(self.item_bitmap)
+        bitmap[item_no >> 3] |= 1 << (item_no & 7)
+        self.item_bitmap = bytes(bitmap)
+        revisions = bytearray(self.revisions)
+        revisions[item_no] = int(record.revision_no) if record.revision_no.isdigit() else 0
+        self.revisions = bytes(revisions)
+
+    def remove_record(self, record):
+        # called before a record is revised; the item stays in the batch, add_record
+        # stores its new revision
+        amount = record.batch_amount()
+        if record.is_credit:
+            self.credit_count -= 1
+            self.credit_amount -= amount
+        else:
+            self.debit_count -= 1
+            self.debit_amount -= amount
+
+    def rebuild(self, records: list):
+        # the totals and arrays recomputed from all records of the batch, for a batch stored
+        # before it kept them
+        self.credit_count = 0
+        self.debit_count = 0
+        self.credit_amount = 0.0
+        self.debit_amount = 0.0
+        self.max_item_no = 0
+        self.item_bitmap = bytes(ITEM_SLOTS // 8)
+        self.revisions = bytes(ITEM_SLOTS)
+        for record in records:
+            self.add_record(record)
+
+    def missing_items(self, next_item_no: int) -> list:
+        # item numbers below next_item_no the batch does not have, highest first
+        present = int.from_bytes(self.item_bitmap, byteorder='little')
+        missing = ((1 << next_item_no) - 2) & ~present
+        result = []
+        while missing:
+            item_no = missing.bit_length() - 1
+            result.append(item_no)
+            missing ^= 1 << item_no
+        return result
+
+    def has_item(self, item_no: int) -> bool:
+        return self.item_bitmap[item_no >> 3] & (1 << (item_no & 7)) != 0
 
     def __repr__(self):
         return "<%s(merchant_number='%s', device_id='%s', batch_no='%s' date_open='%s')>" % \
@@ -35,10 +109,6 @@ class ClosedBatch(OpenBatch):
     def __init__(self):
         super().__init__()
         self.date_closed = datetime.datetime.now()
-        self.credit_count = 0
-        self.debit_count = 0
-        self.credit_amount = 0.0
-        self.debit_amount = 0.0
 
     def from_batch(self, batch: OpenBatch):
         self.id = batch.id
@@ -46,6 +116,7 @@ class ClosedBatch(OpenBatch):
         self.device_id = batch.device_id
         self.batch_no = batch.batch_no
         self.date_open = batch.date_open
+        self.max_item_no = batch.max_item_no
 
     def __repr__(self):
         return "<%s(merchant_number='%s', device_id='%s', batch_no='%s' " \
@@ -65,6 +136,14 @@ class BatchRecord:
         self.is_credit = True
         self.amount = 0.0
 
+    def batch_amount(self) -> float:
+        # what the record adds to the batch total: voids count as zero, returns as credits back
+        if self.txn_code in VOID_TXN_CODES:
+            return 0.0
+        if self.txn_code == RETURN_TXN_CODE:
+            return -self.amount
+        return self.amount
+
     def __repr__(self):
         return "<%s(batch_id='%d', item_no='%s', revision_no='%s' txn_code='%s', amount='%.2f')>" % \
                (self.__class__.__name__, self.batch_id, self.item_no, self.revision_no, self.txn_code, self.amount)
@@ -82,6 +161,9 @@ class FdmsStorage:
     def get_open_batch(self, merchant_number, device_id) -> OpenBatch:
         raise NotImplementedError('%s.get_open_batch()' % self.__class__.__name__)
 
+    def query_open_batches(self) -> list:
+        raise NotImplementedError('%s.query_open_batches()' % self.__class__.__name__)
+
     def create_batch(self, merchant_number, device_id, batch_no) -> OpenBatch:
         raise NotImplementedError('%s.create_batch()' % self.__class__.__name__)
 
@@ -91,12 +173,23 @@ class FdmsStorage:
     def query_batch_items(self, batch_id: int):
         raise NotImplementedError('%s.query_batch_items()' % self.__class__.__name__)
 
-    def put_batch_record(self, batch_record: BatchRecord):
+    def put_batch_record(self, batch_record: BatchRecord, batch: OpenBatch=None):
+        # a batch given along is stored with the record, so its running totals never
+        # disagree with the records
         raise NotImplementedError('%s.put_batch_record()' % self.__class__.__name__)
 
     def query_authorization(self, merchant_number, authorization_code) -> list:
         raise NotImplementedError('%s.query_authorization()' % self.__class__.__name__)
 
+    def query_uncaptured_authorizations(self, merchant_number=None, authorization_code=None) -> list:
+        # auth-only authorizations not yet captured by a ticket-only nor expired; all of them without arguments
+        raise NotImplementedError('%s.query_uncaptured_authorizations()' % self.__class__.__name__)
+
+    def expire_authorizations(self, before: datetime.datetime) -> int:
+        # marks the uncaptured authorizations older than `before` expired, returns how many;
+        # they are kept, only query_uncaptured_authorizations() no longer returns them
+        raise NotImplementedError('%s.expire_authorizations()' % self.__class__.__name__)
+
     def get_authorization(self, rec_id) -> Authorization:
         raise NotImplementedError('%s.get_authorization()' % self.__class__.__name__)
 
@@ -0,0 +1,153 @@
+import asyncio
+import collections
+import logging
+import time
+from .fdms_protocol import FdmsFrameReader, ENQ, REQUEST_TIMEOUT
+from . import LOG_NAME
+
+GREETING = bytes((ENQ,))
+
+
+class PooledConnection:
+    def __init__(self, frames: FdmsFrameReader, writer: asyncio.StreamWriter):
+        self.frames = frames
+        self.writer = writer
+        self.created = time.monotonic()
+
+
+class FdmsConnectionPool:
+    # Keeps min_size backend connections open and greeted, so a SiteNet session does not wait for
+    # connect/accept. A connection is healthy once the backend has sent its ENQ greeting; it is
+    # dropped before the backend's own request timeout can close it (max_idle). The FDMS engine
+    # ends its session after a transaction, so only connections that never carried a request
+    # are returned to the pool, everything else is discarded.
+    def __init__(self, connect, min_size=2, max_size=16, max_idle=REQUEST_TIMEOUT - 5.0,
+                 connect_timeout=5.0, loop=None):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.connect_timeout = connect_timeout
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._idle = collections.deque()
+        ''':type: collections.deque of [PooledConnection]'''
+        self._opening = 0
+        self._checked_out = dict()
+        ''':type: dict[int, PooledConnection]'''
+        self._timer = None
+        self.hits = 0
+        self.misses = 0
+        self.returned = 0
+        self.discarded = 0
+        self.failed = 0
+
+    def start(self):
+        self._sweep()
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._idle:
+            self._idle.popleft().writer.close()
+
+    @asyncio.coroutine
+    def _open(self) -> PooledConnection:
+        reader, writer = yield from asyncio.wait_for(self.connect(), self.connect_timeout)
+        frames = FdmsFrameReader(reader)
+        try:
+            greeting = yield from asyncio.wait_for(frames.read_packet(), self.connect_timeout)
+        except Exception:
+            writer.close()
+            raise
+        if greeting != GREETING:
+            writer.close()
+            raise ConnectionError('FDMS backend did not greet with ENQ')
+        return PooledConnection(frames, writer)
+
+    @asyncio.coroutine
+    def _warm(self):
+        try:
+            conn = yield from self._open()
+        except Exception as e:
+            self.failed += 1
+            logging.getLogger(LOG_NAME).debug('Pool connect error: %s', str(e))
+            return
+        finally:
+            self._opening -= 1
+
+        if len(self._idle) < self.max_size:
+            self._idle.append(conn)
+        else:
+            conn.writer.close()
+
+    def _fill(self):
+        while len(self._idle) + self._opening < self.min_size:
+            self._opening += 1
+            asyncio.Task(self._warm(), loop=self._loop)
+
+    def _healthy(self, conn: PooledConnection, now: float) -> bool:
+        return now - conn.created < self.max_idle and not conn.writer.transport.is_closing() \
+            and not conn.frames.at_eof()
+
+    def _sweep(self):
+        now = time.monotonic()
+        idle = collections.deque()
+        for conn in self._idle:
+            if self._healthy(conn, now):
+                idle.append(conn)
+            else:
+                self.discarded += 1
+                conn.writer.close()
+        self._idle = idle
+        self._fill()
+        self._timer = self._loop.call_later(1.0, self._sweep)
+
+    @asyncio.coroutine
+    def acquire(self) -> (FdmsFrameReader, asyncio.StreamWriter):
+        now = time.monotonic()
+        conn = None
+        while self._idle:
+            candidate = self._idle.popleft()
+            if self._healthy(candidate, now):
+                conn = candidate
+                break
+            self.discarded += 1
+            candidate.writer.close()
+
+        if conn is None:
+            self.misses += 1
+            conn = yield from self._open()
+        else:
+            self.hits += 1
+        self._fill()
+
+        # the session forwards the greeting to its terminal
+        conn.frames.unread(GREETING)
+        self._checked_out[id(conn.writer)] = conn
+        return conn.frames, conn.writer
+
+    def owns(self, writer: asyncio.StreamWriter) -> bool:
+        return id(writer) in self._checked_out
+
+    def release(self, frames: FdmsFrameReader, writer: asyncio.StreamWriter, reusable: bool):
+        conn = self._checked_out.pop(id(writer), None)
+        if conn is not None and reusable and frames.buffered() == 0 and len(self._idle) < self.max_size \
+                and self._healthy(conn, time.monotonic()):
+            self.returned += 1
+            self._idle.append(conn)
+        else:
+            self.discarded += 1
+            writer.close()
+
+    def metrics(self) -> dict:
+        return {
+            'idle': len(self._idle),
+            'opening': self._opening,
+            'checked_out': len(self._checked_out),
+            'hits': self.hits,
+            'misses': self.misses,
+            'returned': self.returned,
+            'discarded': self.discarded,
+            'failed': self.failed,
+        }
@@ -1,7 +1,10 @@
 from enum import Enum
 from .fdms_model import *
 from .sqlite_storage import SqlFdmsStorage
+from .sql_core_storage import SqlCoreStorage
 from .leveldb_storage import LevelDbStorage
+from .fdms_cache import BatchCache, cached_storage, copy_batch
+from .fdms_auth_index import AuthorizationIndex
 from . import LOG_NAME
 import logging
 import math
@@ -53,11 +56,28 @@ class FdmsTransactionType(Enum):
     SpecificPollTransaction = '6'
 
 
+class FrameField:
+    # Parsers keep the undecoded bytes of the field in obj.raw_fields; the text is
+    # decoded on first read and then kept as a plain instance attribute
+    def __init__(self, name: str, default=''):
+        self.name = name
+        self.default = default
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        raw = obj.raw_fields.get(self.name)
+        value = self.default if raw is None else raw.decode()
+        obj.__dict__[self.name] = value
+        return value
+
+
 class FdmsTransaction:
     def __init__(self):
-        pass
+        self.raw_fields = dict()
+        ''':type: dict of [str, bytes]'''
 
-    def parse(self, data: bytes):
+    def parse(self, data: bytes, start=0, end=None):
         raise NotImplementedError('%s.parse' % self.__class__.__name__)
 
 
@@ -69,8 +89,8 @@ class FdmsResponse:
         self.item_no = '000'
         self.revision_no = '0'
 
-    def body(self) -> bytes:
-        raise NotImplementedError('%s.body' % self.__class__.__name__)
+    def write_body(self, buffer):
+        raise NotImplementedError('%s.write_body' % self.__class__.__name__)
 
     def response(self) -> bytes:
         raise NotImplementedError('%s.response' % self.__class__.__name__)
@@ -102,14 +122,17 @@ class FdmsResponse:
 
 
 class FdmsHeader:
+    protocol_type = FrameField('protocol_type')
+    terminal_id = FrameField('terminal_id')
+    merchant_number = FrameField('merchant_number')
+    device_id = FrameField('device_id')
+    wcc = FrameField('wcc')
+    txn_type = FrameField('txn_type')
+    txn_code = FrameField('txn_code', FdmsTxnCode.Close.value)
+
     def __init__(self):
-        self.protocol_type = ''
-        self.terminal_id = ''
-        self.merchant_number = ''
-        self.device_id = ''
-        self.wcc = ''
-        self.txn_type = ''
-        self.txn_code = FdmsTxnCode.Close.value
+        self.raw_fields = dict()
+        ''':type: dict of [str, bytes]'''
 
     def create_txn(self) -> FdmsTransaction:
         txn_code = FdmsTxnCode(self.txn_code)
@@ -139,56 +162,55 @@ class NegativeResponseTransaction(FdmsTransaction):
 
 
 class RevisionInquiryTransaction(FdmsTransaction):
+    item_no = FrameField('item_no')
+
     def __init__(self):
         super().__init__()
-        self.item_no = ''
         self.revisions = list()
         ''':type: list of [str]'''
 
 
 class MonetaryTransaction(FdmsTransaction):
+    invoice_no = FrameField('invoice_no')
+    batch_no = FrameField('batch_no')
+    item_no = FrameField('item_no')
+    revision_no = FrameField('revision_no')
+    format_code = FrameField('format_code')
+    transaction_id = FrameField('transaction_id')
+    card_type = FrameField('card_type')
+    pin_block = FrameField('pin_block')
+    smid_block = FrameField('smid_block')
+    authorization_code = FrameField('authorization_code')
+    partial_indicator = FrameField('partial_indicator')
+
     def __init__(self):
         super().__init__()
         self.total_amount = 0.0
-        self.invoice_no = ''
-        self.batch_no = ''
-        self.item_no = ''
-        self.revision_no = ''
-        self.format_code = ''
-        self.transaction_id = ''
-        self.card_type = ''
-        self.pin_block = ''
-        self.smid_block = ''
-        self.authorization_code = ''
-        self.partial_indicator = ''
 
 
 class SwipedMonetaryTransaction(MonetaryTransaction):
-    def __init__(self):
-        super().__init__()
-        self.track_data = ''
+    track_data = FrameField('track_data')
 
 
 class KeyedMonetaryTransaction(MonetaryTransaction):
-    def __init__(self):
-        super().__init__()
-        self.account_no = ''
-        self.cv_presence = ''
-        self.cvv = ''
-        self.exp_date = ''
+    account_no = FrameField('account_no')
+    cv_presence = FrameField('cv_presence')
+    cvv = FrameField('cvv')
+    exp_date = FrameField('exp_date')
 
 
 class BatchCloseTransaction(FdmsTransaction):
+    batch_no = FrameField('batch_no')
+    item_no = FrameField('item_no', '000')
+
     def __init__(self):
         super().__init__()
-        self.batch_no = ''
-        self.item_no = '000'
         self.credit_batch_amount = 0.0
         self.debit_batch_count = 0
         self.debit_batch_amount = 0.0
         self.offline_items = 0
-        self.batch_items = dict()
-        """:type : dict of [str, BatchRecord]"""
+        self.batch = None
+        ''':type: OpenBatch the batch as it was when the revision inquiry started'''
         self.poll_items = set()
         ''':type: set of [str]'''
         self.last_item_no = '001'
@@ -235,8 +257,78 @@ class SpecificPollResponse(FdmsResponse):
 
 
 #Storage = SqlFdmsStorage
+#Storage = SqlCoreStorage
 Storage = LevelDbStorage
 
+
+def set_batch_cache(cache: BatchCache, warm_up=False):
+    # serves open and last closed batches from `cache`; None goes back to the plain backend
+    global Storage
+    storage_class = Storage.storage_class if hasattr(Storage, 'batch_cache') else Storage
+    Storage = storage_class if cache is None else cached_storage(storage_class, cache)
+    if cache is not None and warm_up:
+        cache.warm_up(storage_class)
+
+
+AUTH_INDEX = None
+''':type: AuthorizationIndex'''
+
+
+def set_authorization_index(index: AuthorizationIndex):
+    # rejects ticket-only codes missing from `index` without a storage lookup
+    global AUTH_INDEX
+    if index is not None:
+        index.load(Storage)
+    AUTH_INDEX = index
+
+
+class UnitOfWork:
+    # A storage session shared by the transactions of a terminal session. Processing functions
+    # given a unit work in its storage session instead of opening one; their save() is left to
+    # the outermost user of the unit, which saves all of them at once. Updates that must wait for
+    # the save, such as those of the authorization index, run once the storage session is closed,
+    # which is when the data is durable. A transaction that raises marks the unit failed.
+    def __init__(self):
+        self.storage = None
+        ''':type: FdmsStorage'''
+        self.failed = False
+        self._depth = 0
+        self._saved = False
+        self._after_save = list()
+
+    def __enter__(self):
+        if self._depth == 0:
+            self.storage = Storage().__enter__()
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._depth -= 1
+        if exc_type is not None:
+            self.failed = True
+        if self._depth > 0:
+            return
+        storage, self.storage = self.storage, None
+        after_save, self._after_save = self._after_save, list()
+        storage.__exit__(exc_type, exc_val, exc_tb)
+        if self._saved and exc_type is None:
+            for callback in after_save:
+                callback()
+
+    def save(self):
+        if self._depth == 1:
+            self.storage.save()
+            self._saved = True
+
+    def after_save(self, callback):
+        self._after_save.append(callback)
+
+
+def unit_of_work(unit: UnitOfWork=None) -> UnitOfWork:
+    # the unit of the terminal session, or one for a single transaction
+    return unit if unit is not None else UnitOfWork()
+
+
 INV_BATCH_SEQ = 'INV BATCH SEQ'
 INVLD_BATCH_SEQ = 'INVLD BATCH SEQ'
 INV_TRAN_CODE = 'INV TRAN CODE'
@@ -253,15 +345,13 @@ def process_add_on_txn(main: (FdmsHeader, FdmsTransaction), add_on: (FdmsHeader,
         revision_txn = add_on[1]
         ''':type: RevisionInquiryTransaction'''
         start_item_no = int(revision_txn.item_no)
-        for i in range(len(revision_txn.revisions)):
-            item_no = '%.3d' % (start_item_no + i)
-            revision = revision_txn.revisions[i]
-            if len(revision) == 1:
-                if '0' <= revision <= '9':
-                    item = close_txn.batch_items[item_no]
-                    if item is not None:
-                        if item.revision_no < revision:
-                            close_txn.poll_items.add(item_no)
+        batch = close_txn.batch
+        stored = batch.revisions[start_item_no:start_item_no + len(revision_txn.revisions)]
+        for i, revision in enumerate(revision_txn.revisions[:len(stored)]):
+            if len(revision) == 1 and '0' <= revision <= '9':
+                item_no = start_item_no + i
+                if batch.has_item(item_no) and stored[i] < int(revision):
+                    close_txn.poll_items.add('%.3d' % item_no)
 
         start_item_no += len(revision_txn.revisions)
         close_txn.set_last_item_no(start_item_no)
@@ -269,24 +359,59 @@ def process_add_on_txn(main: (FdmsHeader, FdmsTransaction), add_on: (FdmsHeader,
         raise ValueError(INV_TRAN_CODE)
 
 
-def process_txn(transaction: (FdmsHeader, FdmsTransaction)) -> FdmsResponse:
+def process_session(online: (FdmsHeader, FdmsTransaction), add_on: (FdmsHeader, FdmsTransaction),
+                    offline: list) -> FdmsResponse:
+    # The piggy-back, add-on and online transactions of a terminal session in one unit of work,
+    # saved once before the response goes out. If one of them fails the unit is dropped and they
+    # are processed again one by one, so that only the failed one leaves nothing behind. So are
+    # they when the storage fails to open, save or close the unit, which then saved nothing.
+    rs = None
+    unit = UnitOfWork()
+    try:
+        with unit:
+            try:
+                for txn in offline:
+                    process_txn(txn, unit)
+                    if unit.failed:
+                        break
+                else:
+                    if add_on is not None:
+                        process_add_on_txn(online, add_on)
+                    rs = process_txn(online, unit)
+            finally:
+                if not unit.failed:
+                    unit.save()
+    except Exception as e:
+        logging.getLogger(LOG_NAME).debug('Unit of work error: %s', str(e))
+        unit.failed = True
+    if not unit.failed:
+        return rs
+
+    for txn in offline:
+        process_txn(txn)
+    if add_on is not None:
+        process_add_on_txn(online, add_on)
+    return process_txn(online)
+
+
+def process_txn(transaction: (FdmsHeader, FdmsTransaction), unit: UnitOfWork=None) -> FdmsResponse:
     header, body = transaction
     response = FdmsTextResponse()
     try:
         if isinstance(body, DepositInquiryTransaction):
             response = BatchResponse()
-            process_deposit_inquiry(header, response)
+            process_deposit_inquiry(header, response, unit)
         elif isinstance(body, MonetaryTransaction):
             response = CreditResponse()
             response.item_no = body.item_no
             response.batch_no = body.batch_no
             response.revision_no = body.revision_no
-            process_monetary_transaction(header, body, response)
+            process_monetary_transaction(header, body, response, unit)
         elif isinstance(body, BatchCloseTransaction):
             response = BatchResponse()
             response.batch_no = body.batch_no
             response.item_no = body.item_no
-            return process_batch_close(header, body)
+            return process_batch_close(header, body, unit)
         else:
             response.set_negative()
             response.response_text = INV_TRAN_CODE
@@ -301,7 +426,7 @@ def process_txn(transaction: (FdmsHeader, FdmsTransaction)) -> FdmsResponse:
     return response
 
 
-def process_batch_close(header: FdmsHeader, body: BatchCloseTransaction) -> FdmsResponse:
+def process_batch_close(header: FdmsHeader, body: BatchCloseTransaction, unit: UnitOfWork=None) -> FdmsResponse:
     def get_specific_poll_response() -> SpecificPollResponse:
         if len(body.poll_items) == 0:
             return None
@@ -337,49 +462,25 @@ def process_batch_close(header: FdmsHeader, body: BatchCloseTransaction) -> Fdms
         if response is not None:
             return response
 
-    with Storage() as storage:
+    with unit_of_work(unit) as unit:
+        storage = unit.storage
         batch = storage.get_open_batch(header.merchant_number, header.device_id)
         if batch is None:
             raise ValueError(INVLD_BATCH_SEQ)
 
-        body.batch_items.clear()
-        for item in storage.query_batch_items(batch.id):
-            assert isinstance(item, BatchRecord)
-            body.batch_items[item.item_no] = item
-
-        max_item_no = 0
-        credit_count = 0
-        debit_count = 0
-        credit_amount = 0.0
-        debit_amount = 0.0
-        for item in body.batch_items.values():
-            assert isinstance(item, BatchRecord)
-            txn_code = FdmsTxnCode(item.txn_code)
-            amount = 0.0
-            if txn_code not in TRANSACTION_VOID:
-                amount = item.amount
-                if txn_code == FdmsTxnCode.Return:
-                    amount = -amount
-            if item.is_credit:
-                credit_count += 1
-                credit_amount += amount
-                item_number = int(item.item_no)
-                if item_number > max_item_no:
-                    max_item_no = item_number
-            else:
-                debit_count += 1
-                debit_amount += amount
-
-        max_item_no += 1
+        # the open batch carries running totals of its records and the item presence and
+        # revisions, see OpenBatch.add_record
+        credit_count = batch.credit_count
+        debit_count = batch.debit_count
+        credit_amount = batch.credit_amount
+        debit_amount = batch.debit_amount
+        max_item_no = batch.max_item_no + 1
         rq_max_item_no = int(body.item_no)
 
         if body.state == BatchCloseState.ReadyToClose:
             body.state = BatchCloseState.HostSpecificPollTransaction
             body.poll_items.clear()
-            for i in range(1, rq_max_item_no):
-                i_no = '%.3d' % i
-                if i_no not in body.batch_items:
-                    body.poll_items.add(i_no)
+            body.poll_items.update('%.3d' % i for i in batch.missing_items(rq_max_item_no))
 
             response = get_specific_poll_response()
             if response is not None:
@@ -390,6 +491,8 @@ def process_batch_close(header: FdmsHeader, body: BatchCloseTransaction) -> Fdms
             if body.state == BatchCloseState.HostSpecificPollTransaction:
                 body.state = BatchCloseState.RevisionInquiry
                 body.last_item_no = '001'
+                # the inquiry is answered after this storage session, which may expire the batch
+                body.batch = copy_batch(batch)
 
                 body.poll_items.clear()
                 response = get_revision_inquiry_response()
@@ -405,7 +508,7 @@ def process_batch_close(header: FdmsHeader, body: BatchCloseTransaction) -> Fdms
 
         body.state = BatchCloseState.Closed
         storage.close_batch(batch, (credit_count, credit_amount), (debit_count, debit_amount))
-        storage.save()
+        unit.save()
 
         response = BatchResponse()
         response.set_positive()
@@ -424,8 +527,9 @@ def process_batch_close(header: FdmsHeader, body: BatchCloseTransaction) -> Fdms
     raise ValueError(CLOSE_UNAVAIL)
 
 
-def process_deposit_inquiry(header: FdmsHeader, response: BatchResponse):
-    with Storage() as storage:
+def process_deposit_inquiry(header: FdmsHeader, response: BatchResponse, unit: UnitOfWork=None):
+    with unit_of_work(unit) as unit:
+        storage = unit.storage
         last_batch = storage.last_closed_batch(header.merchant_number, header.device_id)
         if last_batch is None:
             last_batch = ClosedBatch()
@@ -442,7 +546,8 @@ def process_deposit_inquiry(header: FdmsHeader, response: BatchResponse):
         response.batch_id_number = '%d' % last_batch.id
 
 
-def process_monetary_transaction(header: FdmsHeader, body: MonetaryTransaction, response: CreditResponse):
+def process_monetary_transaction(header: FdmsHeader, body: MonetaryTransaction, response: CreditResponse,
+                                 unit: UnitOfWork=None):
     def calc_card_hash() -> str:
         if isinstance(body, KeyedMonetaryTransaction):
             return card_info_md5(body.account_no, body.exp_date)
@@ -467,6 +572,7 @@ def process_monetary_transaction(header: FdmsHeader, body: MonetaryTransaction,
         auth.amount = body.total_amount
         storage.put_authorization(auth)
         auth.authorization_code = str(auth.id).rjust(6, '0')
+        storage.put_authorization(auth)
         return auth
 
     response.set_negative()
@@ -500,7 +606,13 @@ def process_monetary_transaction(header: FdmsHeader, body: MonetaryTransaction,
         if not isinstance(body, SwipedMonetaryTransaction):
             raise ValueError(INV_TRAN_CODE)
 
-    with Storage() as storage:
+    if txn_code == FdmsTxnCode.TicketOnly and AUTH_INDEX is not None:
+        if not AUTH_INDEX.might_contain(header.merchant_number, body.authorization_code):
+            raise ValueError(INV_AUTH_CODE)
+
+    authorization = None
+    with unit_of_work(unit) as unit:
+        storage = unit.storage
         if txn_code == FdmsTxnCode.AuthOnly:
             authorization = authorize(False)
             response.response_text = 'APPROVED %s' % authorization.authorization_code
@@ -534,9 +646,11 @@ def process_monetary_transaction(header: FdmsHeader, body: MonetaryTransaction,
                         (txn_code == FdmsTxnCode.VoidTicketOnly and cur_code == FdmsTxnCode.TicketOnly)):
                     raise ValueError(UNMATCHED_VOID)
 
+                batch.remove_record(record)
                 record.txn_code = header.txn_code
                 record.revision_no = body.revision_no
-                storage.put_batch_record(record)
+                batch.add_record(record)
+                storage.put_batch_record(record, batch)
                 response.response_text = ''
 
             elif txn_code in {FdmsTxnCode.Sale, FdmsTxnCode.Return}:
@@ -569,24 +683,23 @@ def process_monetary_transaction(header: FdmsHeader, body: MonetaryTransaction,
                     if authorization.authorization_code != body.authorization_code:
                         raise ValueError(INV_AUTH_CODE)
                     response.response_text = ''
+                    batch.remove_record(record)
 
                 record.revision_no = body.revision_no
                 record.amount = body.total_amount
+                batch.add_record(record)
                 storage.put_authorization(authorization)
-                storage.put_batch_record(record)
+                storage.put_batch_record(record, batch)
             elif txn_code == FdmsTxnCode.TicketOnly:
                 if len(body.authorization_code) == 0:
                     raise ValueError(INV_AUTH_CODE)
                 if record is not None:
                     raise ValueError(INV_TRAN_CODE)
 
-                authorization = None
-                for a in storage.query_authorization(header.merchant_number, body.authorization_code):
-                    if not a.is_captured:
-                        authorization = a
-                        break
-                if authorization is None:
+                uncaptured = storage.query_uncaptured_authorizations(header.merchant_number, body.authorization_code)
+                if len(uncaptured) == 0:
                     raise ValueError(INV_AUTH_CODE)
+                authorization = uncaptured[0]
 
                 authorization.is_captured = True
                 record = BatchRecord()
@@ -597,11 +710,22 @@ def process_monetary_transaction(header: FdmsHeader, body: MonetaryTransaction,
                 record.is_credit = authorization.is_credit
                 record.revision_no = body.revision_no
                 record.amount = body.total_amount
+                batch.add_record(record)
                 storage.put_authorization(authorization)
-                storage.put_batch_record(record)
+                storage.put_batch_record(record, batch)
                 response.response_text = '%s %s' % ('TKT CODE', authorization.authorization_code)
             else:
                 raise ValueError(INV_TRAN_CODE)
 
-        storage.save()
+        # read before save(), which expires SQL objects
+        index = AUTH_INDEX
+        if index is not None and authorization is not None:
+            indexed = (header.merchant_number, authorization.authorization_code, authorization.id)
+            if txn_code == FdmsTxnCode.AuthOnly:
+                auth_date = authorization.date
+                unit.after_save(lambda: index.add(*indexed, date=auth_date))
+            elif txn_code == FdmsTxnCode.TicketOnly:
+                unit.after_save(lambda: index.discard(*indexed))
+        unit.save()
+
     response.set_positive()
@@ -1,6 +1,13 @@
 import asyncio
+import collections
 import functools
+import queue
 from .fdms_processor import *
+from .fdms_checksum import PARITY_TABLE, lrc, validate_frame
+from . import fdms_executor
+from . import fdms_replay
+from .fdms_timer import get_timer_wheel
+from .fdms_supervisor import merchant_shard
 from . import LOG_NAME
 
 STX = 2
@@ -13,6 +20,35 @@ FS = 28
 US = 31
 SEP = 35
 
+REQUEST_TIMEOUT = 15.0
+ACK_TIMEOUT = 4.0
+
+LOCAL_SHARD = None
+''':type: (int, int) the shard served by this process and the number of shards'''
+
+TERMINAL_TIMEOUTS = dict()
+''':type: dict of [(str, str), (float, float)]'''
+
+
+def set_terminal_timeouts(merchant_number: str, device_id: str, request_timeout=REQUEST_TIMEOUT,
+                          ack_timeout=ACK_TIMEOUT):
+    TERMINAL_TIMEOUTS[(merchant_number, device_id)] = (request_timeout, ack_timeout)
+
+
+def set_local_shard(shard: int, shards: int):
+    global LOCAL_SHARD
+    LOCAL_SHARD = (shard, shards) if shard is not None else None
+
+
+def serves_merchant(merchant_number: str) -> bool:
+    # a worker serves the merchants of its shard only, whose batches and authorizations it caches
+    return LOCAL_SHARD is None or merchant_shard(merchant_number, LOCAL_SHARD[1]) == LOCAL_SHARD[0]
+
+
+def terminal_timeouts(header) -> (float, float):
+    # the defaults apply until the terminal has identified itself in a request header
+    return TERMINAL_TIMEOUTS.get(session_key(header), (REQUEST_TIMEOUT, ACK_TIMEOUT))
+
 
 @asyncio.coroutine
 def read_fdms_packet(reader: asyncio.StreamReader) -> bytes:
@@ -39,6 +75,117 @@ def read_fdms_packet(reader: asyncio.StreamReader) -> bytes:
 
     return buffer
 
+
+def scan_frames(buffer: bytes, start=0) -> (list, int):
+    frames = []
+    pos = start
+    size = len(buffer)
+    while pos < size:
+        if buffer[pos] == STX:
+            etx = buffer.find(ETX, pos + 1)
+            if etx < 0 or etx + 1 >= size:
+                break
+            frames.append(bytes(buffer[pos:etx + 2]))
+            pos = etx + 2
+        else:
+            frames.append(bytes(buffer[pos:pos + 1]))
+            pos += 1
+
+    return frames, pos
+
+
+class FdmsFrameReader:
+    def __init__(self, reader: asyncio.StreamReader, chunk_size=4096):
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._frames = collections.deque()
+        ''':type: collections.deque of [bytes]'''
+
+    @asyncio.coroutine
+    def _fill(self) -> bool:
+        chunk = yield from self.reader.read(self.chunk_size)
+        if len(chunk) == 0:
+            return False
+
+        self._buffer.extend(chunk.translate(PARITY_TABLE))
+        frames, pos = scan_frames(self._buffer)
+        if pos > 0:
+            del self._buffer[:pos]
+        self._frames.extend(frames)
+        return True
+
+    @asyncio.coroutine
+    def read_packet(self) -> bytes:
+        while len(self._frames) == 0:
+            has_data = yield from self._fill()
+            if not has_data:
+                return bytes()
+
+        return self._frames.popleft()
+
+    @asyncio.coroutine
+    def read_packets(self) -> list:
+        while len(self._frames) == 0:
+            has_data = yield from self._fill()
+            if not has_data:
+                return []
+
+        frames = list(self._frames)
+        self._frames.clear()
+        return frames
+
+    def unread(self, frame: bytes):
+        self._frames.appendleft(frame)
+
+    def buffered(self) -> int:
+        return len(self._frames)
+
+    def at_eof(self) -> bool:
+        return len(self._frames) == 0 and self.reader.at_eof()
+
+
+def parse_request(request: bytes) -> (FdmsHeader, FdmsTransaction):
+    if not validate_frame(request):
+        raise ValueError('LRS sum')
+
+    pos, header = parse_header(request)
+    txn = header.create_txn()
+    txn.parse(request, pos, len(request) - 2)
+    return header, txn
+
+
+def session_key(header: FdmsHeader) -> tuple:
+    # transactions of one terminal must be applied in order
+    return header.merchant_number, header.device_id
+
+
+def process_session_txns(online: (FdmsHeader, FdmsTransaction), add_on: (FdmsHeader, FdmsTransaction),
+                         offline: list, digest=None) -> FdmsResponse:
+    # digest: of the request frames, see fdms_replay.request_digest()
+    cache = fdms_replay.REPLAY_CACHE
+    key = None
+    if cache is not None and digest is not None:
+        key = fdms_replay.replay_key(*online)
+        if key is not None:
+            digest = digest.digest()
+            rs = cache.get(key, digest)
+            if rs is not None:
+                return rs
+
+    rs = process_session(online, add_on, offline)
+    if key is not None:
+        cache.put(key, digest, rs)
+    return rs
+
+
+def reject_session(writer):
+    # the host is busy: end the session before it starts, the terminal retries later
+    writer.write(bytes((EOT,)))
+    if writer.can_write_eof():
+        writer.write_eof()
+
+
 @asyncio.coroutine
 def fdms_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     online = None
@@ -46,6 +193,10 @@ def fdms_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     add_on = None
     ''':type: (FdmsHeader, FdmsTransaction)'''
     offline = list()
+    digest = None
+    frames = FdmsFrameReader(reader)
+    timers = get_timer_wheel()
+    request_timeout, ack_timeout = REQUEST_TIMEOUT, ACK_TIMEOUT
 
     writer.write(bytes((ENQ,)))
     yield from writer.drain()
@@ -59,19 +210,20 @@ def fdms_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
                 if attempt > 4:
                     return
 
-                request = yield from asyncio.wait_for(read_fdms_packet(reader), timeout=15.0)
+                request = yield from timers.wait(frames.read_packet(), request_timeout)
                 if len(request) == 0:
                     return
 
                 control_byte = request[0]
                 if control_byte == STX:
-                    lrs = functools.reduce(lambda x, y: x ^ int(y), request[2:-1], int(request[1]))
-                    if lrs != request[-1]:
-                        raise ValueError('LRS sum')
-
-                    pos, header = parse_header(request)
-                    txn = header.create_txn()
-                    txn.parse(request[pos:-2])
+                    header, txn = parse_request(request)
+                    if not serves_merchant(header.merchant_number):
+                        logging.getLogger(LOG_NAME).debug('Session rejected: merchant %s of another shard',
+                                                          header.merchant_number)
+                        reject_session(writer)
+                        return
+                    digest = fdms_replay.request_digest(digest, request)
+                    request_timeout, ack_timeout = terminal_timeouts(header)
                     if header.txn_type == FdmsTransactionType.Online.value:
                         if online is None:
                             online = (header, txn)
@@ -106,15 +258,21 @@ def fdms_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
             return
 
         # Process Transactions & Send Response
-        for txn in offline:
-            rs = process_txn(txn)
+        executor = fdms_executor.TXN_EXECUTOR
+        if executor is None:
+            rs = process_session_txns(online, add_on, offline, digest)
+        else:
+            try:
+                rs = yield from executor.run_keyed(session_key(online[0]), process_session_txns,
+                                                   online, add_on, list(offline), digest)
+            except queue.Full as e:
+                # nothing was processed, the terminal sends the transactions again later
+                logging.getLogger(LOG_NAME).debug('Session rejected: %s', str(e))
+                reject_session(writer)
+                return
         offline.clear()
-
-        if add_on is not None:
-            process_add_on_txn(online, add_on)
         add_on = None
-
-        rs = process_txn(online)
+        digest = None
 
         # Send Response
         rs_bytes = rs.response()
@@ -134,10 +292,10 @@ def fdms_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
                 control_byte = 0
                 try:
                     while True:
-                        rs_head = yield from asyncio.wait_for(reader.read(1), timeout=4.0)
+                        rs_head = yield from timers.wait(frames.read_packet(), ack_timeout)
                         if len(rs_head) == 0:
                             return
-                        control_byte = rs_head[0] & 0x7f
+                        control_byte = rs_head[0]
                         if control_byte == ACK:
                             break
                         elif control_byte == NAK:
@@ -165,14 +323,353 @@ def fdms_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         writer.write_eof()
 
 
-def sep_gen(sep: int, buffer: bytes, offset=0, count=-1):
-    for i in range(offset, len(buffer)):
-        if count == 0:
+@asyncio.coroutine
+def pump_fdms_frames(frames: FdmsFrameReader, writer: asyncio.StreamWriter):
+    while True:
+        packets = yield from frames.read_packets()
+        if len(packets) == 0:
+            return
+        writer.writelines(packets)
+        yield from writer.drain()
+
+
+@asyncio.coroutine
+def pump_terminal_to_fdms(frames: FdmsFrameReader, fdms_writer: asyncio.StreamWriter):
+    yield from pump_fdms_frames(frames, fdms_writer)
+    # the terminal is gone: the backend ends its session on EOF
+    if fdms_writer.can_write_eof():
+        fdms_writer.write_eof()
+
+
+@asyncio.coroutine
+def fdms_route_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, connect, release=None):
+    # Passes a terminal session on to the FDMS engine serving its merchant, e.g. the worker owning
+    # the merchant's shard. The terminal is greeted here and its first request read for the
+    # merchant number; connect(merchant_number) opens the backend, whose greeting is dropped, the
+    # request is sent on and the frames are pumped both ways until the backend closes.
+    frames = FdmsFrameReader(reader)
+    timers = get_timer_wheel()
+    writer.write(bytes((ENQ,)))
+    yield from writer.drain()
+
+    request = None
+    header = None
+    ''':type: FdmsHeader'''
+    attempt = 0
+    while request is None:
+        if attempt > 4:
+            return
+        try:
+            packet = yield from timers.wait(frames.read_packet(), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            return
+        if len(packet) == 0 or packet[0] == EOT:
+            return
+        if packet[0] != STX:
+            continue
+        try:
+            header, _ = parse_request(packet)
+            request = packet
+        except Exception as e:
+            logging.getLogger(LOG_NAME).debug('Request error: %s', str(e))
+            attempt += 1
+            writer.write(bytes((NAK,)))
+            yield from writer.drain()
+
+    try:
+        fdms_reader, fdms_writer = yield from connect(header.merchant_number)
+    except OSError as e:
+        logging.getLogger(LOG_NAME).debug('Session rejected: %s', str(e))
+        reject_session(writer)
+        return
+    fdms_frames = fdms_reader if isinstance(fdms_reader, FdmsFrameReader) else FdmsFrameReader(fdms_reader)
+    greeting = yield from timers.wait(fdms_frames.read_packet(), REQUEST_TIMEOUT)
+    if greeting == bytes((ENQ,)):
+        fdms_writer.write(request)
+    else:
+        # turned away, e.g. by admission control: the terminal gets the answer
+        fdms_frames.unread(greeting)
+
+    upstream = asyncio.Task(pump_terminal_to_fdms(frames, fdms_writer))
+    try:
+        yield from pump_fdms_frames(fdms_frames, writer)
+    except Exception as e:
+        logging.getLogger(LOG_NAME).debug('Routed session error: %s', str(e))
+    finally:
+        upstream.cancel()
+
+    if release is not None:
+        release(fdms_frames, fdms_writer, False)
+    else:
+        fdms_writer.close()
+    if writer.can_write_eof():
+        writer.write_eof()
+
+
+class FdmsSessionState(Enum):
+    Request = 1
+    Processing = 2
+    Response = 3
+    Closed = 4
+    Queued = 5
+
+
+class FdmsProtocol(asyncio.Protocol):
+    def __init__(self, loop: asyncio.AbstractEventLoop=None, admission=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.admission = admission
+        ''':type: fdms.fdms_admission.AdmissionController'''
+        self._admission_waiter = None
+        ''':type: asyncio.Future'''
+        self.transport = None
+        ''':type: asyncio.Transport'''
+        self.state = FdmsSessionState.Closed
+        self.online = None
+        ''':type: (FdmsHeader, FdmsTransaction)'''
+        self.add_on = None
+        ''':type: (FdmsHeader, FdmsTransaction)'''
+        self.offline = list()
+        self.digest = None
+        self.attempt = 0
+        self.rs_bytes = None
+        ''':type: bytes'''
+        self._buffer = bytearray()
+        self._pending = list()
+        ''':type: list of [bytes]'''
+        self._timers = get_timer_wheel(self._loop)
+        self._timer = None
+        ''':type: fdms.fdms_timer.TimerEntry'''
+        self.request_timeout = REQUEST_TIMEOUT
+        self.ack_timeout = ACK_TIMEOUT
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        if self.admission is None:
+            self._start_request(send_enq=True)
+            return
+
+        self.state = FdmsSessionState.Queued
+        self._admission_waiter = self.admission.request()
+        if self._admission_waiter.done():
+            self._admitted(self._admission_waiter)
+        else:
+            self._admission_waiter.add_done_callback(self._admitted)
+
+    def _admitted(self, waiter: asyncio.Future):
+        if self.state != FdmsSessionState.Queued:
+            return
+        if waiter.result():
+            self._start_request(send_enq=True)
+        else:
+            self._admission_waiter = None
+            reject_session(self.transport)
+            self._close()
+
+    def connection_lost(self, exc):
+        self._cancel_timer()
+        self.state = FdmsSessionState.Closed
+        self.transport = None
+        if self._admission_waiter is not None:
+            self.admission.cancel(self._admission_waiter)
+            self._admission_waiter = None
+
+    def eof_received(self):
+        self._close()
+
+    def data_received(self, data: bytes):
+        self._buffer.extend(data.translate(PARITY_TABLE))
+        frames, pos = scan_frames(self._buffer)
+        if pos > 0:
+            del self._buffer[:pos]
+        self._frames_received(frames)
+
+    def _frames_received(self, frames: list):
+        for i, frame in enumerate(frames):
+            if self.state == FdmsSessionState.Request:
+                self._request_received(frame)
+            elif self.state == FdmsSessionState.Response:
+                self._response_received(frame)
+            elif self.state == FdmsSessionState.Processing:
+                # replayed once the transactions are processed
+                self._pending.extend(frames[i:])
+                break
+            else:
+                break
+
+    def _set_timer(self, timeout: float):
+        self._cancel_timer()
+        self._timer = self._timers.schedule(timeout, self._close)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _close(self):
+        self._cancel_timer()
+        if self.state != FdmsSessionState.Closed:
+            self.state = FdmsSessionState.Closed
+            self.transport.close()
+
+    def _finish(self):
+        self.transport.write(bytes((EOT,)))
+        if self.transport.can_write_eof():
+            self.transport.write_eof()
+        self._close()
+
+    def _start_request(self, send_enq: bool):
+        self.state = FdmsSessionState.Request
+        self.attempt = 0
+        if send_enq:
+            self.transport.write(bytes((ENQ,)))
+        self._set_timer(self.request_timeout)
+
+    def _request_received(self, request: bytes):
+        control_byte = request[0]
+        if control_byte == STX:
+            try:
+                header, txn = parse_request(request)
+            except Exception as e:
+                logging.getLogger(LOG_NAME).debug('Request error: %s', str(e))
+                self.attempt += 1
+                self.transport.write(bytes((NAK,)))
+                if self.attempt > 4:
+                    self._close()
+                else:
+                    self._set_timer(self.request_timeout)
+                return
+
+            if not serves_merchant(header.merchant_number):
+                logging.getLogger(LOG_NAME).debug('Session rejected: merchant %s of another shard',
+                                                  header.merchant_number)
+                reject_session(self.transport)
+                self._close()
+                return
+
+            self.digest = fdms_replay.request_digest(self.digest, request)
+            self.request_timeout, self.ack_timeout = terminal_timeouts(header)
+            if header.txn_type == FdmsTransactionType.Online.value:
+                if self.online is None:
+                    self.online = (header, txn)
+                else:
+                    self.add_on = (header, txn)
+            else:
+                self.offline.append((header, txn))
+
+            if header.protocol_type == '2':
+                self._process()
+                return
+
+            self.attempt = 0
+            self.transport.write(bytes((ACK,)))
+
+        elif control_byte == EOT:
+            self._process()
+            return
+
+        self._set_timer(self.request_timeout)
+
+    def _process(self):
+        self._cancel_timer()
+        if self.online is None:
+            self._close()
+            return
+
+        executor = fdms_executor.TXN_EXECUTOR
+        if executor is not None:
+            self.state = FdmsSessionState.Processing
+            try:
+                future = executor.submit_keyed(session_key(self.online[0]), process_session_txns,
+                                               self.online, self.add_on, list(self.offline), self.digest)
+            except queue.Full as e:
+                logging.getLogger(LOG_NAME).debug('Session rejected: %s', str(e))
+                reject_session(self.transport)
+                self._close()
+                return
+            except Exception as e:
+                logging.getLogger(LOG_NAME).debug('Session error: %s', str(e))
+                self._close()
+                return
+            finally:
+                self.offline.clear()
+                self.add_on = None
+                self.digest = None
+            asyncio.wrap_future(future, loop=self._loop).add_done_callback(self._processed)
+            return
+
+        try:
+            rs = process_session_txns(self.online, self.add_on, self.offline, self.digest)
+        except Exception as e:
+            logging.getLogger(LOG_NAME).debug('Session error: %s', str(e))
+            self._close()
+            return
+        finally:
+            self.offline.clear()
+            self.add_on = None
+            self.digest = None
+
+        self._respond(rs)
+
+    def _processed(self, future: asyncio.Future):
+        if self.state != FdmsSessionState.Processing:
+            return
+
+        try:
+            rs = future.result()
+        except Exception as e:
+            logging.getLogger(LOG_NAME).debug('Session error: %s', str(e))
+            self._close()
+            return
+
+        self._respond(rs)
+        pending = self._pending
+        self._pending = list()
+        self._frames_received(pending)
+
+    def _respond(self, rs: FdmsResponse):
+        self.rs_bytes = rs.response()
+        self.transport.write(self.rs_bytes)
+        if rs.action_code == FdmsActionCode.HostSpecificPoll or rs.action_code == FdmsActionCode.RevisionInquiry:
+            self._start_request(send_enq=False)
+        else:
+            self.state = FdmsSessionState.Response
+            self.attempt = 0
+            self._set_timer(self.ack_timeout)
+
+    def _response_received(self, rs_head: bytes):
+        control_byte = rs_head[0]
+        if control_byte == ACK:
+            if self.online[0].wcc in {'B', 'C'}:
+                self._start_request(send_enq=True)
+            else:
+                self._finish()
+        elif control_byte == NAK:
+            self.attempt += 1
+            if self.attempt >= 4:
+                self._close()
+            else:
+                self.transport.write(self.rs_bytes)
+                self._set_timer(self.ack_timeout)
+        else:
+            self._set_timer(self.ack_timeout)
+
+
+def sep_find(sep: int, buffer: bytes, start=0, end=None, count=-1) -> list:
+    if end is None:
+        end = len(buffer)
+    result = []
+    while count != 0:
+        pos = buffer.find(sep, start, end)
+        if pos < 0:
             break
-        if buffer[i] == sep:
-            yield i
-            if count > 0:
-                count -= 1
+        result.append(pos)
+        start = pos + 1
+        count -= 1
+    return result
+
+
+def sep_gen(sep: int, buffer: bytes, offset=0, count=-1):
+    yield from sep_find(sep, buffer, offset, None, count)
 
 
 def buf_chop(buffer: bytes, stops, start=0):
@@ -183,88 +680,107 @@ def buf_chop(buffer: bytes, stops, start=0):
     yield buffer[s_pos:].decode()
 
 
-def monetary_parse(self: MonetaryTransaction, data: bytes):
-    pos = 0
-    fs_pos = list(sep_gen(FS, data, pos, 3))
-    if len(fs_pos) != 3:
-        raise ValueError('Monetary: parse')
-    if fs_pos[2] - (fs_pos[1] + 1) != 5:
-        raise ValueError('Monetary: parse')
-    pos = fs_pos[2]+1
-
-    aux_data = data[0:fs_pos[2]]
-    fs_pos.pop()
-    fields = list(buf_chop(aux_data, fs_pos))
-    self.total_amount = float(fields[0])
-    self.invoice_no = fields[1]
-    self.batch_no = fields[2][0:1]
-    self.item_no = fields[2][1:4]
-    self.revision_no = fields[2][4:5]
-
-    fs_pos = list(sep_gen(FS, data, pos))
-    self.format_code = data[pos:fs_pos[0]].decode()
-    aux_data = bytes()
-    if self.format_code == '6':  # Retail
-        if len(fs_pos) < 15:
-            raise ValueError('Monetary: Retail: parse')
-        self.transaction_id = data[fs_pos[11]+1:fs_pos[12]].decode()
-        aux_data = data[fs_pos[14]+1:fs_pos[15]]
-    elif self.format_code == '2':  # Restaurant
-        self.transaction_id = data[fs_pos[4]+1:fs_pos[5]].decode()
-        aux_data = data[fs_pos[6]+1:fs_pos[7]]
-    elif self.format_code == '4':  # Hotel
-        self.transaction_id = data[fs_pos[7]+1:fs_pos[8]].decode()
-        aux_data = data[fs_pos[12]+1:fs_pos[13]]
-
-    if len(aux_data) > 0:
-        fields = list(buf_chop(aux_data, sep_gen(US, aux_data)))
-        if len(fields) < 7:
-            raise ValueError('Monetary: parse')
-        self.pin_block = fields[0]
-        self.card_type = fields[1]
-        # cashback - 2
-        # surcharge - 3
-        # voucher number - 4
-        self.authorization_code = fields[5]
-        self.smid_block = fields[6]
-        if len(fields) > 7:
-            self.partial_indicator = fields[7]
+# Monetary request layouts: the FS separated fields of each card entry prefix,
+# the fields common to every format and the fields each format code adds,
+# counted from the format code field. US separated sub-fields are split out
+# of the named compound fields; None marks a field the processor does not use.
+MONETARY_PREFIX_FIELDS = {
+    KeyedMonetaryTransaction: ('keyed_data', 'exp_date'),
+    SwipedMonetaryTransaction: ('track_data',),
+}
 
+MONETARY_COMMON_FIELDS = ('total_amount', 'invoice_no', 'sequence_no', 'format_code')
 
-MonetaryTransaction.parse = monetary_parse
+MONETARY_FORMAT_FIELDS = {
+    '6': ('Retail', {'transaction_id': 12, 'additional_data': 15}),
+    '2': ('Restaurant', {'transaction_id': 5, 'additional_data': 7}),
+    '4': ('Hotel', {'transaction_id': 8, 'additional_data': 13}),
+}
 
+MONETARY_SUB_FIELDS = {
+    'keyed_data': (0, ('account_no', 'cv_presence', 'cvv')),
+    'additional_data': (7, ('pin_block', 'card_type', None, None, None, 'authorization_code', 'smid_block',
+                            'partial_indicator')),
+}
 
-def swiped_parse(self: SwipedMonetaryTransaction, data: bytes):
-    fs_pos = data.index(FS, 0, 77)
-    self.track_data = data[0:fs_pos].decode()
+MAX_TRACK_DATA = 76
 
-    MonetaryTransaction.parse(self, data[fs_pos + 1:])
+_FS_BYTES = bytes((FS,))
+_US_BYTES = bytes((US,))
 
-SwipedMonetaryTransaction.parse = swiped_parse
 
+class MonetaryLayout:
+    def __init__(self, name: str, field_count: int, fields: tuple):
+        self.name = name
+        self.field_count = field_count
+        self.fields = fields
+        ''':type: tuple of [(str, int)]'''
 
-def keyed_parse(self: KeyedMonetaryTransaction, data: bytes):
-    pos = 0
-    fs_pos = list(sep_gen(FS, data, pos, 2))
-    if len(fs_pos) != 2:
-        raise ValueError('Keyed: parse')
 
-    data1 = data[pos:fs_pos[0]]
-    fields = list(buf_chop(data1, sep_gen(US, data1)))
-    if len(fields) > 2:
-        self.cvv = fields[2]
-    if len(fields) > 1:
-        self.cv_presence = fields[1]
-    if len(fields) > 0:
-        self.account_no = fields[0]
-    self.exp_date = data[fs_pos[0]+1:fs_pos[1]].decode()
+def compile_monetary_layouts() -> (dict, dict):
+    base_layouts = dict()
+    layouts = dict()
+    for txn_class, prefix in MONETARY_PREFIX_FIELDS.items():
+        common = tuple((name, i) for i, name in enumerate(prefix + MONETARY_COMMON_FIELDS))
+        format_index = len(common) - 1
+        base_layouts[txn_class] = MonetaryLayout('Monetary', len(common), common)
+        for format_code, (name, fields) in MONETARY_FORMAT_FIELDS.items():
+            format_fields = tuple((fld, format_index + i) for fld, i in sorted(fields.items(), key=lambda x: x[1]))
+            layouts[(txn_class, format_code)] = \
+                MonetaryLayout(name, format_fields[-1][1] + 1, common + format_fields)
+
+    return base_layouts, layouts
+
+_MONETARY_BASE_LAYOUTS, _MONETARY_LAYOUTS = compile_monetary_layouts()
 
-    MonetaryTransaction.parse(self, data[fs_pos[1]+1:])
 
-KeyedMonetaryTransaction.parse = keyed_parse
+def monetary_parse(self: MonetaryTransaction, data: bytes, start=0, end=None):
+    base_layout = _MONETARY_BASE_LAYOUTS.get(self.__class__)
+    if base_layout is None:
+        raise ValueError('Monetary: parse')
+
+    fields = data[start:end].split(_FS_BYTES)
+    if len(fields) < base_layout.field_count:
+        raise ValueError('Monetary: parse')
+
+    format_code = fields[base_layout.field_count - 1].decode()
+    layout = _MONETARY_LAYOUTS.get((self.__class__, format_code), base_layout)
+    if len(fields) < layout.field_count:
+        raise ValueError('Monetary: %s: parse' % layout.name)
 
+    raw_fields = self.raw_fields
+    for name, index in layout.fields:
+        raw_fields[name] = fields[index]
+    self.format_code = format_code
 
-def skip_parse(self: FdmsTransaction, data: bytes):
+    sequence_no = raw_fields.pop('sequence_no')
+    if len(sequence_no) != 5:
+        raise ValueError('Monetary: parse')
+    raw_fields['batch_no'] = sequence_no[0:1]
+    raw_fields['item_no'] = sequence_no[1:4]
+    raw_fields['revision_no'] = sequence_no[4:5]
+
+    self.total_amount = float(raw_fields.pop('total_amount'))
+
+    if len(raw_fields.get('track_data', b'')) > MAX_TRACK_DATA:
+        raise ValueError('Swiped: parse')
+
+    for name, (min_count, sub_names) in MONETARY_SUB_FIELDS.items():
+        compound = raw_fields.pop(name, None)
+        if not compound:
+            continue
+        sub_fields = compound.split(_US_BYTES)
+        if len(sub_fields) < min_count:
+            raise ValueError('Monetary: parse')
+        for sub_name, sub_field in zip(sub_names, sub_fields):
+            if sub_name is not None:
+                raw_fields[sub_name] = sub_field
+
+
+MonetaryTransaction.parse = monetary_parse
+
+
+def skip_parse(self: FdmsTransaction, data: bytes, start=0, end=None):
     pass
 
 DepositInquiryTransaction.parse = skip_parse
@@ -272,8 +788,8 @@ DepositInquiryTransaction.parse = skip_parse
 NegativeResponseTransaction.parse = skip_parse
 
 
-def batch_close_parse(self: BatchCloseTransaction, data: bytes):
-    fields = list(buf_chop(data, sep_gen(FS, data)))
+def batch_close_parse(self: BatchCloseTransaction, data: bytes, start=0, end=None):
+    fields = data[start:end].split(_FS_BYTES)
     if len(fields) < 5:
         raise ValueError('Batch Close: parse')
 
@@ -281,18 +797,18 @@ def batch_close_parse(self: BatchCloseTransaction, data: bytes):
     self.offline_items = int(fields[1])
     self.debit_batch_count = int(fields[2])
     self.debit_batch_amount = float(fields[3])
-    self.batch_no = fields[4][0:1]
-    self.item_no = fields[4][1:4]
+    self.raw_fields['batch_no'] = fields[4][0:1]
+    self.raw_fields['item_no'] = fields[4][1:4]
 
 BatchCloseTransaction.parse = batch_close_parse
 
 
-def revision_inquiry_parse(self: RevisionInquiryTransaction, data: bytes):
-    fields = list(buf_chop(data, sep_gen(FS, data)))
-    self.item_no = fields[0]
+def revision_inquiry_parse(self: RevisionInquiryTransaction, data: bytes, start=0, end=None):
+    fields = data[start:end].split(_FS_BYTES)
+    self.raw_fields['item_no'] = fields[0]
     revisions = fields[1:11]
     if len(revisions) == 10:
-        self.revisions = revisions
+        self.revisions = [revision.decode() for revision in revisions]
     else:
         self.revisions = []
         for i in range(10):
@@ -301,107 +817,120 @@ def revision_inquiry_parse(self: RevisionInquiryTransaction, data: bytes):
 RevisionInquiryTransaction.parse = revision_inquiry_parse
 
 
+RESPONSE_BUFFER_SIZE = 256
+
+
+def segment(data: bytes, start=0) -> (bytes, int):
+    return data, lrc(data, start)
+
+
+_FS_SEGMENT = segment(bytes((FS,)))
+_FS_FS_SEGMENT = segment(bytes((FS, FS)))
+_NO_AVC_FS_FS_SEGMENT = segment(b'0' + bytes((FS, FS)))
+_BAL_SEGMENT = segment(b'BAL ')
+_AMT_SEGMENT = segment(bytes((FS,)) + b'AMT ')
+_REQ_SEGMENT = segment(bytes((FS,)) + b'REQ ')
+_SIGN_SEGMENTS = (segment(b' '), segment(b'-'))
+_UNAVAILABLE_SEGMENT = segment(b'UNAVAILABLE'.rjust(16, b' ') + b' ')
+
+
+@functools.lru_cache(maxsize=4096)
+def header_segment(action_code: str, response_code: str, batch_no: str, item_no: str, revision_no: str) -> (bytes, int):
+    # STX is not part of the LRC
+    header = action_code[0:1] + response_code[0:1] + batch_no[0:1] + item_no[0:4] + revision_no[0:1]
+    return segment(bytes((STX,)) + header.encode(), 1)
+
+
+@functools.lru_cache(maxsize=1024)
+def text_field_segment(text: str, width=16) -> (bytes, int):
+    return segment(bytes((FS,)) + ('%-*.*s' % (width, width, text)).encode())
+
+
+def amount_segment(amount: float) -> (bytes, int):
+    return segment(('%16.2f' % amount).encode())
+
+
+class ResponseBuffer:
+    def __init__(self, size=RESPONSE_BUFFER_SIZE):
+        self.data = bytearray(size)
+        self.pos = 0
+        self.lrc = 0
+
+    def write(self, data: bytes, data_lrc: int):
+        end = self.pos + len(data)
+        self.data[self.pos:end] = data
+        self.pos = end
+        self.lrc ^= data_lrc
+
+    def write_bytes(self, data: bytes):
+        self.write(data, lrc(data))
+
+    def finish(self) -> bytearray:
+        self.data[self.pos:] = bytes((ETX, self.lrc ^ ETX))
+        return self.data
+
+
 def response(self: FdmsResponse) -> bytes:
-    ba = bytearray()
-    ba.append(STX)
-    ba.append(self.action_code.value.encode()[0])
-    ba.append(self.response_code.encode()[0])
-    ba.append(self.batch_no.encode()[0])
-    ba.extend(self.item_no.encode()[0:4])
-    ba.append(self.revision_no.encode()[0])
-    ba.extend(self.body())
-    ba.append(ETX)
-    ba.append(functools.reduce(lambda x, y: x ^ y, ba[2:], ba[1]))
-    return ba
+    buffer = ResponseBuffer()
+    buffer.write(*header_segment(self.action_code.value, self.response_code,
+                                 self.batch_no, self.item_no, self.revision_no))
+    self.write_body(buffer)
+    return buffer.finish()
 
 FdmsResponse.response = response
 
 
-def text_response_body(self: FdmsTextResponse) -> bytes:
-    if len(self.response_text) < 16:
-        self.response_text = self.response_text.ljust(16, ' ')
-    if len(self.response_text) > 16:
-        self.response_text = self.response_text[0:16]
-
-    ba = bytes([FS])
-    ba += self.response_text.encode()
-    return ba
+def text_response_body(self: FdmsTextResponse, buffer: ResponseBuffer):
+    buffer.write(*text_field_segment(self.response_text))
 
-FdmsTextResponse.body = text_response_body
+FdmsTextResponse.write_body = text_response_body
 
 
-def deposit_response_body(self: BatchResponse) -> bytes:
-    ba = FdmsTextResponse.body(self)
-    ba += bytes([FS])
-    ba += self.batch_id_number.encode()
+def deposit_response_body(self: BatchResponse, buffer: ResponseBuffer):
+    FdmsTextResponse.write_body(self, buffer)
+    buffer.write(*_FS_SEGMENT)
+    buffer.write_bytes(self.batch_id_number.encode())
     if self.response_text2 is not None:
         if len(self.response_text2) > 0:
-            if len(self.response_text2) < 16:
-                self.response_text2 = self.response_text2.ljust(16, ' ')
-            if len(self.response_text2) > 16:
-                self.response_text2 = self.response_text2[0:16]
-            ba += bytes([FS])
-            ba += self.response_text2.encode()
+            buffer.write(*text_field_segment(self.response_text2))
 
-    return ba
+BatchResponse.write_body = deposit_response_body
 
-BatchResponse.body = deposit_response_body
 
-
-def credit_response_body(self: CreditResponse) -> bytes:
-    ba = FdmsTextResponse.body(self)
-    if len(self.avc_rs_code) > 0:
-        ba += self.avc_rs_code.encode()
+def credit_response_body(self: CreditResponse, buffer: ResponseBuffer):
+    FdmsTextResponse.write_body(self, buffer)
+    if len(self.avc_rs_code) > 0 or len(self.cvv_rs_code) > 0:
+        buffer.write_bytes((self.avc_rs_code if len(self.avc_rs_code) > 0 else '0').encode() +
+                           self.cvv_rs_code.encode())
+        buffer.write(*_FS_FS_SEGMENT)
     else:
-        ba += b'0'
-    if len(self.cvv_rs_code) > 0:
-        ba += self.cvv_rs_code.encode()
-    ba += bytes([FS])
-    ba += bytes([FS])
+        buffer.write(*_NO_AVC_FS_FS_SEGMENT)
     if len(self.transaction_id) > 0:
-        tid = self.transaction_id.encode()
-        if len(tid) > 15:
-            tid = tid[0:15]
-        ba += tid
-    ba += bytes([FS])
-    ba += bytes([FS])  # market indicator
+        buffer.write_bytes(self.transaction_id.encode()[0:15])
+    buffer.write(*_FS_FS_SEGMENT)  # market indicator
     if self.action_code == '3':
-        ba += b'BAL '
-        if isinstance(self.balance_amount, float):
-            amt = '{0:.2f}'.format(self.balance_amount)
-        else:
-            amt = 'UNAVAILABLE'
-        amt = amt.rjust(16, ' ')
-        ba += amt.encode()
+        buffer.write(*_BAL_SEGMENT)
         if isinstance(self.balance_amount, float):
-            ba += b' ' if self.balance_amount >= 0.0 else b'-'
+            buffer.write(*amount_segment(self.balance_amount))
+            buffer.write(*_SIGN_SEGMENTS[0 if self.balance_amount >= 0.0 else 1])
         else:
-            ba += b' '
+            buffer.write(*_UNAVAILABLE_SEGMENT)
 
         if self.requested_amount > 0.005 or self.approved_amount > 0.005:
-            ba += bytes([FS])
-            ba += b'AMT '
-            amt = '{0:.2f}'.format(self.approved_amount)
-            amt = amt.rjust(16, ' ')
-            ba += amt.encode()
-            ba += bytes([FS])
-            ba += b'REQ '
-            amt = '{0:.2f}'.format(self.requested_amount)
-            amt = amt.rjust(16, ' ')
-            ba += amt.encode()
-            ba += bytes([FS])
+            buffer.write(*_AMT_SEGMENT)
+            buffer.write(*amount_segment(self.approved_amount))
+            buffer.write(*_REQ_SEGMENT)
+            buffer.write(*amount_segment(self.requested_amount))
+            buffer.write(*_FS_SEGMENT)
 
-    return ba
+CreditResponse.write_body = credit_response_body
 
-CreditResponse.body = credit_response_body
 
+def specific_poll_body(self: SpecificPollResponse, buffer: ResponseBuffer):
+    buffer.write(*_FS_SEGMENT)
+    buffer.write_bytes(self.request_type.encode())
 
-def specific_poll_body(self: SpecificPollResponse) -> bytes:
-    ba = bytes([FS])
-    ba += self.request_type.encode()
-    return ba
-
-SpecificPollResponse.body = specific_poll_body
+SpecificPollResponse.write_body = specific_poll_body
 
 
 def parse_header(data: bytes) -> (int, FdmsHeader):
@@ -409,34 +938,35 @@ def parse_header(data: bytes) -> (int, FdmsHeader):
     if data[pos] == STX:
         pos += 1
 
-    p_ch = data[pos:pos+1].decode()
-    if p_ch != '*':
+    if data[pos] != ord('*'):
         raise ValueError('Protocol flag * expected')
 
     pos += 1
-    p_type = data[pos:pos+1].decode()
-    if not p_type in ['1', '2', '3']:
+    if data[pos] not in b'123':
         raise ValueError('Protocol type is invalid')
 
+    header = FdmsHeader()
+    header.raw_fields['protocol_type'] = data[pos:pos+1]
+
     pos += 1
-    term_id = data[pos:pos+6].decode()
+    header.raw_fields['terminal_id'] = data[pos:pos+6]
 
     pos += 5
     p_sep = data.index(SEP, pos, pos + 20)
-    merch_num = data[pos:p_sep].decode()
+    header.raw_fields['merchant_number'] = data[pos:p_sep]
 
     pos = p_sep + 1
     p_sep = data.index(FS, pos, pos+5)
-    device_id = data[pos:p_sep].decode()
+    header.raw_fields['device_id'] = data[pos:p_sep]
 
     pos = p_sep + 1
-    wcc = data[pos:pos+1].decode()
+    header.raw_fields['wcc'] = data[pos:pos+1]
 
     pos += 1
-    txn_type = data[pos:pos+1].decode()
+    header.raw_fields['txn_type'] = data[pos:pos+1]
 
     pos += 1
-    txn_code = data[pos:pos+1].decode()
+    header.raw_fields['txn_code'] = data[pos:pos+1]
 
     pos += 1
     p_sep = data[pos]
@@ -444,14 +974,4 @@ def parse_header(data: bytes) -> (int, FdmsHeader):
         raise ValueError('Invalid transaction header')
 
     pos += 1
-
-    header = FdmsHeader()
-    header.protocol_type = p_type
-    header.terminal_id = term_id
-    header.merchant_number = merch_num
-    header.device_id = device_id
-    header.wcc = wcc
-    header.txn_type = txn_type
-    header.txn_code = txn_code
-
     return pos, header
@@ -0,0 +1,123 @@
+import collections
+import hashlib
+import threading
+import time
+from .fdms_processor import FdmsResponse, FdmsActionCode, MONETARY_TRANSACTIONS
+
+REPLAY_CACHE_SIZE = 4096
+REPLAY_WINDOW = 120.0
+
+_MONETARY_CODES = {code.value for code in MONETARY_TRANSACTIONS}
+# responses that end the session or the transaction; polls and revision inquiries are part of a batch close
+_REPLAYED_ACTIONS = {FdmsActionCode.RegularResponse, FdmsActionCode.PartialApproval}
+
+REPLAY_CACHE = None
+''':type: ReplayCache'''
+
+
+def set_replay_cache(cache):
+    global REPLAY_CACHE
+    REPLAY_CACHE = cache
+
+
+def request_digest(digest, request: bytes):
+    # folds a request frame into the digest of the session's transactions; None while replay is off
+    if REPLAY_CACHE is None:
+        return None
+    if digest is None:
+        digest = hashlib.sha1()
+    digest.update(request)
+    return digest
+
+
+def replay_key(header, txn) -> tuple:
+    # only monetary transactions have a batch item to key on; None for the others
+    if header.txn_code not in _MONETARY_CODES:
+        return None
+    return header.merchant_number, header.device_id, txn.batch_no, txn.item_no, txn.revision_no
+
+
+class ReplayedResponse(FdmsResponse):
+    # the response bytes of the original transaction, sent again as they were
+    def __init__(self, action_code: FdmsActionCode, data: bytes):
+        super().__init__()
+        self.action_code = action_code
+        self.data = data
+
+    def response(self) -> bytes:
+        return self.data
+
+
+class ReplayCache:
+    # The responses to recent monetary transactions, keyed by merchant/device/batch/item/revision.
+    # A terminal that resends after a NAK, a lost ACK or a response timeout sends the same frames
+    # again; if their digest matches the one stored with the key within `window` seconds, the
+    # original response is returned without processing the transactions a second time. A different
+    # digest under the same key is a new request and is processed as usual.
+    def __init__(self, max_size=REPLAY_CACHE_SIZE, window=REPLAY_WINDOW):
+        self.max_size = max_size
+        self.window = window
+        self._entries = collections.OrderedDict()
+        ''':type: collections.OrderedDict[tuple, (bytes, FdmsActionCode, bytes, float)]'''
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conflicts = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now: float):
+        # entries are ordered by the time they were stored
+        while len(self._entries) > 0:
+            key, entry = next(iter(self._entries.items()))
+            if entry[3] > now:
+                break
+            del self._entries[key]
+
+    def get(self, key: tuple, digest: bytes, now: float=None) -> ReplayedResponse:
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != digest:
+                self.conflicts += 1
+                return None
+            self.hits += 1
+            return ReplayedResponse(entry[1], entry[2])
+
+    def put(self, key: tuple, digest: bytes, rs: FdmsResponse, now: float=None):
+        # only approvals: a declined transaction saved nothing and is declined again, while an
+        # ERROR may be a passing storage failure the terminal should not get back on its retry
+        if rs.action_code not in _REPLAYED_ACTIONS or rs.response_code != '0':
+            return
+        data = bytes(rs.response())
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (digest, rs.action_code, data, now + self.window)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses + self.conflicts
+            return {
+                'max_size': self.max_size,
+                'window': self.window,
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'conflicts': self.conflicts,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'evictions': self.evictions,
+            }
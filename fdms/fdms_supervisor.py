@@ -0,0 +1,149 @@
+import asyncio
+import errno
+import logging
+import os
+import select
+import signal
+import time
+import zlib
+from . import LOG_NAME
+
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 10.0
+RESTART_DELAY = 1.0
+
+
+def merchant_shard(merchant_number: str, shards: int) -> int:
+    # crc32 rather than hash(): string hashing is randomised per process
+    return zlib.crc32(merchant_number.strip().encode()) % shards
+
+
+def shard_path(path: str, shard: int) -> str:
+    return '%s.%d' % (path, shard)
+
+
+def start_heartbeat(loop: asyncio.AbstractEventLoop, fd: int, interval=HEARTBEAT_INTERVAL):
+    # beats come from the event loop, so a blocked loop is reported as unhealthy
+    def beat():
+        try:
+            os.write(fd, b'.')
+        except OSError:
+            loop.stop()
+            return
+        loop.call_later(interval, beat)
+
+    beat()
+
+
+class WorkerProcess:
+    def __init__(self, index: int):
+        self.index = index
+        self.pid = 0
+        self.fd = -1
+        self.last_beat = 0.0
+        self.started = 0
+        self.restarts = 0
+
+
+class FdmsSupervisor:
+    # Forks one worker per shard and keeps them alive. worker_main(index, heartbeat_fd) runs in the
+    # child and must not return while the worker is healthy; a worker that exits or misses heartbeats
+    # for heartbeat_timeout seconds is killed and started again.
+    def __init__(self, workers: int, worker_main, heartbeat_timeout=HEARTBEAT_TIMEOUT):
+        self.worker_main = worker_main
+        self.heartbeat_timeout = heartbeat_timeout
+        self.workers = [WorkerProcess(i) for i in range(workers)]
+        self._stopping = False
+
+    def _spawn(self, worker: WorkerProcess):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            for other in self.workers:
+                if other.fd >= 0:
+                    os.close(other.fd)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 1
+            try:
+                self.worker_main(worker.index, w)
+                code = 0
+            except BaseException:
+                logging.getLogger(LOG_NAME).exception('Worker %d failed', worker.index)
+            finally:
+                os._exit(code)
+
+        os.close(w)
+        worker.pid = pid
+        worker.fd = r
+        worker.started = worker.last_beat = time.monotonic()
+        logging.getLogger(LOG_NAME).info('Worker %d started: pid %d', worker.index, pid)
+
+    def _reap(self, worker: WorkerProcess, kill: bool):
+        if worker.fd >= 0:
+            os.close(worker.fd)
+            worker.fd = -1
+        if worker.pid:
+            if kill:
+                try:
+                    os.kill(worker.pid, signal.SIGKILL)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        raise
+            os.waitpid(worker.pid, 0)
+            worker.pid = 0
+
+    def _restart(self, worker: WorkerProcess, reason: str):
+        logging.getLogger(LOG_NAME).warning('Worker %d %s: restarting', worker.index, reason)
+        self._reap(worker, kill=True)
+        worker.restarts += 1
+        if time.monotonic() - worker.started < RESTART_DELAY:
+            time.sleep(RESTART_DELAY)
+        self._spawn(worker)
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def check(self):
+        by_fd = {worker.fd: worker for worker in self.workers if worker.fd >= 0}
+        try:
+            readable, _, _ = select.select(list(by_fd), [], [], HEARTBEAT_INTERVAL)
+        except InterruptedError:
+            return
+
+        now = time.monotonic()
+        for fd in readable:
+            worker = by_fd[fd]
+            if os.read(fd, 4096):
+                worker.last_beat = now
+            else:
+                self._restart(worker, 'exited')
+
+        for worker in self.workers:
+            if now - worker.last_beat > self.heartbeat_timeout:
+                self._restart(worker, 'missed heartbeats')
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for worker in self.workers:
+            self._spawn(worker)
+
+        try:
+            while not self._stopping:
+                self.check()
+        finally:
+            for worker in self.workers:
+                if worker.pid:
+                    try:
+                        os.kill(worker.pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+            for worker in self.workers:
+                self._reap(worker, kill=False)
+
+    def status(self) -> list:
+        now = time.monotonic()
+        return [{'index': worker.index, 'pid': worker.pid, 'restarts': worker.restarts,
+                 'heartbeat_age': now - worker.last_beat} for worker in self.workers]
@@ -0,0 +1,114 @@
+import asyncio
+import math
+import weakref
+
+TIMER_RESOLUTION = 0.25
+TIMER_SLOTS = 512
+
+try:
+    _current_task = asyncio.current_task
+except AttributeError:
+    _current_task = asyncio.Task.current_task
+
+
+class TimerEntry:
+    __slots__ = ('wheel', 'deadline', 'callback', 'args', 'cancelled', 'fired')
+
+    def __init__(self, wheel, deadline: int, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.fired = False
+
+    def cancel(self):
+        if not self.cancelled and not self.fired:
+            self.cancelled = True
+            self.wheel._remove(self)
+
+
+class TimerWheel:
+    # Hashed timer wheel shared by all sessions of a loop. Deadlines are rounded up to the next
+    # tick, so a timer never fires early and at most `resolution` late. The wheel keeps a single
+    # loop timer and only ticks while it holds entries; schedule and cancel are O(1).
+    def __init__(self, resolution=TIMER_RESOLUTION, slots=TIMER_SLOTS, loop=None):
+        self.resolution = resolution
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self._slots = [set() for _ in range(slots)]
+        self._tick = 0
+        self._next_time = 0.0
+        self._handle = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay: float, callback, *args) -> TimerEntry:
+        now = self.loop.time()
+        if self._handle is None:
+            self._next_time = now + self.resolution
+            self._handle = self.loop.call_at(self._next_time, self._run_tick)
+        ticks = max(1, int(math.ceil((now + delay - self._next_time) / self.resolution)) + 1)
+        entry = TimerEntry(self, self._tick + ticks, callback, args)
+        self._slots[entry.deadline % len(self._slots)].add(entry)
+        self._count += 1
+        return entry
+
+    def _remove(self, entry: TimerEntry):
+        self._slots[entry.deadline % len(self._slots)].discard(entry)
+        self._count -= 1
+        if self._count == 0 and self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _run_tick(self):
+        self._handle = None
+        self._tick += 1
+        slot = self._slots[self._tick % len(self._slots)]
+        due = [entry for entry in slot if entry.deadline <= self._tick]
+        for entry in due:
+            slot.discard(entry)
+        self._count -= len(due)
+
+        if self._count > 0:
+            self._next_time += self.resolution
+            self._handle = self.loop.call_at(self._next_time, self._run_tick)
+
+        for entry in due:
+            entry.fired = True
+            try:
+                entry.callback(*entry.args)
+            except Exception as e:
+                self.loop.call_exception_handler({'message': 'Timer callback failed', 'exception': e})
+
+    @asyncio.coroutine
+    def wait(self, coro, timeout: float):
+        # like asyncio.wait_for, but the coroutine runs in the calling task: on expiry the task
+        # is cancelled and the cancellation is turned into asyncio.TimeoutError
+        task = _current_task(loop=self.loop)
+        entry = self.schedule(timeout, task.cancel)
+        try:
+            result = yield from coro
+        except asyncio.CancelledError:
+            if not entry.fired:
+                raise
+            if hasattr(task, 'uncancel'):
+                task.uncancel()
+            raise asyncio.TimeoutError()
+        finally:
+            entry.cancel()
+        return result
+
+
+_wheels = weakref.WeakKeyDictionary()
+
+
+def get_timer_wheel(loop=None) -> TimerWheel:
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = TimerWheel(loop=loop)
+        _wheels[loop] = wheel
+    return wheel
@@ -1,13 +1,17 @@
 from .fdms_model import *
+from .fdms_group_commit import GroupCommit
 from enum import Enum
 import leveldb
+import base64
 import json
+import threading
 
 Authorization.JsonFields = ['id', 'merchant_number', 'authorization_code', 'is_credit', 'is_captured', 'card_hash',
-                            'date:dt', 'amount']
-OpenBatch.JsonFields = ['id', 'merchant_number', 'device_id', 'batch_no', 'date_open']
-ClosedBatch.JsonFields = OpenBatch.JsonFields + \
-                         ['date_closed', 'credit_count', 'debit_count', 'credit_amount', 'debit_amount']
+                            'date:dt', 'amount', 'is_expired']
+_BatchJsonFields = ['id', 'merchant_number', 'device_id', 'batch_no', 'date_open', 'credit_count', 'debit_count',
+                    'credit_amount', 'debit_amount', 'max_item_no']
+OpenBatch.JsonFields = _BatchJsonFields + ['item_bitmap:b64', 'revisions:b64']
+ClosedBatch.JsonFields = _BatchJsonFields + ['date_closed']
 BatchRecord.JsonFields = ['id', 'batch_id', 'auth_id', 'item_no', 'revision_no', 'txn_code', 'is_credit', 'amount']
 
 ClassMap = {clazz.__name__: clazz for clazz in (Authorization, OpenBatch, ClosedBatch, BatchRecord)}
@@ -21,10 +25,15 @@ class CustomEncoder(json.JSONEncoder):
             for fld in fields:
                 assert isinstance(fld, str)
                 pos = fld.find(':')
+                type = None
                 if pos > 0:
+                    type = fld[pos + 1:]
                     fld = fld[0:pos]
                 if hasattr(obj, fld):
-                    d[fld] = getattr(obj, fld)
+                    value = getattr(obj, fld)
+                    if type == 'b64' and isinstance(value, bytes):
+                        value = base64.b64encode(value).decode()
+                    d[fld] = value
             return d
         elif isinstance(obj, datetime.datetime):
             return obj.timestamp()
@@ -60,6 +69,8 @@ class CustomDecoder(json.JSONDecoder):
                 if type is not None:
                     if type == 'dt' and isinstance(value, float):
                         value = datetime.datetime.fromtimestamp(value)
+                    elif type == 'b64' and isinstance(value, str):
+                        value = base64.b64decode(value)
                 if hasattr(obj, fld):
                     setattr(obj, fld, value)
 
@@ -73,25 +84,222 @@ class IndexPrefix(Enum):
     ClosedBatch = b'3'
     BatchRecord = b'4'
     AuthorizationCode = b'5'
-
-
-_db = leveldb.DB()
-_db.open('level.db')
+    UncapturedAuthorization = b'6'
+    SchemaVersion = b'7'
+
+
+DATABASE_PATH = 'level.db'
+
+
+def set_database_path(path):
+    # the database at path is opened on next use, after closing the one in use
+    global DATABASE_PATH, _db
+    with _db_lock:
+        DATABASE_PATH = path
+        if _db is not None:
+            _db.close()
+            _db = None
+
+
+_db = None
+_db_lock = threading.Lock()
+_sequence_lock = threading.Lock()
+
+
+def _open_db():
+    # opened on first use, so a supervisor can pick the path and fork before LevelDB locks it
+    global _db
+    with _db_lock:
+        if _db is None:
+            db = leveldb.DB()
+            db.open(DATABASE_PATH)
+            _migrate(db)
+            _db = db
+    return _db
+
+
+def _db_items(db, key_prefix: bytes) -> list:
+    # (key, value) stored under key_prefix, in key order
+    result = []
+    with db.iterator() as iterator:
+        iterator.seek(key_prefix)
+        while iterator.valid():
+            key = iterator.key()
+            if not key.startswith(key_prefix):
+                break
+            result.append((key, iterator.value()))
+            iterator.next()
+    return result
+
+
+def _index_uncaptured_authorizations(db) -> dict:
+    # authorizations stored before the uncaptured index have no entry in it; those stored before
+    # their code was saved have none, and get the one authorize() answered with
+    writes = dict()
+    for key, value in _db_items(db, IndexPrefix.Authorization.value + b'\x00'):
+        authorization = json.loads(value.decode(), cls=CustomDecoder)
+        if not authorization.authorization_code:
+            authorization.authorization_code = str(authorization.id).rjust(6, '0')
+            value = json.dumps(authorization, cls=CustomEncoder).encode()
+            writes[key] = value
+            writes[LevelDbStorage._code_key(authorization)] = b''
+        if not authorization.is_captured and not authorization.is_expired:
+            writes[LevelDbStorage._uncaptured_key(authorization)] = value
+    return writes
+
+
+def _rebuild_open_batches(db) -> dict:
+    # open batches stored before they kept their totals and arrays decode with empty ones
+    writes = dict()
+    for key, value in _db_items(db, IndexPrefix.OpenBatch.value + b'\x00'):
+        batch = json.loads(value.decode(), cls=CustomDecoder)
+        record_prefix = b'\x00'.join((IndexPrefix.BatchRecord.value, LevelDbStorage._id_to_bytes(batch.id)))
+        batch.rebuild([json.loads(record.decode(), cls=CustomDecoder) for _, record in _db_items(db, record_prefix)])
+        writes[key] = json.dumps(batch, cls=CustomEncoder).encode()
+    return writes
+
+
+# the writes bringing a database from version N to N + 1 are MIGRATIONS[N](db)
+MIGRATIONS = [_index_uncaptured_authorizations, _rebuild_open_batches]
+
+
+def _migrate(db) -> int:
+    # brings the database to the version of this code, one synchronous write batch per version
+    version_key = IndexPrefix.SchemaVersion.value
+    value = db.get(version_key)
+    version = int(value.decode()) if value is not None else 0
+    options = leveldb.WriteOptions()
+    options.set_sync(True)
+    for migration in MIGRATIONS[version:]:
+        writes = migration(db)
+        version += 1
+        with leveldb.Batch() as write_batch:
+            for key, value in writes.items():
+                write_batch.put(key, value)
+            write_batch.put(version_key, str(version).encode())
+            db.write(write_batch, options)
+    return version
+
+
+class LevelDbGroupCommit(GroupCommit):
+    # the writes of a group go to LevelDB in one synchronous write batch
+    def __init__(self, max_delay):
+        super().__init__(max_delay)
+        self._options = leveldb.WriteOptions()
+        self._options.set_sync(True)
+
+    def _flush(self, items: list):
+        with leveldb.Batch() as write_batch:
+            for writes in items:
+                for key, value in writes.items():
+                    if value is None:
+                        write_batch.delete(key)
+                    else:
+                        write_batch.put(key, value)
+            db = _db if _db is not None else _open_db()
+            db.write(write_batch, self._options)
+
+
+GROUP_COMMIT = None
+''':type: LevelDbGroupCommit'''
+
+
+def set_group_commit(max_delay):
+    # seconds a commit may wait for concurrent sessions to join it, None writes straight through
+    global GROUP_COMMIT
+    GROUP_COMMIT = LevelDbGroupCommit(max_delay) if max_delay is not None else None
 
 
 class LevelDbStorage(FdmsStorage):
+    # In a session, writes are kept until save(), which applies them in one write batch, so the
+    # session is saved atomically and writes it does not save are dropped. With group commit the
+    # saved writes go to the group once the session exits. Used outside a session, it writes through.
     def __init__(self):
         super().__init__()
-        self._db = _db
+        self._db = _db if _db is not None else _open_db()
+        self._writes = None
+        ''':type: dict[bytes, bytes] writes not saved yet, None deletes a key'''
+        self._saved_writes = None
+        ''':type: dict[bytes, bytes] writes saved for the group commit'''
+        self._group_commit = None
+        ''':type: LevelDbGroupCommit'''
 
     def __enter__(self):
+        self._writes = dict()
+        self._saved_writes = dict()
+        self._group_commit = GROUP_COMMIT
+        if self._group_commit is not None:
+            self._group_commit.begin()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        saved = self._saved_writes
+        group_commit = self._group_commit
+        self._writes, self._saved_writes, self._group_commit = None, None, None
+        if group_commit is None:
+            return
+        if saved is not None and len(saved) > 0:
+            group_commit.commit(saved)
+        else:
+            group_commit.end()
 
     def save(self):
-        pass
+        if self._writes is None:
+            return
+        writes, self._writes = self._writes, dict()
+        if self._group_commit is not None:
+            self._saved_writes.update(writes)
+        else:
+            self._apply(writes)
+
+    def _get(self, key: bytes) -> bytes:
+        # reads see the pending writes of the session, as do scans
+        if self._writes is not None:
+            if key in self._writes:
+                return self._writes[key]
+            if key in self._saved_writes:
+                return self._saved_writes[key]
+        return self._db.get(key)
+
+    def _pending(self, key_prefix: bytes) -> dict:
+        # the pending writes of the session under key_prefix
+        if self._writes is None:
+            return dict()
+        result = {key: value for key, value in self._saved_writes.items() if key.startswith(key_prefix)}
+        result.update((key, value) for key, value in self._writes.items() if key.startswith(key_prefix))
+        return result
+
+    def _scan(self, key_prefix: bytes) -> list:
+        # (key, value) under key_prefix in key order, with the pending writes of the session
+        result = _db_items(self._db, key_prefix)
+        pending = self._pending(key_prefix)
+        if len(pending) > 0:
+            merged = dict(result)
+            merged.update(pending)
+            result = sorted((key, value) for key, value in merged.items() if value is not None)
+        return result
+
+    def _write(self, writes: dict):
+        if self._writes is not None:
+            self._writes.update(writes)
+        else:
+            self._apply(writes)
+
+    def _apply(self, writes: dict):
+        if len(writes) == 1:
+            for key, value in writes.items():
+                if value is None:
+                    self._db.delete(key)
+                else:
+                    self._db.put(key, value)
+        elif len(writes) > 1:
+            with leveldb.Batch() as write_batch:
+                for key, value in writes.items():
+                    if value is None:
+                        write_batch.delete(key)
+                    else:
+                        write_batch.put(key, value)
+                self._db.write(write_batch)
 
     @staticmethod
     def _id_to_bytes(id: int) -> bytes:
@@ -103,19 +311,32 @@ class LevelDbStorage(FdmsStorage):
 
     def _next_sequence(self, entity: IndexPrefix) -> int:
         key = b'\x00'.join((IndexPrefix.Sequence.value, entity.value))
-        seq = self._db.get(key)
-        result = 0
-        if seq is not None:
-            result = self._bytes_to_id(seq)
-        result += 1
-        self._db.put(key, self._id_to_bytes(result))
+        with _sequence_lock:
+            seq = self._db.get(key)
+            result = 0
+            if seq is not None:
+                result = self._bytes_to_id(seq)
+            result += 1
+            self._db.put(key, self._id_to_bytes(result))
         return result
 
     def last_closed_batch(self, merchant_number: str, device_id: str) -> ClosedBatch:
-        key_prefix = b'\x00'.join((IndexPrefix.ClosedBatch.value, merchant_number.encode(), device_id.encode(), b'\xff'))
+        key_prefix = b'\x00'.join((IndexPrefix.ClosedBatch.value, merchant_number.encode(), device_id.encode(), b''))
+        if len(self._pending(key_prefix)) > 0:
+            # closed in this session
+            items = self._scan(key_prefix)
+            if len(items) == 0:
+                return None
+            obj = json.loads(items[-1][1].decode(), cls=CustomDecoder)
+            assert isinstance(obj, ClosedBatch)
+            return obj
         with self._db.iterator() as iterator:
-            iterator.seek(key_prefix)
-            iterator.prev()
+            # the last key of the terminal sorts right before the prefix followed by \xff
+            iterator.seek(key_prefix + b'\xff')
+            if iterator.valid():
+                iterator.prev()
+            else:
+                iterator.seek_to_last()
             if iterator.valid():
                 key = iterator.key()
                 if key.startswith(key_prefix):
@@ -127,13 +348,22 @@ class LevelDbStorage(FdmsStorage):
 
     def get_open_batch(self, merchant_number, device_id) -> OpenBatch:
         key = b'\x00'.join((IndexPrefix.OpenBatch.value, merchant_number.encode(), device_id.encode()))
-        value = self._db.get(key)
+        value = self._get(key)
         if value is not None:
             obj = json.loads(value.decode(), cls=CustomDecoder)
             assert isinstance(obj, OpenBatch)
             return obj
         return None
 
+    def query_open_batches(self) -> list:
+        key_prefix = IndexPrefix.OpenBatch.value + b'\x00'
+        result = []
+        for _, value in self._scan(key_prefix):
+            obj = json.loads(value.decode(), cls=CustomDecoder)
+            assert isinstance(obj, OpenBatch)
+            result.append(obj)
+        return result
+
     def create_batch(self, merchant_number, device_id, batch_no) -> OpenBatch:
         batch = OpenBatch()
         batch.id = self._next_sequence(IndexPrefix.OpenBatch)
@@ -142,11 +372,12 @@ class LevelDbStorage(FdmsStorage):
         batch.batch_no = batch_no
         key = b'\x00'.join((IndexPrefix.OpenBatch.value, merchant_number.encode(), device_id.encode()))
         value = json.dumps(batch, cls=CustomEncoder)
-        self._db.put(key, value.encode())
+        self._write({key: value.encode()})
+        return batch
 
     def get_batch_record(self, batch_id: int, item_no: str) -> BatchRecord:
         key = b'\x00'.join((IndexPrefix.BatchRecord.value, self._id_to_bytes(batch_id), item_no.encode()))
-        value = self._db.get(key)
+        value = self._get(key)
         if value is not None:
             obj = json.loads(value.decode(), cls=CustomDecoder)
             assert isinstance(obj, BatchRecord)
@@ -156,65 +387,92 @@ class LevelDbStorage(FdmsStorage):
     def query_batch_items(self, batch_id: int) -> list:
         key_prefix = b'\x00'.join((IndexPrefix.BatchRecord.value, self._id_to_bytes(batch_id)))
         result = []
-        with self._db.iterator() as iterator:
-            iterator.seek(key_prefix)
-            while iterator.valid():
-                key = iterator.key()
-                if key.startswith(key_prefix):
-                    value = iterator.value()
-                    obj = json.loads(value.decode(), cls=CustomDecoder)
-                    assert isinstance(obj, BatchRecord)
-                    result.append(obj)
-                    iterator.next()
-                else:
-                    break
-
+        for _, value in self._scan(key_prefix):
+            obj = json.loads(value.decode(), cls=CustomDecoder)
+            assert isinstance(obj, BatchRecord)
+            result.append(obj)
         return result
 
-    def put_batch_record(self, batch_record: BatchRecord):
+    def put_batch_record(self, batch_record: BatchRecord, batch: OpenBatch=None):
         if batch_record.id is None:
             batch_record.id = self._next_sequence(IndexPrefix.BatchRecord)
         key = b'\x00'.join((IndexPrefix.BatchRecord.value, self._id_to_bytes(batch_record.batch_id),
-                            self._id_to_bytes(batch_record.id)))
-        value = json.dumps(batch_record, cls=CustomEncoder)
-        self._db.put(key, value.encode())
+                            batch_record.item_no.encode()))
+        writes = {key: json.dumps(batch_record, cls=CustomEncoder).encode()}
+        if batch is not None:
+            batch_key = b'\x00'.join((IndexPrefix.OpenBatch.value, batch.merchant_number.encode(),
+                                      batch.device_id.encode()))
+            writes[batch_key] = json.dumps(batch, cls=CustomEncoder).encode()
+        self._write(writes)
 
     def query_authorization(self, merchant_number, authorization_code) -> list:
         index_key = b'\x00'.join((IndexPrefix.AuthorizationCode.value, merchant_number.encode(),
                                   authorization_code.encode(), b''))
         result = []
-        with self._db.iterator() as iterator:
-            iterator.seek(index_key)
-            while iterator.valid():
-                key = iterator.key()
-                if not key.startswith(index_key):
-                    break
-                id = key[len(index_key):]
-                auth_key = b'\x00'.join((IndexPrefix.Authorization.value, id))
-                value = self._db.get(auth_key)
-                obj = json.loads(value.decode(), cls=CustomDecoder)
-                assert isinstance(obj, Authorization)
-                result.append(obj)
+        for key, _ in self._scan(index_key):
+            id = key[len(index_key):]
+            auth_key = b'\x00'.join((IndexPrefix.Authorization.value, id))
+            value = self._get(auth_key)
+            obj = json.loads(value.decode(), cls=CustomDecoder)
+            assert isinstance(obj, Authorization)
+            result.append(obj)
         return result
 
     def get_authorization(self, rec_id) -> Authorization:
         key = b'\x00'.join((IndexPrefix.Authorization.value, self._id_to_bytes(rec_id)))
-        value = self._db.get(key)
+        value = self._get(key)
         if value is not None:
             obj = json.loads(value.decode(), cls=CustomDecoder)
             assert isinstance(obj, Authorization)
             return obj
         return None
 
+    @staticmethod
+    def _code_key(authorization: Authorization) -> bytes:
+        return b'\x00'.join((IndexPrefix.AuthorizationCode.value, authorization.merchant_number.encode(),
+                             authorization.authorization_code.encode(),
+                             LevelDbStorage._id_to_bytes(authorization.id)))
+
+    @staticmethod
+    def _uncaptured_key(authorization: Authorization) -> bytes:
+        return b'\x00'.join((IndexPrefix.UncapturedAuthorization.value, authorization.merchant_number.encode(),
+                             authorization.authorization_code.encode(),
+                             LevelDbStorage._id_to_bytes(authorization.id)))
+
     def put_authorization(self, authorization: Authorization):
         if authorization.id is None:
             authorization.id = self._next_sequence(IndexPrefix.Authorization)
         key = b'\x00'.join((IndexPrefix.Authorization.value, self._id_to_bytes(authorization.id)))
-        value = json.dumps(authorization, cls=CustomEncoder)
-        self._db.put(key, value.encode())
-        index_key = b'\x00'.join((IndexPrefix.AuthorizationCode.value, authorization.merchant_number.encode(),
-                                  authorization.authorization_code.encode(), self._id_to_bytes(authorization.id)))
-        self._db.put(index_key, b'')
+        value = json.dumps(authorization, cls=CustomEncoder).encode()
+        writes = {key: value}
+        if authorization.authorization_code:
+            writes[self._code_key(authorization)] = b''
+            # uncaptured authorizations are indexed with their value, so a ticket-only reads one key
+            uncaptured = not authorization.is_captured and not authorization.is_expired
+            writes[self._uncaptured_key(authorization)] = value if uncaptured else None
+        self._write(writes)
+
+    def _scan_uncaptured(self, key_prefix: bytes) -> list:
+        result = []
+        for _, value in self._scan(key_prefix):
+            obj = json.loads(value.decode(), cls=CustomDecoder)
+            assert isinstance(obj, Authorization)
+            result.append(obj)
+        return result
+
+    def query_uncaptured_authorizations(self, merchant_number=None, authorization_code=None) -> list:
+        if merchant_number is None:
+            return self._scan_uncaptured(IndexPrefix.UncapturedAuthorization.value + b'\x00')
+        return self._scan_uncaptured(b'\x00'.join((IndexPrefix.UncapturedAuthorization.value,
+                                                   merchant_number.encode(), authorization_code.encode(), b'')))
+
+    def expire_authorizations(self, before: datetime.datetime) -> int:
+        expired = [auth for auth in self.query_uncaptured_authorizations() if auth.date < before]
+        for auth in expired:
+            # the record stays, put_authorization drops it from the uncaptured index
+            auth.is_expired = True
+            self.put_authorization(auth)
+        return len(expired)
 
     def close_batch(self, batch: OpenBatch, credit: (int, float), debit: (int, float)) -> ClosedBatch:
         closed_batch = ClosedBatch()
@@ -225,10 +483,10 @@ class LevelDbStorage(FdmsStorage):
         closed_batch.debit_amount = debit[1]
         key = b'\x00'.join((IndexPrefix.ClosedBatch.value, closed_batch.merchant_number.encode(),
                             closed_batch.device_id.encode(), self._id_to_bytes(closed_batch.id)))
-        value = json.dumps(closed_batch, cls=CustomEncoder)
-        self._db.put(key, value.encode())
-        key = b'\x00'.join((IndexPrefix.OpenBatch.value, batch.merchant_number.encode(), batch.device_id.encode()))
-        self._db.delete(key)
+        open_key = b'\x00'.join((IndexPrefix.OpenBatch.value, batch.merchant_number.encode(),
+                                 batch.device_id.encode()))
+        self._write({key: json.dumps(closed_batch, cls=CustomEncoder).encode(), open_key: None})
+        return closed_batch
 
 
 
@@ -1,23 +1,71 @@
 import struct
 from .fdms_protocol import *
+from .fdms_checksum import strip_parity
 from . import LOG_NAME
 import logging
 
+SITE_NET_HEADER = struct.Struct('!H2s')
+SITE_NET_FDMS_TYPE = b'22'
+SITE_NET_PROTOCOL_ERROR = '201 SERVER PROTOCOL ERROR'.encode()
+
+
 @asyncio.coroutine
 def read_site_net_packet(reader: asyncio.StreamReader) -> (str, bytes):
-    h = yield from reader.read(4)
-    packet_length = h[0] * 256 + h[1]
-    packet_type = h[2:4].decode()
-    packet = yield from reader.read(packet_length)
-    return packet_type, packet
+    h = yield from reader.readexactly(SITE_NET_HEADER.size)
+    packet_length, packet_type = SITE_NET_HEADER.unpack(h)
+    packet = yield from reader.readexactly(packet_length)
+    return packet_type.decode(), packet
+
+
+@asyncio.coroutine
+def pump_site_net_to_fdms(reader: asyncio.StreamReader, client_info):
+    logger = logging.getLogger(LOG_NAME)
+    fdms_writer = client_info.fdms_writer
+    while True:
+        try:
+            frame_type, request = yield from read_site_net_packet(reader)
+        except asyncio.IncompleteReadError:
+            return
+        if frame_type == '22':
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('SiteNET to FDMS: %s', strip_parity(request))
+            client_info.fdms_requests += 1
+            fdms_writer.write(request)
+            yield from fdms_writer.drain()
+
 
 @asyncio.coroutine
-def site_net_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, connect_task: asyncio.Task):
+def pump_fdms_to_site_net(fdms_frames: FdmsFrameReader, writer: asyncio.StreamWriter):
+    logger = logging.getLogger(LOG_NAME)
+    pack = SITE_NET_HEADER.pack
+    while True:
+        responses = yield from fdms_frames.read_packets()
+        if len(responses) == 0:
+            return
+        chunks = []
+        for response in responses:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('FDMS to SiteNET: %s', response)
+            chunks.append(pack(len(response), SITE_NET_FDMS_TYPE))
+            chunks.append(response)
+        writer.writelines(chunks)
+        yield from writer.drain()
+
+
+def reject_site_net_session(writer: asyncio.StreamWriter):
+    writer.write(SITE_NET_HEADER.pack(len(SITE_NET_PROTOCOL_ERROR), b'02'))
+    writer.write(SITE_NET_PROTOCOL_ERROR)
+
+
+@asyncio.coroutine
+def site_net_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, connect_task, release=None):
     client_info = SiteNetClientInfo()
-    frame_type, data = yield from read_site_net_packet(reader)
-    if frame_type == '01':
-        info_record = data.decode()
-        fields = info_record.split(',')
+    try:
+        frame_type, data = yield from read_site_net_packet(reader)
+    except asyncio.IncompleteReadError:
+        return
+    fields = data.decode(errors='replace').split(',') if frame_type == '01' else []
+    if len(fields) >= 4:
         client_info.customer_id = fields[0]
         client_info.merchant_no = fields[1]
         client_info.message_format = fields[2]
@@ -25,57 +73,37 @@ def site_net_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
         if len(fields) > 4:
             client_info.driver_version = fields[4]
 
+        if callable(connect_task):
+            # routed on the merchant number, e.g. to the worker owning the merchant's shard
+            connect_task = connect_task(client_info)
         client_info.fdms_reader, client_info.fdms_writer = yield from connect_task
     else:
-        err_rs = '201 SERVER PROTOCOL ERROR'.encode()
-        writer.write(struct.pack('!H', len(err_rs)))
-        writer.write('02'.encode())
-        writer.write(err_rs)
+        reject_site_net_session(writer)
         yield from writer.drain()
         return
 
-    outer_task = None
-    inner_task = None
-    while True:
-        if outer_task is None:
-            outer_task = asyncio.Task(read_site_net_packet(reader))
-        if inner_task is None:
-            inner_task = asyncio.Task(read_fdms_packet(client_info.fdms_reader))
-        tasks = (outer_task, inner_task)
-        yield from asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-
-        if outer_task.done():
-            try:
-                frame_type, request = outer_task.result()
-                if frame_type == '22':
-                    logging.getLogger(LOG_NAME).debug('SiteNET to FDMS: %s', bytes((b & 0x7f for b in request)))
-                    client_info.fdms_writer.write(request)
-                    yield from client_info.fdms_writer.drain()
-            except asyncio.CancelledError:
-                pass
-            except Exception as e:
-                break
-            outer_task = None
-
-        if inner_task.done():
-            try:
-                response = inner_task.result()
-                logging.getLogger(LOG_NAME).debug('FDMS to SiteNET: %s', response)
-                writer.write(struct.pack('!H', len(response)))
-                writer.write('22'.encode())
-                writer.write(response)
-                yield from writer.drain()
-            except asyncio.CancelledError:
-                pass
-            except Exception:
-                break
-            inner_task = None
-
-    if outer_task is not None:
-        outer_task.cancel()
-    if inner_task is not None:
-        inner_task.cancel()
+    fdms_frames = client_info.fdms_reader
+    if not isinstance(fdms_frames, FdmsFrameReader):
+        fdms_frames = FdmsFrameReader(fdms_frames)
+
+    # one long-lived pump per direction; the session ends when either side closes
+    pumps = (asyncio.Task(pump_site_net_to_fdms(reader, client_info)),
+             asyncio.Task(pump_fdms_to_site_net(fdms_frames, writer)))
+    try:
+        yield from asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for pump in pumps:
+            pump.cancel()
 
+    for pump in pumps:
+        if pump.done() and not pump.cancelled() and pump.exception() is not None:
+            logging.getLogger(LOG_NAME).debug('SiteNET session error: %s', str(pump.exception()))
+
+    if release is not None:
+        # a backend that has not seen a request is still waiting for one and can serve another client
+        release(fdms_frames, client_info.fdms_writer, client_info.fdms_requests == 0)
+    else:
+        client_info.fdms_writer.close()
     if writer.can_write_eof():
         writer.write_eof()
 
@@ -89,6 +117,7 @@ class SiteNetClientInfo:
         self.transaction_type = ''
         self.driver_version = ''
         self.fdms_reader = None
-        ''':type: asyncio.StreamReader'''
+        ''':type: asyncio.StreamReader | FdmsFrameReader'''
         self.fdms_writer = None
         ''':type: asyncio.StreamWriter'''
+        self.fdms_requests = 0
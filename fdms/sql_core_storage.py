@@ -0,0 +1,303 @@
+from sqlalchemy import select, bindparam, and_, desc
+from sqlalchemy.engine import Connection, Transaction
+
+from .fdms_model import *
+from . import sqlite_storage
+from .sqlite_storage import authorization_table, open_batch_table, closed_batch_table, batch_record_table
+import threading
+
+
+# Rows of the SQL tables. They have the attributes and methods of the model classes, in the
+# order of the table columns, without the ORM instrumentation of the mapped model classes.
+
+class AuthorizationRow:
+    __slots__ = ('id', 'merchant_number', 'authorization_code', 'card_hash', 'is_credit', 'is_captured', 'date',
+                 'amount', 'is_expired')
+    __repr__ = Authorization.__repr__
+
+
+class OpenBatchRow:
+    __slots__ = ('id', 'merchant_number', 'device_id', 'batch_no', 'date_open', 'credit_count', 'debit_count',
+                 'credit_amount', 'debit_amount', 'max_item_no', 'item_bitmap', 'revisions')
+    add_record = OpenBatch.add_record
+    remove_record = OpenBatch.remove_record
+    missing_items = OpenBatch.missing_items
+    has_item = OpenBatch.has_item
+    __repr__ = OpenBatch.__repr__
+
+
+class ClosedBatchRow:
+    __slots__ = ('id', 'merchant_number', 'device_id', 'batch_no', 'date_open', 'date_closed', 'credit_count',
+                 'debit_count', 'credit_amount', 'debit_amount')
+    max_item_no = 0  # not stored with a closed batch
+    __repr__ = ClosedBatch.__repr__
+
+
+class BatchRecordRow:
+    __slots__ = ('id', 'batch_id', 'auth_id', 'item_no', 'revision_no', 'txn_code', 'is_credit', 'amount')
+    batch_amount = BatchRecord.batch_amount
+    __repr__ = BatchRecord.__repr__
+
+
+class CoreTable:
+    # the compiled statements of a table and the conversion between its rows and objects
+    def __init__(self, table, row_class, dialect):
+        self.name = table.name
+        self.row_class = row_class
+        self.columns = tuple(column.name for column in table.columns)
+        keys = self.columns[1:]
+        self.insert = table.insert().compile(dialect=dialect, column_keys=keys)
+        self.insert_with_id = table.insert().compile(dialect=dialect, column_keys=self.columns)
+        self.update = table.update().where(table.c.Id == bindparam('_id')).compile(dialect=dialect, column_keys=keys)
+        self.delete = table.delete().where(table.c.Id == bindparam('_id')).compile(dialect=dialect)
+        self.select_by_id = select([table]).where(table.c.Id == bindparam('_id')).compile(dialect=dialect)
+
+    def params(self, obj) -> dict:
+        # obj: a row or a model object
+        return {column: getattr(obj, name) for column, name in zip(self.columns, self.row_class.__slots__)}
+
+    def row(self, values):
+        if values is None:
+            return None
+        obj = self.row_class.__new__(self.row_class)
+        for name, value in zip(self.row_class.__slots__, values):
+            setattr(obj, name, value)
+        return obj
+
+    def rows(self, result) -> list:
+        return [self.row(values) for values in result]
+
+
+class CoreStatements:
+    def __init__(self, dialect):
+        def compile(statement):
+            return statement.compile(dialect=dialect)
+
+        self.authorization = CoreTable(authorization_table, AuthorizationRow, dialect)
+        self.open_batch = CoreTable(open_batch_table, OpenBatchRow, dialect)
+        self.closed_batch = CoreTable(closed_batch_table, ClosedBatchRow, dialect)
+        self.batch_record = CoreTable(batch_record_table, BatchRecordRow, dialect)
+
+        c = closed_batch_table.c
+        self.last_closed_batch = compile(select([closed_batch_table]).
+                                         where(and_(c.MerchantNumber == bindparam('merchant_number'),
+                                                    c.DeviceId == bindparam('device_id'))).
+                                         order_by(desc(c.DateClosed)).limit(1))
+        c = open_batch_table.c
+        self.get_open_batch = compile(select([open_batch_table]).
+                                      where(and_(c.MerchantNumber == bindparam('merchant_number'),
+                                                 c.DeviceId == bindparam('device_id'))))
+        self.query_open_batches = compile(select([open_batch_table]))
+        c = batch_record_table.c
+        self.get_batch_record = compile(select([batch_record_table]).
+                                        where(and_(c.BatchId == bindparam('batch_id'),
+                                                   c.ItemNumber == bindparam('item_no'))))
+        self.query_batch_items = compile(select([batch_record_table]).where(c.BatchId == bindparam('batch_id')))
+        c = authorization_table.c
+        self.query_authorization = compile(select([authorization_table]).
+                                           where(and_(c.MerchantNumber == bindparam('merchant_number'),
+                                                      c.AuthorizationCode == bindparam('authorization_code'))))
+        self.query_uncaptured = compile(select([authorization_table]).
+                                        where(and_(c.IsCaptured == False, c.IsExpired == False)))
+        self.query_uncaptured_code = compile(select([authorization_table]).
+                                             where(and_(c.IsCaptured == False, c.IsExpired == False,
+                                                        c.MerchantNumber == bindparam('merchant_number'),
+                                                        c.AuthorizationCode == bindparam('authorization_code'))))
+        self.expire_authorizations = compile(authorization_table.update().
+                                             where(and_(c.IsCaptured == False, c.IsExpired == False,
+                                                        c.Date < bindparam('before'))).
+                                             values(IsExpired=True))
+
+
+_engine_lock = threading.Lock()
+
+
+class SqlCoreStorage(FdmsStorage):
+    # SqlFdmsStorage without the ORM: the statements are compiled once, rows are returned as
+    # the __slots__ classes above, and updates of existing rows are kept, one per row, until the
+    # session reads their table or saves, and then run with executemany. Inserts run at once,
+    # since their ids are needed right away.
+    engine = None
+    statements = None
+    ''':type: CoreStatements'''
+
+    def __init__(self):
+        super().__init__()
+        self.connection = None
+        ''':type: Connection'''
+        self._transaction = None
+        ''':type: Transaction'''
+        self._group_commit = None
+        ''':type: sqlite_storage.SqlGroupCommit'''
+        self._updates = dict()
+        ''':type: dict[CoreTable, dict[int, dict]]'''
+
+        if SqlCoreStorage.engine is None:
+            with _engine_lock:
+                if SqlCoreStorage.engine is None:
+                    engine = sqlite_storage.open_engine(echo=False)
+                    SqlCoreStorage.statements = CoreStatements(engine.dialect)
+                    SqlCoreStorage.engine = engine
+
+    def __enter__(self):
+        self._group_commit = sqlite_storage.GROUP_COMMIT
+        if self._group_commit is None:
+            self.connection = SqlCoreStorage.engine.connect()
+            self._transaction = self.connection.begin()
+            return self
+
+        # a savepoint of the group's transaction, see SqlFdmsStorage
+        self._group_commit.begin()
+        try:
+            self._transaction = self._group_commit.acquire(SqlCoreStorage.engine)
+        except Exception:
+            self._group_commit.end()
+            raise
+        self.connection = self._transaction.connection
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        transaction, self._transaction = self._transaction, None
+        connection, self.connection = self.connection, None
+        group_commit, self._group_commit = self._group_commit, None
+        self._updates.clear()
+        if group_commit is None:
+            try:
+                if transaction.is_active:
+                    transaction.rollback()
+            finally:
+                connection.close()
+            return
+
+        try:
+            if transaction.is_active:
+                transaction.rollback()
+        finally:
+            group, leader = group_commit.release()
+        group_commit.wait(group, leader)
+
+    def save(self):
+        self._flush()
+        self._transaction.commit()
+        if self._group_commit is None:
+            self._transaction = self.connection.begin()
+        else:
+            self._transaction = self.connection.begin_nested()
+
+    def _flush(self, table: CoreTable=None):
+        # runs the kept updates, of one table or of all
+        tables = [table] if table is not None else list(self._updates)
+        for table in tables:
+            updates = self._updates.pop(table, None)
+            if updates:
+                self.connection.execute(table.update, list(updates.values()))
+
+    def _put(self, table: CoreTable, obj):
+        if obj.id is None:
+            result = self.connection.execute(table.insert, table.params(obj))
+            obj.id = result.lastrowid
+        else:
+            params = table.params(obj)
+            params['_id'] = obj.id
+            self._updates.setdefault(table, dict())[obj.id] = params
+
+    def last_closed_batch(self, merchant_number: str, device_id: str) -> ClosedBatch:
+        statements = SqlCoreStorage.statements
+        result = self.connection.execute(statements.last_closed_batch,
+                                         {'merchant_number': merchant_number, 'device_id': device_id})
+        return statements.closed_batch.row(result.fetchone())
+
+    def get_open_batch(self, merchant_number, device_id) -> OpenBatch:
+        statements = SqlCoreStorage.statements
+        self._flush(statements.open_batch)
+        result = self.connection.execute(statements.get_open_batch,
+                                         {'merchant_number': merchant_number, 'device_id': device_id})
+        return statements.open_batch.row(result.fetchone())
+
+    def query_open_batches(self) -> list:
+        statements = SqlCoreStorage.statements
+        self._flush(statements.open_batch)
+        return statements.open_batch.rows(self.connection.execute(statements.query_open_batches))
+
+    def create_batch(self, merchant_number, device_id, batch_no) -> OpenBatch:
+        batch = OpenBatchRow()
+        batch.id = None
+        batch.merchant_number = merchant_number
+        batch.device_id = device_id
+        batch.batch_no = batch_no
+        batch.date_open = datetime.datetime.now()
+        batch.credit_count = 0
+        batch.debit_count = 0
+        batch.credit_amount = 0.0
+        batch.debit_amount = 0.0
+        batch.max_item_no = 0
+        batch.item_bitmap = bytes(ITEM_SLOTS // 8)
+        batch.revisions = bytes(ITEM_SLOTS)
+        self._put(SqlCoreStorage.statements.open_batch, batch)
+        return batch
+
+    def get_batch_record(self, batch_id: int, item_no: str) -> BatchRecord:
+        statements = SqlCoreStorage.statements
+        self._flush(statements.batch_record)
+        result = self.connection.execute(statements.get_batch_record, {'batch_id': batch_id, 'item_no': item_no})
+        return statements.batch_record.row(result.fetchone())
+
+    def query_batch_items(self, batch_id: int) -> list:
+        statements = SqlCoreStorage.statements
+        self._flush(statements.batch_record)
+        return statements.batch_record.rows(self.connection.execute(statements.query_batch_items,
+                                                                    {'batch_id': batch_id}))
+
+    def put_batch_record(self, batch_record: BatchRecord, batch: OpenBatch=None):
+        statements = SqlCoreStorage.statements
+        self._put(statements.batch_record, batch_record)
+        if batch is not None:
+            self._put(statements.open_batch, batch)
+
+    def get_authorization(self, rec_id) -> Authorization:
+        table = SqlCoreStorage.statements.authorization
+        self._flush(table)
+        return table.row(self.connection.execute(table.select_by_id, {'_id': rec_id}).fetchone())
+
+    def put_authorization(self, authorization: Authorization):
+        self._put(SqlCoreStorage.statements.authorization, authorization)
+
+    def query_authorization(self, merchant_number: str, authorization_code: str) -> list:
+        statements = SqlCoreStorage.statements
+        self._flush(statements.authorization)
+        result = self.connection.execute(statements.query_authorization,
+                                         {'merchant_number': merchant_number,
+                                          'authorization_code': authorization_code})
+        return statements.authorization.rows(result)
+
+    def query_uncaptured_authorizations(self, merchant_number=None, authorization_code=None) -> list:
+        statements = SqlCoreStorage.statements
+        self._flush(statements.authorization)
+        if merchant_number is None:
+            result = self.connection.execute(statements.query_uncaptured)
+        else:
+            result = self.connection.execute(statements.query_uncaptured_code,
+                                             {'merchant_number': merchant_number,
+                                              'authorization_code': authorization_code})
+        return statements.authorization.rows(result)
+
+    def expire_authorizations(self, before: datetime.datetime) -> int:
+        statements = SqlCoreStorage.statements
+        self._flush(statements.authorization)
+        return self.connection.execute(statements.expire_authorizations, {'before': before}).rowcount
+
+    def close_batch(self, batch: OpenBatch, credit: (int, float), debit: (int, float)) -> ClosedBatch:
+        statements = SqlCoreStorage.statements
+        closed_batch = ClosedBatchRow()
+        closed_batch.id = batch.id
+        closed_batch.merchant_number = batch.merchant_number
+        closed_batch.device_id = batch.device_id
+        closed_batch.batch_no = batch.batch_no
+        closed_batch.date_open = batch.date_open
+        closed_batch.date_closed = datetime.datetime.now()
+        closed_batch.credit_count, closed_batch.credit_amount = credit
+        closed_batch.debit_count, closed_batch.debit_amount = debit
+        self._updates.get(statements.open_batch, dict()).pop(batch.id, None)
+        self.connection.execute(statements.open_batch.delete, {'_id': batch.id})
+        self.connection.execute(statements.closed_batch.insert_with_id, statements.closed_batch.params(closed_batch))
+        return closed_batch
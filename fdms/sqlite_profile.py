@@ -0,0 +1,182 @@
+import logging
+import sqlite3
+import threading
+from sqlalchemy import MetaData, event, inspect
+from sqlalchemy.engine import Engine
+from . import LOG_NAME
+
+WAL_CHECKPOINT_INTERVAL = 1.0
+WAL_TRUNCATE_PAGES = 16384  # 64 MB of 4 KB pages
+
+
+class SchemaError(Exception):
+    pass
+
+
+class SqliteProfile:
+    # The pragmas set on every connection of an engine, and the statement cache of pysqlite.
+    # None leaves a setting at the SQLite default. A profile with a checkpoint_interval turns
+    # the automatic checkpoints off, so no commit runs one, and leaves them to a WalCheckpointer.
+    def __init__(self, name: str, journal_mode=None, synchronous=None, mmap_size=None, cache_size=None,
+                 cached_statements=None, checkpoint_interval=None):
+        self.name = name
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size  # in pages, or in KB when negative
+        self.cached_statements = cached_statements
+        self.checkpoint_interval = checkpoint_interval
+
+    def __repr__(self):
+        return 'SqliteProfile(%s)' % self.name
+
+    def pragmas(self) -> list:
+        result = []
+        if self.journal_mode is not None:
+            result.append('PRAGMA journal_mode=%s' % self.journal_mode)
+        if self.synchronous is not None:
+            result.append('PRAGMA synchronous=%s' % self.synchronous)
+        if self.mmap_size is not None:
+            result.append('PRAGMA mmap_size=%d' % self.mmap_size)
+        if self.cache_size is not None:
+            result.append('PRAGMA cache_size=%d' % self.cache_size)
+        if self.checkpoint_interval is not None:
+            result.append('PRAGMA wal_autocheckpoint=0')
+        return result
+
+    def connect_args(self) -> dict:
+        return {'cached_statements': self.cached_statements} if self.cached_statements is not None else {}
+
+    def apply(self, engine: Engine):
+        # before the engine opens its first connection
+        pragmas = self.pragmas()
+        if len(pragmas) == 0:
+            return
+
+        def connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                for pragma in pragmas:
+                    cursor.execute(pragma)
+            finally:
+                cursor.close()
+
+        event.listen(engine, 'connect', connect)
+
+
+PROFILES = {
+    # SQLite as it comes: a rollback journal, synced on every commit
+    'default': SqliteProfile('default'),
+    # WAL keeps readers off the writer, every commit is still synced
+    'durable': SqliteProfile('durable', journal_mode='WAL', synchronous='FULL', cache_size=-16384,
+                             cached_statements=256, checkpoint_interval=WAL_CHECKPOINT_INTERVAL),
+    # WAL synced at checkpoints only: a power loss may undo the last commits, a crash cannot
+    'fast': SqliteProfile('fast', journal_mode='WAL', synchronous='NORMAL', mmap_size=256 * 2**20,
+                          cache_size=-65536, cached_statements=256, checkpoint_interval=WAL_CHECKPOINT_INTERVAL),
+}
+
+
+def database_path(engine: Engine) -> str:
+    # the file of a sqlite engine, None for an in-memory database
+    path = engine.url.database
+    return path if path not in (None, '', ':memory:') else None
+
+
+class WalCheckpointer:
+    # Checkpoints the WAL of a database file from a thread and a connection of its own, every
+    # `interval` seconds. Checkpoints are PASSIVE, so they never wait for the sessions and copy
+    # what no reader still needs; once the WAL has grown over truncate_pages, a TRUNCATE
+    # checkpoint waits for the writer and resets it.
+    def __init__(self, path: str, interval=WAL_CHECKPOINT_INTERVAL, truncate_pages=WAL_TRUNCATE_PAGES):
+        self.path = path
+        self.interval = interval
+        self.truncate_pages = truncate_pages
+        self._connection = None
+        ''':type: sqlite3.Connection'''
+        self._stopped = threading.Event()
+        self._thread = None
+        ''':type: threading.Thread'''
+        self.checkpoints = 0
+        self.truncated = 0
+        self.pages = 0
+        self.busy = 0
+        self.errors = 0
+
+    def checkpoint(self) -> int:
+        # returns the pages still in the WAL
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        busy, log, checkpointed = self._connection.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        self.checkpoints += 1
+        self.pages += max(checkpointed, 0)
+        if log > self.truncate_pages:
+            busy, _, _ = self._connection.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+            if busy == 0:
+                # the rest of the WAL was copied and the file emptied
+                self.truncated += 1
+                self.pages += log - checkpointed
+                log = checkpointed = 0
+        if busy != 0:
+            self.busy += 1
+        return max(log, 0) - max(checkpointed, 0)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.checkpoint()
+            except Exception as e:
+                self.errors += 1
+                logging.getLogger(LOG_NAME).debug('WAL checkpoint error: %s', str(e))
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='wal-checkpointer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def metrics(self) -> dict:
+        return {
+            'checkpoints': self.checkpoints,
+            'truncated': self.truncated,
+            'pages': self.pages,
+            'busy': self.busy,
+            'errors': self.errors,
+        }
+
+
+def verify_schema(engine: Engine, metadata: MetaData) -> bool:
+    # Creates the tables of a new database and returns True. An existing database must have
+    # every table and column of `metadata`, or SchemaError lists what is missing; missing
+    # indexes are created, since that cannot change the data.
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    if len(existing & set(metadata.tables)) == 0:
+        metadata.create_all(engine)
+        return True
+
+    missing = []
+    indexes = []
+    for name, table in metadata.tables.items():
+        if name not in existing:
+            missing.append('table %s' % name)
+            continue
+        columns = set(column['name'] for column in inspector.get_columns(name))
+        missing.extend('column %s.%s' % (name, column.name) for column in table.columns
+                       if column.name not in columns)
+        index_names = set(index['name'] for index in inspector.get_indexes(name))
+        indexes.extend(index for index in table.indexes if index.name not in index_names)
+    if len(missing) > 0:
+        raise SchemaError('Database schema does not match: missing %s' % ', '.join(missing))
+
+    for index in indexes:
+        logging.getLogger(LOG_NAME).info('Creating index %s', index.name)
+        index.create(engine)
+    return False
@@ -1,8 +1,13 @@
-from sqlalchemy import MetaData, Table, Column, Index, Integer, String, Boolean, DateTime, Float, desc
-from sqlalchemy import create_engine
+from sqlalchemy import MetaData, Table, Column, Index, Integer, String, Boolean, DateTime, Float, LargeBinary, desc
+from sqlalchemy import create_engine, event, inspect, select, func, and_
+from sqlalchemy.engine import Connection, Transaction
 from sqlalchemy.orm import mapper, sessionmaker, Session
+from sqlalchemy.pool import StaticPool
 
 from .fdms_model import *
+from .fdms_group_commit import GroupCommit, CommitGroup
+from .sqlite_profile import SqliteProfile, WalCheckpointer, PROFILES, database_path, verify_schema
+import threading
 
 DATABASE_NAME = 'sqlite:///:memory:'
 
@@ -10,6 +15,34 @@ def set_database_name(name):
     global DATABASE_NAME
     DATABASE_NAME = name
 
+
+GROUP_COMMIT = None
+''':type: SqlGroupCommit'''
+
+
+def set_group_commit(max_delay):
+    # seconds a commit may wait for concurrent sessions to join it, None commits every session
+    # on its own; set before the first session, like the database name
+    global GROUP_COMMIT
+    GROUP_COMMIT = SqlGroupCommit(max_delay) if max_delay is not None else None
+
+
+PROFILE = PROFILES['default']
+''':type: SqliteProfile'''
+
+CHECKPOINTER = None
+''':type: WalCheckpointer'''
+
+
+def set_profile(profile):
+    # a SqliteProfile or the name of one in PROFILES; set before the first session, like the
+    # database name
+    global PROFILE, CHECKPOINTER
+    PROFILE = PROFILES[profile] if isinstance(profile, str) else profile
+    if CHECKPOINTER is not None:
+        CHECKPOINTER.stop()
+        CHECKPOINTER = None
+
 fdms_metadata = MetaData()
 
 authorization_table = Table('Authorization', fdms_metadata,
@@ -21,9 +54,14 @@ authorization_table = Table('Authorization', fdms_metadata,
                             Column('IsCaptured', Boolean, nullable=False, default=True),
                             Column('Date', DateTime, nullable=False),
                             Column('Amount', Float, nullable=False, default=0.0),
+                            Column('IsExpired', Boolean, nullable=False, default=False),
                             Index('Authorization_Number_Idx', 'MerchantNumber', 'AuthorizationCode', unique=False),
                             sqlite_autoincrement=True)
 
+# only auth-only authorizations still waiting for their ticket-only
+Index('Authorization_Uncaptured_Idx', authorization_table.c.MerchantNumber, authorization_table.c.AuthorizationCode,
+      sqlite_where=and_(authorization_table.c.IsCaptured == False, authorization_table.c.IsExpired == False))
+
 mapper(Authorization, authorization_table, properties={
     'id': authorization_table.columns.Id,
     'merchant_number': authorization_table.columns.MerchantNumber,
@@ -33,6 +71,7 @@ mapper(Authorization, authorization_table, properties={
     'is_captured': authorization_table.columns.IsCaptured,
     'date': authorization_table.columns.Date,
     'amount': authorization_table.columns.Amount,
+    'is_expired': authorization_table.columns.IsExpired,
 })
 
 open_batch_table = Table('OpenBatch', fdms_metadata,
@@ -41,6 +80,13 @@ open_batch_table = Table('OpenBatch', fdms_metadata,
                          Column('DeviceId', String(4), nullable=False),
                          Column('BatchNumber', String(8), nullable=False),
                          Column('DateOpen', DateTime, nullable=False),
+                         Column('CreditCount', Integer, nullable=False, default=0),
+                         Column('DebitCount', Integer, nullable=False, default=0),
+                         Column('CreditAmount', Float, nullable=False, default=0.0),
+                         Column('DebitAmount', Float, nullable=False, default=0.0),
+                         Column('MaxItemNumber', Integer, nullable=False, default=0),
+                         Column('ItemBitmap', LargeBinary, nullable=False),
+                         Column('Revisions', LargeBinary, nullable=False),
                          Index('OpenBatch_Number_Idx', 'MerchantNumber', 'DeviceId', unique=True),
                          sqlite_autoincrement=True)
 
@@ -49,7 +95,14 @@ mapper(OpenBatch, open_batch_table, properties={
     'merchant_number': open_batch_table.columns.MerchantNumber,
     'device_id': open_batch_table.columns.DeviceId,
     'batch_no': open_batch_table.columns.BatchNumber,
-    'date_open': open_batch_table.columns.DateOpen
+    'date_open': open_batch_table.columns.DateOpen,
+    'credit_count': open_batch_table.columns.CreditCount,
+    'debit_count': open_batch_table.columns.DebitCount,
+    'credit_amount': open_batch_table.columns.CreditAmount,
+    'debit_amount': open_batch_table.columns.DebitAmount,
+    'max_item_no': open_batch_table.columns.MaxItemNumber,
+    'item_bitmap': open_batch_table.columns.ItemBitmap,
+    'revisions': open_batch_table.columns.Revisions,
 })
 
 closed_batch_table = Table('ClosedBatch', fdms_metadata,
@@ -105,6 +158,164 @@ mapper(BatchRecord, batch_record_table, properties={
 })
 
 _SqlSession = sessionmaker()
+_engine_lock = threading.Lock()
+
+
+def _begin_explicitly(dbapi_connection, connection_record):
+    # pysqlite defers BEGIN to the first write, which breaks savepoints; SQLAlchemy emits it instead
+    dbapi_connection.isolation_level = None
+
+
+class SqlGroupCommit(GroupCommit):
+    # All sessions share one connection and take turns on it, each in a savepoint of the
+    # transaction of the current group, which the group leader commits. A session joins its group
+    # before it hands the connection on, and the leader closes the group and commits while it has
+    # the connection, so every session in a transaction is in the group that commits it.
+    # SQLite has a single writer anyway, so the sessions run one at a time: a thread holds the
+    # connection from acquire() to release(), and one that opens a second session meanwhile would
+    # wait for itself, so acquire() raises instead.
+    def __init__(self, max_delay):
+        super().__init__(max_delay)
+        self.connection = None
+        ''':type: Connection'''
+        self._transaction = None
+        ''':type: Transaction'''
+        self._lock = threading.Lock()
+        self._owner = None
+
+    def create_engine(self, name: str, echo=True, connect_args=None):
+        connect_args = dict(connect_args if connect_args is not None else {}, check_same_thread=False)
+        engine = create_engine(name, echo=echo, poolclass=StaticPool, connect_args=connect_args)
+        event.listen(engine, 'connect', _begin_explicitly)
+        event.listen(engine, 'begin', lambda conn: conn.execute('BEGIN'))
+        return engine
+
+    def acquire(self, engine) -> Transaction:
+        # waits for the connection, returns the savepoint of the session
+        if self._owner == threading.get_ident():
+            raise RuntimeError('Nested storage session: the connection is held by this thread')
+        self._lock.acquire()
+        self._owner = threading.get_ident()
+        try:
+            if self.connection is None:
+                self.connection = engine.connect()
+            if self._transaction is None:
+                self._transaction = self.connection.begin()
+            return self.connection.begin_nested()
+        except Exception:
+            self._owner = None
+            self._lock.release()
+            raise
+
+    def release(self) -> (CommitGroup, bool):
+        # hands the connection on, see GroupCommit.wait()
+        try:
+            return self.join(None)
+        finally:
+            self._owner = None
+            self._lock.release()
+
+    def _commit_group(self, group: CommitGroup):
+        with self._lock:
+            self._close(group)
+            transaction, self._transaction = self._transaction, None
+            if transaction is None:
+                return
+            try:
+                transaction.commit()
+            except Exception:
+                transaction.rollback()
+                raise
+
+
+# OpenBatch columns added after the first release, with the defaults ALTER TABLE needs
+_OPEN_BATCH_COLUMNS = (
+    ('CreditCount', 'INTEGER NOT NULL DEFAULT 0'),
+    ('DebitCount', 'INTEGER NOT NULL DEFAULT 0'),
+    ('CreditAmount', 'FLOAT NOT NULL DEFAULT 0.0'),
+    ('DebitAmount', 'FLOAT NOT NULL DEFAULT 0.0'),
+    ('MaxItemNumber', 'INTEGER NOT NULL DEFAULT 0'),
+    ('ItemBitmap', "BLOB NOT NULL DEFAULT x''"),
+    ('Revisions', "BLOB NOT NULL DEFAULT x''"),
+)
+
+_AUTHORIZATION_COLUMNS = (
+    ('IsExpired', 'BOOLEAN NOT NULL DEFAULT 0'),
+)
+
+
+def migrate_database(engine) -> int:
+    # Adds the OpenBatch and Authorization columns a database of an earlier release lacks and
+    # recomputes the totals and arrays of its open batches from their records, so verify_schema
+    # finds it up to date. Returns the batches rebuilt.
+    inspector = inspect(engine)
+    if open_batch_table.name not in inspector.get_table_names():
+        return 0
+    columns = set(column['name'] for column in inspector.get_columns(open_batch_table.name))
+    missing = [(name, definition) for name, definition in _OPEN_BATCH_COLUMNS if name not in columns]
+    columns = set(column['name'] for column in inspector.get_columns(authorization_table.name))
+    missing_authorization = [(name, definition) for name, definition in _AUTHORIZATION_COLUMNS if name not in columns]
+
+    c = open_batch_table.c
+    with engine.begin() as connection:
+        for name, definition in missing:
+            connection.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (open_batch_table.name, name, definition))
+        for name, definition in missing_authorization:
+            connection.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (authorization_table.name, name, definition))
+        if len(missing_authorization) > 0:
+            # indexed on IsCaptured alone; verify_schema creates it again, without the expired ones
+            connection.execute('DROP INDEX IF EXISTS "Authorization_Uncaptured_Idx"')
+        # the batches given the column defaults, until they are rebuilt, have an empty bitmap
+        batch_ids = [row[0] for row in connection.execute(select([c.Id]).where(func.length(c.ItemBitmap) == 0))]
+        for batch_id in batch_ids:
+            records = []
+            for row in connection.execute(select([batch_record_table]).
+                                          where(batch_record_table.c.BatchId == batch_id)):
+                record = BatchRecord()
+                record.item_no, record.revision_no, record.txn_code = row.ItemNumber, row.RevNumber, row.TxnCode
+                record.is_credit, record.amount = row.IsCredit, row.Amount
+                records.append(record)
+            batch = OpenBatch()
+            batch.rebuild(records)
+            connection.execute(open_batch_table.update().where(c.Id == batch_id).values(
+                CreditCount=batch.credit_count, DebitCount=batch.debit_count, CreditAmount=batch.credit_amount,
+                DebitAmount=batch.debit_amount, MaxItemNumber=batch.max_item_no, ItemBitmap=batch.item_bitmap,
+                Revisions=batch.revisions))
+    return len(batch_ids)
+
+
+def open_engine(echo=True):
+    # an engine on DATABASE_NAME set up with PROFILE, for each of the SQL storage classes; the
+    # schema is verified, not created, unless the database is new
+    global CHECKPOINTER
+    connect_args = PROFILE.connect_args()
+    if GROUP_COMMIT is not None:
+        engine = GROUP_COMMIT.create_engine(DATABASE_NAME, echo=echo, connect_args=connect_args)
+    else:
+        engine = create_engine(DATABASE_NAME, echo=echo, connect_args=connect_args)
+    PROFILE.apply(engine)
+    migrate_database(engine)
+    verify_schema(engine, fdms_metadata)
+
+    path = database_path(engine)
+    if PROFILE.checkpoint_interval is not None and path is not None:
+        if CHECKPOINTER is None or CHECKPOINTER.path != path:
+            if CHECKPOINTER is not None:
+                CHECKPOINTER.stop()
+            CHECKPOINTER = WalCheckpointer(path, PROFILE.checkpoint_interval)
+            CHECKPOINTER.start()
+    return engine
+
+
+def open_database(echo=True):
+    # opens the database of SqlFdmsStorage at startup, rather than with the first session
+    if SqlFdmsStorage.engine is None:
+        with _engine_lock:
+            if SqlFdmsStorage.engine is None:
+                engine = open_engine(echo)
+                _SqlSession.configure(bind=engine)
+                SqlFdmsStorage.engine = engine
+    return SqlFdmsStorage.engine
 
 
 class SqlFdmsStorage(FdmsStorage):
@@ -115,23 +326,49 @@ class SqlFdmsStorage(FdmsStorage):
         self.session = None
         ''':type: Session'''
 
-        if SqlFdmsStorage.engine is None:
-            global DATABASE_NAME
-            SqlFdmsStorage.engine = create_engine(DATABASE_NAME, echo=True)
-            fdms_metadata.create_all(SqlFdmsStorage.engine)
-            _SqlSession.configure(bind=SqlFdmsStorage.engine)
+        self._savepoint = None
+        ''':type: Transaction'''
 
+        if SqlFdmsStorage.engine is None:
+            open_database()
 
     def __enter__(self):
-        self.session = _SqlSession()
+        if GROUP_COMMIT is None:
+            self.session = _SqlSession()
+            return self
+
+        GROUP_COMMIT.begin()
+        try:
+            self._savepoint = GROUP_COMMIT.acquire(SqlFdmsStorage.engine)
+        except Exception:
+            GROUP_COMMIT.end()
+            raise
+        self.session = _SqlSession(bind=self._savepoint.connection)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.session.close()
-        self.session = None
+        if self._savepoint is None:
+            self.session.close()
+            self.session = None
+            return
+
+        savepoint, self._savepoint = self._savepoint, None
+        try:
+            self.session.close()
+            # holds what was written since the last save()
+            if savepoint.is_active:
+                savepoint.rollback()
+        finally:
+            self.session = None
+            group, leader = GROUP_COMMIT.release()
+        # the session may have read writes of its group, so it waits for the commit even without its own
+        GROUP_COMMIT.wait(group, leader)
 
     def save(self):
         self.session.commit()
+        if self._savepoint is not None and self._savepoint.is_active:
+            self._savepoint.commit()
+            self._savepoint = self._savepoint.connection.begin_nested()
 
     def last_closed_batch(self, merchant_number: str, device_id: str) -> ClosedBatch:
         query = self.session.query(ClosedBatch). \
@@ -144,6 +381,9 @@ class SqlFdmsStorage(FdmsStorage):
             filter(OpenBatch.merchant_number == merchant_number, OpenBatch.device_id == device_id)
         return query.first()
 
+    def query_open_batches(self) -> list:
+        return self.session.query(OpenBatch).all()
+
     def create_batch(self, merchant_number, device_id, batch_no):
         batch = OpenBatch(merchant_number=merchant_number, device_id=device_id, batch_no=batch_no)
         self.session.add(batch)
@@ -155,8 +395,11 @@ class SqlFdmsStorage(FdmsStorage):
             filter(BatchRecord.batch_id == batch_id, BatchRecord.item_no == item_no)
         return query.first()
 
-    def put_batch_record(self, batch_record):
+    def put_batch_record(self, batch_record, batch=None):
         self.session.add(batch_record)
+        if batch is not None:
+            # the batch may be a copy loaded by another session, see fdms_cache
+            self.session.merge(batch)
         self.session.flush()
 
     def get_authorization(self, rec_id) -> Authorization:
@@ -173,6 +416,20 @@ class SqlFdmsStorage(FdmsStorage):
                    Authorization.authorization_code == authorization_code)
         return query.all()
 
+    def query_uncaptured_authorizations(self, merchant_number=None, authorization_code=None) -> list:
+        ''':rtype: list of Authorization'''
+        query = self.session.query(Authorization).filter(Authorization.is_captured == False,
+                                                         Authorization.is_expired == False)
+        if merchant_number is not None:
+            query = query.filter(Authorization.merchant_number == merchant_number,
+                                 Authorization.authorization_code == authorization_code)
+        return query.all()
+
+    def expire_authorizations(self, before: datetime.datetime) -> int:
+        query = self.session.query(Authorization). \
+            filter(Authorization.is_captured == False, Authorization.is_expired == False, Authorization.date < before)
+        return query.update({Authorization.is_expired: True}, synchronize_session=False)
+
     def query_batch_items(self, batch_id: int) -> list:
         query = self.session.query(BatchRecord). \
             filter(BatchRecord.batch_id == batch_id)
@@ -186,5 +443,6 @@ class SqlFdmsStorage(FdmsStorage):
         closed_batch.debit_count = debit[0]
         closed_batch.debit_amount = debit[1]
         self.session.add(closed_batch)
-        self.session.delete(batch)
+        self.session.delete(self.session.merge(batch))
         self.session.flush()
+        return closed_batch
@@ -1,45 +1,219 @@
 import fdms
+import fdms.fdms_supervisor as supervisor
+import argparse
 import asyncio
+import datetime
 import os
+import socket
 import ssl
 import logging
 
 UNIX_SOCKET_PATH = 'fdms.1'
 
+parser = argparse.ArgumentParser(description=fdms.LOG_NAME)
+parser.add_argument('--fdms-engine', choices=('stream', 'protocol'), default='stream',
+                    help='FDMS session engine: StreamReader coroutine or asyncio.Protocol state machine')
+parser.add_argument('--txn-threads', type=int, default=0,
+                    help='worker threads for transaction processing (0 processes on the event loop)')
+parser.add_argument('--txn-queue', type=int, default=0,
+                    help='serialise transactions per merchant/device with at most N pending per terminal')
+parser.add_argument('--txn-backlog', type=int, default=256,
+                    help='with --txn-queue, turn sessions away once N transactions are pending over all terminals')
+parser.add_argument('--batch-cache', type=int, default=0,
+                    help='cache the open and last closed batch of up to N terminals, loaded at startup')
+parser.add_argument('--auth-expiry', type=float, default=0,
+                    help='index uncaptured auth-only authorizations and expire them after N hours (0 disables)')
+parser.add_argument('--replay-cache', type=int, default=0,
+                    help='answer resent monetary transactions from the last N responses instead of processing them')
+parser.add_argument('--group-commit', type=float, default=0,
+                    help='commit the storage sessions finishing within N milliseconds together (0 commits each)')
+parser.add_argument('--sqlite-profile', choices=('default', 'durable', 'fast'),
+                    help='open the SQLite database at startup with these pragmas and WAL checkpointing')
+parser.add_argument('--workers', type=int, default=0,
+                    help='fork N worker processes sharing the SiteNet port; merchants are sharded across workers')
+parser.add_argument('--fdms-bridge', action='store_true',
+                    help='connect SiteNet sessions to FDMS in memory instead of over the unix socket')
+parser.add_argument('--pool-min', type=int, default=0,
+                    help='backend connections kept open and greeted per FDMS socket')
+parser.add_argument('--pool-max', type=int, default=16,
+                    help='most idle backend connections kept per FDMS socket')
+parser.add_argument('--max-sessions', type=int, default=0,
+                    help='most FDMS and SiteNet sessions running at once (0 is unlimited)')
+parser.add_argument('--session-queue', type=int, default=0,
+                    help='sessions over the limit that may wait for a slot; the rest are rejected')
+parser.add_argument('--queue-wait', type=float, default=1.0,
+                    help='seconds a queued session may wait before it is rejected')
+args = parser.parse_args()
+
 logging.getLogger(fdms.LOG_NAME).setLevel(logging.DEBUG)
 logging.getLogger(fdms.LOG_NAME).addHandler(logging.StreamHandler())
 
 
-loop = asyncio.get_event_loop()
+loop = None
+fdms_socket_path = UNIX_SOCKET_PATH
+local_shard = None
+public_socket = None
+''':type: socket.socket'''
+pools = dict()
+''':type: dict[str, fdms.FdmsConnectionPool]'''
+fdms_admission = None
+''':type: fdms.AdmissionController'''
+site_net_admission = None
+''':type: fdms.AdmissionController'''
 
 
 def accept_fdms_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    asyncio.Task(fdms.fdms_session(reader, writer), loop=loop).add_done_callback(lambda fut: writer.close())
+    session = fdms.fdms_session(reader, writer)
+    if fdms_admission is not None:
+        session = fdms.admit_session(fdms_admission, session, lambda: fdms.reject_session(writer))
+    asyncio.Task(session, loop=loop).add_done_callback(lambda fut: writer.close())
+
+
+def connect_merchant_fdms(merchant_number):
+    shard = supervisor.merchant_shard(merchant_number, args.workers)
+    return connect_unix(supervisor.shard_path(UNIX_SOCKET_PATH, shard))
+
+
+def accept_routed_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # a terminal on the public socket is passed on to the worker owning its merchant
+    session = fdms.fdms_route_session(reader, writer, connect_merchant_fdms, release_fdms_connection)
+    asyncio.Task(session, loop=loop).add_done_callback(lambda fut: writer.close())
+
+
+def fdms_server_protocol() -> asyncio.Protocol:
+    if args.fdms_engine == 'protocol':
+        return fdms.FdmsProtocol(loop=loop, admission=fdms_admission)
+    return asyncio.StreamReaderProtocol(asyncio.StreamReader(loop=loop), accept_fdms_client, loop=loop)
+
+
+def connect_fdms_bridge(client_info):
+    return fdms.open_memory_connection(fdms_server_protocol, loop=loop)
+
+
+def connect_unix(path):
+    if args.pool_min <= 0:
+        return asyncio.open_unix_connection(path=path)
+
+    pool = pools.get(path)
+    if pool is None:
+        pool = fdms.FdmsConnectionPool(lambda: asyncio.open_unix_connection(path=path),
+                                       min_size=args.pool_min, max_size=args.pool_max, loop=loop)
+        pool.start()
+        pools[path] = pool
+    return pool.acquire()
+
+
+def release_fdms_connection(frames, writer, reusable):
+    for pool in pools.values():
+        if pool.owns(writer):
+            pool.release(frames, writer, reusable)
+            return
+    writer.close()
+
+
+def connect_local(client_info):
+    if args.fdms_bridge:
+        return connect_fdms_bridge(client_info)
+    return connect_unix(fdms_socket_path)
+
+
+def connect_merchant_shard(client_info):
+    shard = supervisor.merchant_shard(client_info.merchant_no, args.workers)
+    if args.fdms_bridge and shard == local_shard:
+        return connect_fdms_bridge(client_info)
+    return connect_unix(supervisor.shard_path(UNIX_SOCKET_PATH, shard))
 
 
 def accept_site_net_client(reader, writer):
-    task = asyncio.Task(asyncio.open_unix_connection(path=UNIX_SOCKET_PATH))
-    asyncio.Task(fdms.site_net_session(reader, writer, task)).add_done_callback(lambda fut: writer.close())
-
-# Start FDMS
-if os.path.exists(UNIX_SOCKET_PATH):
-    os.remove(UNIX_SOCKET_PATH)
-
-fdms.set_database_name('sqlite:///fdms.db')
-f = asyncio.start_unix_server(accept_fdms_client, path=UNIX_SOCKET_PATH)
-loop.run_until_complete(f)
-
-pem_path = os.path.dirname(__file__)
-pem_path = os.path.join(pem_path, 'cert.pem')
-context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-context.load_cert_chain(pem_path)
-f = asyncio.start_server(accept_site_net_client, port=8444, ssl=context)
-loop.run_until_complete(f)
-
-try:
-    loop.run_forever()
-finally:
-    if os.path.exists(UNIX_SOCKET_PATH):
-        os.remove(UNIX_SOCKET_PATH)
+    # the backend is only connected once a valid 01 info record has been read
+    connect = connect_merchant_shard if args.workers > 0 else connect_local
+    session = fdms.site_net_session(reader, writer, connect, release_fdms_connection)
+    if site_net_admission is not None:
+        session = fdms.admit_session(site_net_admission, session, lambda: fdms.reject_site_net_session(writer))
+    asyncio.Task(session).add_done_callback(lambda fut: writer.close())
+
+
+def serve(shard=None, heartbeat_fd=None):
+    global loop, fdms_socket_path, local_shard, fdms_admission, site_net_admission
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    if args.max_sessions > 0:
+        # separate limits: every SiteNet session holds an FDMS session of its own
+        fdms_admission = fdms.AdmissionController(args.max_sessions, args.session_queue, args.queue_wait, loop=loop)
+        site_net_admission = fdms.AdmissionController(args.max_sessions, args.session_queue, args.queue_wait, loop=loop)
+
+    if shard is not None:
+        local_shard = shard
+        # each worker owns the merchants of its shard, together with their LevelDB
+        fdms_socket_path = supervisor.shard_path(UNIX_SOCKET_PATH, shard)
+        fdms.set_level_db_path(supervisor.shard_path('level.db', shard))
+        fdms.set_local_shard(shard, args.workers)
 
+    # Start FDMS
+    if os.path.exists(fdms_socket_path):
+        os.remove(fdms_socket_path)
 
+    fdms.set_database_name('sqlite:///fdms.db')
+    if args.group_commit > 0:
+        fdms.set_sql_group_commit(args.group_commit / 1000)
+        fdms.set_level_db_group_commit(args.group_commit / 1000)
+    if args.sqlite_profile is not None:
+        # after the group commit, which the engine is created for
+        fdms.set_sqlite_profile(args.sqlite_profile)
+        fdms.open_sql_database()
+    if args.batch_cache > 0:
+        fdms.set_batch_cache(fdms.BatchCache(args.batch_cache), warm_up=True)
+    if args.auth_expiry > 0:
+        auth_index = fdms.AuthorizationIndex(datetime.timedelta(hours=args.auth_expiry))
+        fdms.set_authorization_index(auth_index)
+        auth_index.start(loop=loop)
+    if args.replay_cache > 0:
+        fdms.set_replay_cache(fdms.ReplayCache(args.replay_cache))
+    if args.txn_threads > 0:
+        if args.txn_queue > 0:
+            executor = fdms.KeyedTransactionExecutor(max_workers=args.txn_threads, max_pending=args.txn_queue,
+                                                     max_backlog=args.txn_backlog)
+        else:
+            executor = fdms.TransactionExecutor(max_workers=args.txn_threads)
+        fdms.set_txn_executor(executor)
+    if args.fdms_engine == 'protocol':
+        f = loop.create_unix_server(fdms_server_protocol, path=fdms_socket_path)
+    else:
+        f = asyncio.start_unix_server(accept_fdms_client, path=fdms_socket_path, loop=loop)
+    loop.run_until_complete(f)
+    if public_socket is not None:
+        # every worker accepts on the public socket, bound before the fork
+        loop.run_until_complete(asyncio.start_unix_server(accept_routed_client, sock=public_socket, loop=loop))
+
+    pem_path = os.path.dirname(__file__)
+    pem_path = os.path.join(pem_path, 'cert.pem')
+    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+    context.load_cert_chain(pem_path)
+    f = asyncio.start_server(accept_site_net_client, port=8444, ssl=context, reuse_port=shard is not None, loop=loop)
+    loop.run_until_complete(f)
+
+    if heartbeat_fd is not None:
+        supervisor.start_heartbeat(loop, heartbeat_fd)
+
+    try:
+        loop.run_forever()
+    finally:
+        if os.path.exists(fdms_socket_path):
+            os.remove(fdms_socket_path)
+
+
+if args.workers > 0:
+    if os.path.exists(UNIX_SOCKET_PATH):
+        os.remove(UNIX_SOCKET_PATH)
+    public_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    public_socket.bind(UNIX_SOCKET_PATH)
+    public_socket.listen(100)
+    try:
+        supervisor.FdmsSupervisor(args.workers, serve).run()
+    finally:
+        public_socket.close()
+        if os.path.exists(UNIX_SOCKET_PATH):
+            os.remove(UNIX_SOCKET_PATH)
+else:
+    serve()
@@ -0,0 +1,68 @@
+import asyncio
+import unittest
+import fdms
+import fdms.fdms_protocol as protocol
+from fdms_protocol_test import FakeTransport
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_limit_and_queue(self):
+        admission = fdms.AdmissionController(1, max_queued=1, max_wait=5.0, loop=self.loop)
+        first = admission.request()
+        second = admission.request()
+        third = admission.request()
+        self.assertTrue(first.result())
+        self.assertFalse(second.done())
+        self.assertFalse(third.result())
+
+        admission.release()
+        self.assertTrue(second.result())
+        admission.release()
+        self.assertEqual(admission.metrics(), {'max_active': 1, 'active': 0, 'waiting': 0, 'admitted': 2,
+                                               'queued': 1, 'shed': 1, 'expired': 0})
+
+    def test_latency_target(self):
+        admission = fdms.AdmissionController(1, max_queued=4, max_wait=0.01, loop=self.loop)
+        self.assertTrue(self.loop.run_until_complete(admission.acquire()))
+        self.assertFalse(self.loop.run_until_complete(admission.acquire()))
+        self.assertEqual(admission.metrics()['expired'], 1)
+
+    def test_reject_stream_session(self):
+        admission = fdms.AdmissionController(0, loop=self.loop)
+        writer = FakeTransport()
+        session = fdms.fdms_session(asyncio.StreamReader(loop=self.loop), writer)
+        self.loop.run_until_complete(
+            fdms.admit_session(admission, session, lambda: fdms.reject_session(writer)))
+        self.assertEqual(writer.data, bytes((protocol.EOT,)))
+
+    def test_protocol_queued(self):
+        admission = fdms.AdmissionController(1, max_queued=1, max_wait=5.0, loop=self.loop)
+        first, second, third = FakeTransport(), FakeTransport(), FakeTransport()
+        sessions = [fdms.FdmsProtocol(loop=self.loop, admission=admission) for _ in range(3)]
+        for session, transport in zip(sessions, (first, second, third)):
+            session.connection_made(transport)
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual(first.data, bytes((protocol.ENQ,)))
+        self.assertEqual(second.data, b'')
+        self.assertEqual(third.data, bytes((protocol.EOT,)))
+        self.assertTrue(third.closed)
+
+        sessions[0].connection_lost(None)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(second.data, bytes((protocol.ENQ,)))
+        sessions[1].connection_lost(None)
+        self.assertEqual(admission.metrics()['active'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
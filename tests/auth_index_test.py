@@ -0,0 +1,66 @@
+import datetime
+import unittest
+import fdms
+import fdms.fdms_processor as processor
+from fdms_test_case import FdmsTestCase
+
+
+class AuthorizationIndexTest(FdmsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_new_merchant()
+        self.index = fdms.AuthorizationIndex()
+        fdms.set_authorization_index(self.index)
+        self.addCleanup(fdms.set_authorization_index, None)
+        self.query = self.count_calls(processor.Storage, 'query_uncaptured_authorizations')
+
+    def send(self, txn_code: processor.FdmsTxnCode, item_no: str, authorization_code='') -> processor.FdmsResponse:
+        batch_no = '0' if txn_code == processor.FdmsTxnCode.AuthOnly else '5'
+        return processor.process_txn(self.keyed_txn(txn_code, item_no, batch_no=batch_no,
+                                                    authorization_code=authorization_code))
+
+    def auth_only(self) -> str:
+        response = self.send(processor.FdmsTxnCode.AuthOnly, '000')
+        self.assertEqual(response.response_code, '0', response.response_text)
+        return response.response_text.split(' ')[-1]
+
+    def test_unknown_code(self):
+        response = self.send(processor.FdmsTxnCode.TicketOnly, '001', authorization_code='999999')
+        self.assertEqual(response.response_code, '1')
+        self.assertEqual(response.response_text, processor.INV_AUTH_CODE)
+        self.assertEqual(self.query.call_count, 0)
+        self.assertEqual(self.index.metrics()['rejected'], 1)
+
+    def test_capture(self):
+        code = self.auth_only()
+        self.assertTrue(self.index.might_contain(self.header.merchant_number, code))
+        # a restarted processor finds the authorization as well
+        index = fdms.AuthorizationIndex()
+        index.load(processor.Storage)
+        self.assertTrue(index.might_contain(self.header.merchant_number, code))
+
+        response = self.send(processor.FdmsTxnCode.TicketOnly, '001', authorization_code=code)
+        self.assertEqual(response.response_code, '0', response.response_text)
+        self.assertFalse(self.index.might_contain(self.header.merchant_number, code))
+        with processor.Storage() as storage:
+            self.assertEqual(storage.query_uncaptured_authorizations(self.header.merchant_number, code), [])
+
+    def test_expire(self):
+        code = self.auth_only()
+        self.assertGreaterEqual(self.index.expire(datetime.datetime.now() + self.index.max_age * 2), 1)
+        self.assertFalse(self.index.might_contain(self.header.merchant_number, code))
+        with processor.Storage() as storage:
+            self.assertEqual(storage.query_uncaptured_authorizations(self.header.merchant_number, code), [])
+            # the authorization itself is kept
+            authorizations = storage.query_authorization(self.header.merchant_number, code)
+            self.assertEqual([(a.is_captured, a.is_expired) for a in authorizations], [(False, True)])
+        self.assertEqual(self.index.metrics()['size'], 0)
+
+        # not even a storage lookup finds it for a ticket-only
+        fdms.set_authorization_index(None)
+        response = self.send(processor.FdmsTxnCode.TicketOnly, '001', authorization_code=code)
+        self.assertEqual(response.response_text, processor.INV_AUTH_CODE)
+
+
+if __name__ == '__main__':
+    unittest.main()
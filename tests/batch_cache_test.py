@@ -0,0 +1,88 @@
+import unittest
+import fdms
+import fdms.fdms_processor as processor
+import fdms.fdms_cache as fdms_cache
+from fdms.fdms_model import OpenBatch
+from fdms_test_case import FdmsTestCase
+
+
+class BatchCacheTest(FdmsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_new_merchant()
+        self.cache = fdms.BatchCache(max_size=16)
+        fdms.set_batch_cache(self.cache)
+        self.addCleanup(fdms.set_batch_cache, None)
+        self.backend = processor.Storage.storage_class
+        self.get_open_batch = self.count_calls(self.backend, 'get_open_batch')
+
+    def send(self, txn_code: processor.FdmsTxnCode, item_no: str, amount: float):
+        response = processor.process_txn(self.keyed_txn(txn_code, item_no, amount, batch_no='4'))
+        self.assertEqual(response.response_code, '0', response.response_text)
+
+    def test_write_through(self):
+        self.send(processor.FdmsTxnCode.Sale, '001', 10.0)
+        self.send(processor.FdmsTxnCode.Sale, '002', 5.0)
+        self.send(processor.FdmsTxnCode.Sale, '003', 1.0)
+        # only the first sale loads the (missing) batch
+        self.assertEqual(self.get_open_batch.call_count, 1)
+        with self.backend() as storage:
+            stored = storage.get_open_batch(self.header.merchant_number, self.header.device_id)
+        with processor.Storage() as storage:
+            cached = storage.get_open_batch(self.header.merchant_number, self.header.device_id)
+        self.assertEqual((cached.id, cached.credit_count, cached.credit_amount, cached.revisions),
+                         (stored.id, stored.credit_count, stored.credit_amount, stored.revisions))
+
+        self.header.txn_code = processor.FdmsTxnCode.Close.value
+        body = processor.BatchCloseTransaction()
+        body.batch_no = '4'
+        body.item_no = '004'
+        body.credit_batch_amount = 16.0
+        rs = processor.process_txn((self.header, body))
+        self.assertTrue(rs.response_text.startswith('CLOSE'), rs.response_text)
+
+        rs = processor.BatchResponse()
+        processor.process_deposit_inquiry(self.header, rs)
+        self.assertEqual(rs.response_text, 'DEP %8.2f' % 16.0)
+        with processor.Storage() as storage:
+            self.assertIsNone(storage.get_open_batch(self.header.merchant_number, self.header.device_id))
+        with self.backend() as storage:
+            stored = storage.last_closed_batch(self.header.merchant_number, self.header.device_id)
+        self.assertAlmostEqual(stored.credit_amount, 16.0)
+        # the open and closed batch lookups of the first sale were the only misses
+        self.assertEqual(self.get_open_batch.call_count, 2)
+        self.assertEqual(self.cache.metrics()['misses'], 2)
+
+    def test_unsaved_session_is_dropped(self):
+        key = (self.header.merchant_number, self.header.device_id)
+        with processor.Storage() as storage:
+            storage.get_open_batch(*key)
+            storage.create_batch(key[0], key[1], '1')
+        # the batch was written but not saved, so the cached "no open batch" is dropped
+        self.assertEqual(self.cache.metrics()['invalidations'], 1)
+        self.assertIs(self.cache.get_open_batch(key), fdms_cache._UNKNOWN)
+
+    def test_lru_eviction(self):
+        cache = fdms.BatchCache(max_size=2)
+        for device_id in ('0001', '0002', '0003'):
+            cache.update(('1', device_id), open_batch=OpenBatch('1', device_id, '1'))
+            cache.get_open_batch(('1', '0001'))
+        self.assertIsNotNone(cache.get_open_batch(('1', '0001')))
+        self.assertIs(cache.get_open_batch(('1', '0002')), fdms_cache._UNKNOWN)
+        metrics = cache.metrics()
+        self.assertEqual((metrics['size'], metrics['evictions'], metrics['hits'], metrics['misses']), (2, 1, 4, 1))
+
+    def test_warm_up(self):
+        self.send(processor.FdmsTxnCode.Sale, '001', 10.0)
+        cache = fdms.BatchCache()
+        fdms.set_batch_cache(cache, warm_up=True)
+        self.assertGreaterEqual(len(cache), 1)
+        self.get_open_batch.reset_mock()
+        with processor.Storage() as storage:
+            batch = storage.get_open_batch(self.header.merchant_number, self.header.device_id)
+        self.assertEqual(batch.credit_amount, 10.0)
+        self.assertEqual(self.get_open_batch.call_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+from unittest import mock
+import fdms.fdms_processor as processor
+from fdms.sqlite_storage import SqlFdmsStorage
+from fdms_test_case import FdmsTestCase
+
+
+class BatchTotalsTest(FdmsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_new_merchant()
+        self.query_batch_items = self.count_calls(processor.Storage, 'query_batch_items')
+
+    def send(self, txn_code: processor.FdmsTxnCode, item_no: str, amount: float, revision_no='0',
+             authorization_code=''):
+        response = processor.process_txn(self.keyed_txn(txn_code, item_no, amount, batch_no='3',
+                                                        revision_no=revision_no,
+                                                        authorization_code=authorization_code))
+        self.assertEqual(response.response_code, '0', response.response_text)
+        return response
+
+    def open_batch(self):
+        with processor.Storage() as storage:
+            return storage.get_open_batch(self.header.merchant_number, self.header.device_id)
+
+    def test_totals(self):
+        self.send(processor.FdmsTxnCode.Sale, '001', 10.0)
+        self.send(processor.FdmsTxnCode.Return, '002', 3.0)
+        response = self.send(processor.FdmsTxnCode.Sale, '003', 5.0)
+        self.send(processor.FdmsTxnCode.VoidSale, '003', 5.0, revision_no='1',
+                  authorization_code=response.response_text.split(' ')[-1])
+
+        batch = self.open_batch()
+        self.assertEqual(batch.credit_count, 3)
+        self.assertAlmostEqual(batch.credit_amount, 7.0)
+        self.assertEqual(batch.debit_count, 0)
+        self.assertEqual(batch.max_item_no, 3)
+        self.assertEqual(batch.missing_items(4), [])
+        self.assertEqual(list(batch.revisions[0:5]), [0, 0, 0, 1, 0])
+
+        self.header.txn_code = processor.FdmsTxnCode.Close.value
+        body = processor.BatchCloseTransaction()
+        body.batch_no = '3'
+        body.item_no = '004'
+        body.credit_batch_amount = 7.0
+        rs = processor.process_txn((self.header, body))
+        self.assertIsInstance(rs, processor.BatchResponse)
+        self.assertTrue(rs.response_text.startswith('CLOSE'), rs.response_text)
+        self.assertEqual(self.query_batch_items.call_count, 0)
+        self.assertIsNone(self.open_batch())
+
+    def test_missing_item_is_polled(self):
+        self.send(processor.FdmsTxnCode.Sale, '001', 10.0)
+        self.send(processor.FdmsTxnCode.Sale, '003', 2.0)
+
+        self.header.txn_code = processor.FdmsTxnCode.Close.value
+        body = processor.BatchCloseTransaction()
+        body.batch_no = '3'
+        body.item_no = '004'
+        body.credit_batch_amount = 12.0
+        rs = processor.process_txn((self.header, body))
+        self.assertIsInstance(rs, processor.SpecificPollResponse)
+        self.assertEqual(rs.item_no, '002')
+        self.assertEqual(self.query_batch_items.call_count, 0)
+
+    def test_revision_inquiry(self):
+        self.send(processor.FdmsTxnCode.Sale, '001', 10.0)
+        self.send(processor.FdmsTxnCode.Sale, '002', 4.0)
+
+        self.header.txn_code = processor.FdmsTxnCode.Close.value
+        close = processor.BatchCloseTransaction()
+        close.batch_no = '3'
+        close.item_no = '003'
+        close.credit_batch_amount = 10.0
+        rs = processor.process_txn((self.header, close))
+        self.assertEqual(rs.action_code, processor.FdmsActionCode.RevisionInquiry)
+        self.assertEqual(rs.item_no, '001')
+
+        # the terminal has revised item 002 offline
+        inquiry = processor.RevisionInquiryTransaction()
+        inquiry.item_no = '001'
+        inquiry.revisions = ['0', '1'] + [''] * 8
+        processor.process_add_on_txn((self.header, close), (self.header, inquiry))
+        rs = processor.process_txn((self.header, close))
+        self.assertIsInstance(rs, processor.SpecificPollResponse)
+        self.assertEqual(rs.item_no, '002')
+        self.assertEqual(rs.request_type, processor.FdmsTransactionType.SpecificPollRevised.value)
+        self.assertEqual(self.query_batch_items.call_count, 0)
+
+    def test_revision_inquiry_in_session(self):
+        # the ORM expires the batch when the session of the close saves
+        with mock.patch.object(processor, 'Storage', SqlFdmsStorage):
+            self.send(processor.FdmsTxnCode.Sale, '001', 10.0)
+            self.send(processor.FdmsTxnCode.Sale, '002', 4.0)
+
+            self.header.txn_code = processor.FdmsTxnCode.Close.value
+            close = processor.BatchCloseTransaction()
+            close.batch_no = '3'
+            close.item_no = '003'
+            close.credit_batch_amount = 10.0
+            rs = processor.process_session((self.header, close), None, [])
+            self.assertEqual(rs.action_code, processor.FdmsActionCode.RevisionInquiry)
+
+            inquiry = processor.RevisionInquiryTransaction()
+            inquiry.item_no = '001'
+            inquiry.revisions = ['0', '1'] + [''] * 8
+            rs = processor.process_session((self.header, close), (self.header, inquiry), [])
+            self.assertIsInstance(rs, processor.SpecificPollResponse)
+            self.assertEqual(rs.item_no, '002')
+
+
+if __name__ == '__main__':
+    unittest.main()
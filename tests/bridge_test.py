@@ -0,0 +1,52 @@
+import asyncio
+import unittest
+import fdms
+import fdms.fdms_protocol as protocol
+from fdms_protocol_test import DEPOSIT_INQUIRY_REQUEST
+
+
+class MemoryBridgeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_terminal(self, protocol_factory) -> list:
+        @asyncio.coroutine
+        def terminal():
+            reader, writer = yield from fdms.open_memory_connection(protocol_factory, loop=self.loop)
+            frames = protocol.FdmsFrameReader(reader)
+            received = []
+            for data in (DEPOSIT_INQUIRY_REQUEST, bytes((protocol.EOT,)), bytes((protocol.ACK,))):
+                received.append((yield from frames.read_packet()))
+                writer.write(data)
+            received.append((yield from frames.read_packet()))
+            received.append((yield from frames.read_packet()))
+            writer.close()
+            return received
+
+        return self.loop.run_until_complete(terminal())
+
+    def test_protocol_engine(self):
+        received = self.run_terminal(lambda: fdms.FdmsProtocol(loop=self.loop))
+        self.assertEqual(received[0], bytes((protocol.ENQ,)))
+        self.assertEqual(received[1], bytes((protocol.ACK,)))
+        self.assertEqual(received[2][0], protocol.STX)
+        self.assertEqual(received[3], bytes((protocol.EOT,)))
+        self.assertEqual(received[4], b'')
+
+    def test_same_as_stream_engine(self):
+        def accept(reader, writer):
+            asyncio.Task(fdms.fdms_session(reader, writer), loop=self.loop).add_done_callback(lambda f: writer.close())
+
+        stream = self.run_terminal(
+            lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader(loop=self.loop), accept, loop=self.loop))
+        self.assertEqual(stream, self.run_terminal(lambda: fdms.FdmsProtocol(loop=self.loop)))
+
+
+if __name__ == '__main__':
+    unittest.main()
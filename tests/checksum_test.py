@@ -0,0 +1,29 @@
+import functools
+import unittest
+import fdms.fdms_checksum as checksum
+
+DEPOSIT_INQUIRY_REQUEST = b'\x02*1PIM1.4266962000000048#0239\x1c@09\x1c\x1c\x1c\x1c\x1c\x1c0\x03\x1a'
+
+
+class FdmsChecksumTest(unittest.TestCase):
+
+    def test_lrc(self):
+        for size in range(0, 300, 7):
+            data = bytes((i * 37 + size) & 0xff for i in range(size))
+            expected = functools.reduce(lambda x, y: x ^ y, data, 0)
+            self.assertEqual(checksum.lrc(data), expected)
+            self.assertEqual(checksum.lrc(bytearray(data), 1), functools.reduce(lambda x, y: x ^ y, data[1:], 0))
+
+    def test_validate_frame(self):
+        self.assertTrue(checksum.validate_frame(DEPOSIT_INQUIRY_REQUEST))
+        self.assertTrue(checksum.validate_frame(bytearray(DEPOSIT_INQUIRY_REQUEST)))
+        self.assertFalse(checksum.validate_frame(DEPOSIT_INQUIRY_REQUEST[:-1] + b'\x00'))
+        self.assertFalse(checksum.validate_frame(DEPOSIT_INQUIRY_REQUEST[1:]))
+
+    def test_strip_parity(self):
+        self.assertEqual(checksum.strip_parity(bytes(b | 0x80 for b in DEPOSIT_INQUIRY_REQUEST)),
+                         DEPOSIT_INQUIRY_REQUEST)
+
+
+if __name__ == '__main__':
+    unittest.main()
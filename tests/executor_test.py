@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import unittest
+import queue
+from fdms.fdms_executor import TransactionExecutor, KeyedTransactionExecutor
+
+
+class TransactionExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = TransactionExecutor(max_workers=1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_run(self):
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(self.executor.run(lambda a, b: a + b, 1, 2))
+        finally:
+            loop.close()
+        self.assertEqual(result, 3)
+        metrics = self.executor.metrics()
+        self.assertEqual(metrics['submitted'], 1)
+        self.assertEqual(metrics['completed'], 1)
+        self.assertEqual(metrics['failed'], 0)
+
+    def test_queue_depth(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        futures = [self.executor.submit(block)]
+        started.wait(5)
+        futures.extend(self.executor.submit(block) for _ in range(3))
+        metrics = self.executor.metrics()
+        self.assertEqual(metrics['running'], 1)
+        self.assertEqual(metrics['queued'], 3)
+
+        release.set()
+        for future in futures:
+            future.result(5)
+        metrics = self.executor.metrics()
+        self.assertEqual(metrics['queued'], 0)
+        self.assertEqual(metrics['max_queued'], 3)
+        self.assertEqual(metrics['completed'], 4)
+
+    def test_failed(self):
+        future = self.executor.submit(int, 'x')
+        self.assertRaises(ValueError, future.result, 5)
+        self.assertEqual(self.executor.metrics()['failed'], 1)
+
+
+class KeyedTransactionExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = KeyedTransactionExecutor(max_workers=4, max_pending=8)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_key_order(self):
+        lock = threading.Lock()
+        order = {'a': [], 'b': []}
+        active = {'a': 0, 'b': 0}
+        overlap = []
+
+        def job(key, n):
+            with lock:
+                active[key] += 1
+                overlap.append(active[key])
+            order[key].append(n)
+            with lock:
+                active[key] -= 1
+
+        futures = []
+        for n in range(8):
+            futures.append(self.executor.submit_keyed('a', job, 'a', n))
+            futures.append(self.executor.submit_keyed('b', job, 'b', n))
+        for future in futures:
+            future.result(5)
+
+        self.assertEqual(order['a'], list(range(8)))
+        self.assertEqual(order['b'], list(range(8)))
+        self.assertEqual(max(overlap), 1)
+        self.assertEqual(self.executor.metrics()['keys'], 0)
+
+    def test_fairness(self):
+        release = threading.Event()
+        executor = KeyedTransactionExecutor(max_workers=1, max_pending=8)
+        order = []
+        try:
+            executor.submit_keyed('busy', release.wait, 5)
+            for n in range(4):
+                executor.submit_keyed('busy', order.append, 'busy')
+            last = executor.submit_keyed('quiet', order.append, 'quiet')
+            release.set()
+            last.result(5)
+        finally:
+            executor.shutdown()
+        # the quiet terminal is served before the backlog of the busy one
+        self.assertEqual(order[0], 'quiet')
+
+    def test_bounded(self):
+        release = threading.Event()
+        futures = [self.executor.submit_keyed('a', release.wait, 5) for _ in range(8)]
+        self.assertRaises(queue.Full, self.executor.submit_keyed, 'a', release.wait, 5)
+        self.executor.submit_keyed('b', int).result(5)
+        release.set()
+        for future in futures:
+            future.result(5)
+        self.assertEqual(self.executor.metrics()['rejected'], 1)
+
+    def test_backlog(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        executor = KeyedTransactionExecutor(max_workers=1, max_pending=8, max_backlog=3)
+        try:
+            futures = [executor.submit_keyed('a', block)]
+            started.wait(5)
+            # the running job is not counted, the three waiting ones fill the backlog
+            futures.extend(executor.submit_keyed(key, release.wait, 5) for key in 'bcd')
+            self.assertRaises(queue.Full, executor.submit_keyed, 'e', release.wait, 5)
+            release.set()
+            for future in futures:
+                future.result(5)
+            executor.submit_keyed('e', int).result(5)
+        finally:
+            executor.shutdown()
+        self.assertEqual(executor.metrics()['rejected'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import asyncio
+import unittest
+import fdms.fdms_protocol as protocol
+from fdms import fdms_executor
+from fdms.fdms_bridge import open_memory_connection
+from fdms.fdms_supervisor import merchant_shard
+
+DEPOSIT_INQUIRY_REQUEST = b'\x02*1PIM1.4266962000000048#0239\x1c@09\x1c\x1c\x1c\x1c\x1c\x1c0\x03\x1a'
+INVALID_LRC_REQUEST = DEPOSIT_INQUIRY_REQUEST[:-1] + b'\x00'
+
+
+class FakeTransport(asyncio.Transport):
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.data.extend(data)
+
+    def can_write_eof(self):
+        return True
+
+    def write_eof(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeWriter(FakeTransport):
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+
+class FdmsProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_protocol(self, data: bytes) -> FakeTransport:
+        transport = FakeTransport()
+        session = protocol.FdmsProtocol(loop=self.loop)
+        session.connection_made(transport)
+        session.data_received(data)
+        return transport
+
+    def run_stream(self, data: bytes) -> FakeWriter:
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(data)
+        reader.feed_eof()
+        writer = FakeWriter()
+        self.loop.run_until_complete(protocol.fdms_session(reader, writer))
+        return writer
+
+    def test_deposit_inquiry(self):
+        transport = self.run_protocol(DEPOSIT_INQUIRY_REQUEST + bytes((protocol.EOT, protocol.ACK)))
+        self.assertTrue(transport.closed)
+        self.assertEqual(transport.data[0:2], bytes((protocol.ENQ, protocol.ACK)))
+        self.assertEqual(transport.data[2], protocol.STX)
+        self.assertEqual(transport.data[-1], protocol.EOT)
+
+    def test_retry_limit(self):
+        transport = self.run_protocol(INVALID_LRC_REQUEST * 5)
+        self.assertTrue(transport.closed)
+        self.assertEqual(transport.data, bytes((protocol.ENQ,)) + bytes((protocol.NAK,)) * 5)
+
+    def test_same_as_stream_session(self):
+        scripts = (
+            DEPOSIT_INQUIRY_REQUEST + bytes((protocol.EOT, protocol.ACK)),
+            INVALID_LRC_REQUEST + DEPOSIT_INQUIRY_REQUEST + bytes((protocol.EOT, protocol.NAK, protocol.ACK)),
+            DEPOSIT_INQUIRY_REQUEST + bytes((protocol.EOT,)) + bytes((protocol.NAK,)) * 4,
+            bytes((protocol.EOT,)),
+        )
+        for script in scripts:
+            self.assertEqual(self.run_protocol(script).data, self.run_stream(script).data)
+
+    def test_same_with_executor(self):
+        script = INVALID_LRC_REQUEST + DEPOSIT_INQUIRY_REQUEST + bytes((protocol.EOT, protocol.NAK, protocol.ACK))
+        expected = self.run_stream(script).data
+        executor = fdms_executor.TransactionExecutor(max_workers=1)
+        fdms_executor.set_txn_executor(executor)
+        try:
+            transport = self.run_protocol(script)
+            self.loop.call_later(0.1, self.loop.stop)
+            self.loop.run_forever()
+            self.assertEqual(transport.data, expected)
+            self.assertEqual(self.run_stream(script).data, expected)
+        finally:
+            fdms_executor.set_txn_executor(None)
+            executor.shutdown()
+
+    def test_rejected_by_executor(self):
+        # a full executor queue ends the session with EOT instead of dropping the connection
+        script = DEPOSIT_INQUIRY_REQUEST + bytes((protocol.EOT,))
+        executor = fdms_executor.KeyedTransactionExecutor(max_workers=1, max_backlog=0)
+        fdms_executor.set_txn_executor(executor)
+        try:
+            transport = self.run_protocol(script)
+            writer = self.run_stream(script)
+        finally:
+            fdms_executor.set_txn_executor(None)
+            executor.shutdown()
+        expected = bytes((protocol.ENQ, protocol.ACK, protocol.EOT))
+        self.assertEqual(transport.data, expected)
+        self.assertTrue(transport.closed)
+        self.assertEqual(writer.data, expected)
+        self.assertEqual(executor.metrics()['rejected'], 2)
+
+    def test_other_shard(self):
+        # a worker turns away the merchants of the other shards
+        protocol.set_local_shard(merchant_shard('4266962000000048', 2) ^ 1, 2)
+        try:
+            script = DEPOSIT_INQUIRY_REQUEST + bytes((protocol.EOT, protocol.ACK))
+            transport = self.run_protocol(script)
+            writer = self.run_stream(script)
+        finally:
+            protocol.set_local_shard(None, 0)
+        expected = bytes((protocol.ENQ, protocol.EOT))
+        self.assertEqual(transport.data, expected)
+        self.assertTrue(transport.closed)
+        self.assertEqual(writer.data, expected)
+
+    def test_route_session(self):
+        script = DEPOSIT_INQUIRY_REQUEST + bytes((protocol.EOT, protocol.ACK))
+        merchants = []
+
+        def connect(merchant_number):
+            merchants.append(merchant_number)
+            return open_memory_connection(lambda: protocol.FdmsProtocol(loop=self.loop), loop=self.loop)
+
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(script)
+        reader.feed_eof()
+        writer = FakeWriter()
+        self.loop.run_until_complete(protocol.fdms_route_session(reader, writer, connect))
+        self.assertEqual(merchants, ['4266962000000048'])
+        self.assertEqual(writer.data, self.run_stream(script).data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,22 @@
+import atexit
+import copy
+import itertools
+import os
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 import fdms.fdms_processor as processor
+import fdms.leveldb_storage as leveldb_storage
+
+# the tests run on a LevelDB database of their own, so a rerun does not find the items of the last one
+_database_dir = tempfile.mkdtemp()
+leveldb_storage.set_database_path(os.path.join(_database_dir, 'level.db'))
+atexit.register(shutil.rmtree, _database_dir, True)
+
+# numbers no test stores under, in the database of this process that starts empty
+_merchant_numbers = itertools.count(5500000001000000)
+
 
 class FdmsTestCase(unittest.TestCase):
 
@@ -10,3 +27,32 @@ class FdmsTestCase(unittest.TestCase):
         self.header.merchant_number = '1234567890'
         self.header.device_id = '0239'
 
+    def use_new_merchant(self):
+        # a merchant of its own, so the test starts without batches or authorizations
+        self.header.merchant_number = str(next(_merchant_numbers))
+        self.header.wcc = '@'
+        self.header.txn_type = processor.FdmsTransactionType.Online.value
+
+    def keyed_txn(self, txn_code: processor.FdmsTxnCode, item_no: str, amount=10.0, batch_no='1', revision_no='0',
+                  authorization_code='', txn_type=processor.FdmsTransactionType.Online) \
+            -> (processor.FdmsHeader, processor.KeyedMonetaryTransaction):
+        # a keyed monetary transaction of the terminal in self.header
+        header = copy.copy(self.header)
+        header.txn_type = txn_type.value
+        header.txn_code = txn_code.value
+        body = processor.KeyedMonetaryTransaction()
+        body.batch_no = batch_no
+        body.item_no = item_no
+        body.revision_no = revision_no
+        body.invoice_no = 'Test'
+        body.total_amount = amount
+        body.account_no = '4111111111111111'
+        body.exp_date = '1230'
+        body.authorization_code = authorization_code
+        return header, body
+
+    def count_calls(self, owner, name: str) -> mock.Mock:
+        # owner.name still runs, through a mock that counts the calls, until the test ends
+        patcher = mock.patch.object(owner, name, autospec=True, side_effect=getattr(owner, name))
+        self.addCleanup(patcher.stop)
+        return patcher.start()
@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+import fdms.fdms_protocol as protocol
+
+DEPOSIT_INQUIRY_REQUEST = b'\x02*1PIM1.4266962000000048#0239\x1c@09\x1c\x1c\x1c\x1c\x1c\x1c0\x03\x1a'
+
+
+class FdmsFrameReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def read_all(self, *chunks) -> list:
+        stream = asyncio.StreamReader(loop=self.loop)
+        for chunk in chunks:
+            stream.feed_data(chunk)
+        stream.feed_eof()
+        frames = protocol.FdmsFrameReader(stream)
+        result = []
+        while True:
+            frame = self.loop.run_until_complete(frames.read_packet())
+            if len(frame) == 0:
+                break
+            result.append(frame)
+        return result
+
+    def test_scan_frames(self):
+        buffer = bytes((protocol.ACK,)) + DEPOSIT_INQUIRY_REQUEST + DEPOSIT_INQUIRY_REQUEST[:10]
+        frames, pos = protocol.scan_frames(buffer)
+        self.assertEqual(frames, [bytes((protocol.ACK,)), DEPOSIT_INQUIRY_REQUEST])
+        self.assertEqual(pos, len(DEPOSIT_INQUIRY_REQUEST) + 1)
+
+    def test_back_to_back_frames(self):
+        frames = self.read_all(DEPOSIT_INQUIRY_REQUEST + bytes((protocol.EOT,)) + DEPOSIT_INQUIRY_REQUEST)
+        self.assertEqual(frames, [DEPOSIT_INQUIRY_REQUEST, bytes((protocol.EOT,)), DEPOSIT_INQUIRY_REQUEST])
+
+    def test_split_frame(self):
+        frames = self.read_all(DEPOSIT_INQUIRY_REQUEST[:5], DEPOSIT_INQUIRY_REQUEST[5:-1], DEPOSIT_INQUIRY_REQUEST[-1:])
+        self.assertEqual(frames, [DEPOSIT_INQUIRY_REQUEST])
+
+    def test_parity_stripped(self):
+        frames = self.read_all(bytes(b | 0x80 for b in DEPOSIT_INQUIRY_REQUEST))
+        self.assertEqual(frames, [DEPOSIT_INQUIRY_REQUEST])
+
+    def test_incomplete_frame(self):
+        frames = self.read_all(DEPOSIT_INQUIRY_REQUEST[:-1])
+        self.assertEqual(frames, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
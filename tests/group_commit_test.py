@@ -0,0 +1,138 @@
+import threading
+import unittest
+import fdms.leveldb_storage as leveldb_storage
+import fdms.sqlite_storage as sqlite_storage
+from fdms.leveldb_storage import LevelDbStorage
+from fdms.sqlite_storage import SqlFdmsStorage
+from fdms_test_case import FdmsTestCase
+
+MERCHANT_NUMBER = '5500000000000021'
+
+
+class LevelDbGroupCommitTest(FdmsTestCase):
+    def setUp(self):
+        super().setUp()
+        leveldb_storage.set_group_commit(1.0)
+        self.group_commit = leveldb_storage.GROUP_COMMIT
+
+    def tearDown(self):
+        leveldb_storage.set_group_commit(None)
+
+    def run_sessions(self, device_ids: list) -> list:
+        # every session has started before the first one exits, so they all join one group
+        entered = threading.Barrier(len(device_ids))
+        errors = []
+
+        def run(device_id):
+            try:
+                with LevelDbStorage() as storage:
+                    entered.wait(5)
+                    storage.create_batch(MERCHANT_NUMBER, device_id, '1')
+                    storage.save()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(device_id,)) for device_id in device_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return errors
+
+    def test_one_commit(self):
+        device_ids = ['03%.2d' % i for i in range(4)]
+        self.assertEqual(self.run_sessions(device_ids), [])
+        metrics = self.group_commit.metrics()
+        self.assertEqual((metrics['commits'], metrics['sessions'], metrics['max_group']), (1, 4, 4))
+        with LevelDbStorage() as storage:
+            for device_id in device_ids:
+                self.assertIsNotNone(storage.get_open_batch(MERCHANT_NUMBER, device_id))
+
+    def test_failed_commit(self):
+        def flush(items):
+            raise IOError('disk full')
+
+        self.group_commit._flush = flush
+        device_ids = ['03%.2d' % i for i in range(4, 7)]
+        errors = self.run_sessions(device_ids)
+        self.assertEqual([str(e) for e in errors], ['disk full'] * 3)
+        self.assertEqual(self.group_commit.metrics()['failed'], 1)
+
+    def test_unsaved_session(self):
+        with LevelDbStorage() as storage:
+            storage.create_batch(MERCHANT_NUMBER, '0310', '1')
+            self.assertIsNotNone(storage.get_open_batch(MERCHANT_NUMBER, '0310'))
+        with LevelDbStorage() as storage:
+            self.assertIsNone(storage.get_open_batch(MERCHANT_NUMBER, '0310'))
+        self.assertEqual(self.group_commit.metrics()['commits'], 0)
+
+
+class SqlGroupCommitTest(unittest.TestCase):
+    def setUp(self):
+        # the engine is created with the first session, so the test gets one of its own
+        self.engine = SqlFdmsStorage.engine
+        self.database_name = sqlite_storage.DATABASE_NAME
+        SqlFdmsStorage.engine = None
+        sqlite_storage.set_database_name('sqlite:///:memory:')
+        sqlite_storage.set_group_commit(1.0)
+        self.group_commit = sqlite_storage.GROUP_COMMIT
+
+    def tearDown(self):
+        sqlite_storage.set_group_commit(None)
+        sqlite_storage.set_database_name(self.database_name)
+        SqlFdmsStorage.engine = self.engine
+        sqlite_storage._SqlSession.configure(bind=self.engine)
+
+    def test_sessions(self):
+        device_ids = ['03%.2d' % i for i in range(20, 28)]
+        errors = []
+
+        def run(device_id):
+            try:
+                with SqlFdmsStorage() as storage:
+                    storage.create_batch(MERCHANT_NUMBER, device_id, '1')
+                    storage.save()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(device_id,)) for device_id in device_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(errors, [])
+        metrics = self.group_commit.metrics()
+        self.assertEqual(metrics['sessions'], len(device_ids))
+        self.assertLessEqual(metrics['commits'], len(device_ids))
+        with SqlFdmsStorage() as storage:
+            for device_id in device_ids:
+                self.assertIsNotNone(storage.get_open_batch(MERCHANT_NUMBER, device_id))
+
+    def test_unsaved_session(self):
+        with SqlFdmsStorage() as storage:
+            storage.create_batch(MERCHANT_NUMBER, '0330', '1')
+        with SqlFdmsStorage() as storage:
+            storage.create_batch(MERCHANT_NUMBER, '0331', '1')
+            storage.save()
+            # written after the save
+            storage.create_batch(MERCHANT_NUMBER, '0332', '1')
+        with SqlFdmsStorage() as storage:
+            self.assertIsNone(storage.get_open_batch(MERCHANT_NUMBER, '0330'))
+            self.assertIsNotNone(storage.get_open_batch(MERCHANT_NUMBER, '0331'))
+            self.assertIsNone(storage.get_open_batch(MERCHANT_NUMBER, '0332'))
+
+    def test_nested_session(self):
+        # the connection is held by the outer session, which the inner one would wait for
+        with SqlFdmsStorage() as storage:
+            with self.assertRaises(RuntimeError):
+                with SqlFdmsStorage():
+                    pass
+            storage.create_batch(MERCHANT_NUMBER, '0333', '1')
+            storage.save()
+        self.assertEqual(self.group_commit.metrics()['active'], 0)
+        with SqlFdmsStorage() as storage:
+            self.assertIsNotNone(storage.get_open_batch(MERCHANT_NUMBER, '0333'))
+
+
+if __name__ == '__main__':
+    unittest.main()
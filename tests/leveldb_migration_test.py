@@ -0,0 +1,87 @@
+import json
+import unittest
+import fdms.leveldb_storage as leveldb_storage
+from fdms.fdms_model import Authorization, BatchRecord
+from fdms.leveldb_storage import LevelDbStorage, IndexPrefix
+from fdms_test_case import FdmsTestCase
+
+MERCHANT_NUMBER = '5500000000000030'
+
+
+class LevelDbMigrationTest(FdmsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = leveldb_storage._open_db()
+
+    def set_version(self, version: int):
+        self.db.put(IndexPrefix.SchemaVersion.value, str(version).encode())
+
+    def test_uncaptured_authorizations(self):
+        auth = Authorization()
+        auth.merchant_number = MERCHANT_NUMBER
+        auth.authorization_code = 'M00001'
+        auth.card_hash = 'CARD'
+        auth.is_captured = False
+        auth.amount = 10.0
+        with LevelDbStorage() as storage:
+            storage.put_authorization(auth)
+            storage.save()
+        # as stored before the uncaptured index
+        self.db.delete(LevelDbStorage._uncaptured_key(auth))
+        self.set_version(0)
+
+        self.assertEqual(leveldb_storage._migrate(self.db), len(leveldb_storage.MIGRATIONS))
+        with LevelDbStorage() as storage:
+            uncaptured = storage.query_uncaptured_authorizations(MERCHANT_NUMBER, 'M00001')
+        self.assertEqual([a.id for a in uncaptured], [auth.id])
+
+    def test_authorizations_without_code(self):
+        # an auth-only stored before its code was, as answered to the terminal
+        auth = Authorization()
+        auth.merchant_number = MERCHANT_NUMBER
+        auth.card_hash = 'CARD'
+        auth.is_captured = False
+        with LevelDbStorage() as storage:
+            storage.put_authorization(auth)
+            storage.save()
+        code = str(auth.id).rjust(6, '0')
+        self.set_version(0)
+
+        leveldb_storage._migrate(self.db)
+        with LevelDbStorage() as storage:
+            uncaptured = storage.query_uncaptured_authorizations(MERCHANT_NUMBER, code)
+            self.assertEqual([a.id for a in uncaptured], [auth.id])
+            self.assertEqual([a.id for a in storage.query_authorization(MERCHANT_NUMBER, code)], [auth.id])
+            self.assertEqual(storage.get_authorization(auth.id).authorization_code, code)
+
+    def test_open_batches(self):
+        with LevelDbStorage() as storage:
+            batch = storage.create_batch(MERCHANT_NUMBER, '0370', '1')
+            for item_no, txn_code, amount in (('001', '1', 10.0), ('002', '2', 3.0), ('004', '1', 5.0)):
+                record = BatchRecord()
+                record.batch_id = batch.id
+                record.auth_id = int(item_no)
+                record.item_no = item_no
+                record.revision_no = '0'
+                record.txn_code = txn_code
+                record.amount = amount
+                storage.put_batch_record(record)
+            storage.save()
+        # as stored before the batch kept totals and arrays
+        key = b'\x00'.join((IndexPrefix.OpenBatch.value, MERCHANT_NUMBER.encode(), b'0370'))
+        fields = ['id', 'merchant_number', 'device_id', 'batch_no']
+        stored = {'__class__': 'OpenBatch'}
+        stored.update((name, getattr(batch, name)) for name in fields)
+        self.db.put(key, json.dumps(stored).encode())
+        self.set_version(1)
+
+        leveldb_storage._migrate(self.db)
+        with LevelDbStorage() as storage:
+            batch = storage.get_open_batch(MERCHANT_NUMBER, '0370')
+        self.assertEqual((batch.credit_count, batch.max_item_no), (3, 4))
+        self.assertAlmostEqual(batch.credit_amount, 12.0)
+        self.assertEqual(batch.missing_items(5), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -80,6 +80,33 @@ class FdmsParserTest(unittest.TestCase):
 
 
 
+    def test_restaurant_layout(self):
+        body = processor.KeyedMonetaryTransaction()
+        body.parse(b'4111111111111111\x1c1214\x1c10.00\x1cINV\x1c10010\x1c2\x1c\x1c\x1c\x1c\x1cTID\x1c\x1c'
+                   b'PIN\x1fD\x1f\x1f\x1f\x1fAUTH\x1fSMID\x1c')
+        self.assertEqual(body.format_code, '2')
+        self.assertEqual(body.transaction_id, 'TID')
+        self.assertEqual(body.pin_block, 'PIN')
+        self.assertEqual(body.card_type, 'D')
+        self.assertEqual(body.authorization_code, 'AUTH')
+        self.assertEqual(body.smid_block, 'SMID')
+        self.assertEqual(body.item_no, '001')
+
+    def test_hotel_layout_too_short(self):
+        body = processor.SwipedMonetaryTransaction()
+        with self.assertRaises(ValueError):
+            body.parse(b';4393410316009875=170612110000762?\x1c10.00\x1cINV\x1c10010\x1c4\x1c\x1c\x1c')
+
+    def test_lazy_fields(self):
+        pos, header = protocol.parse_header(AUTHORIZE_KEYED_REQUEST)
+        body = header.create_txn()
+        body.parse(AUTHORIZE_KEYED_REQUEST, pos, len(AUTHORIZE_KEYED_REQUEST) - 2)
+        self.assertNotIn('invoice_no', body.__dict__)
+        self.assertEqual(body.invoice_no, 'MK71BCEA')
+        self.assertIn('invoice_no', body.__dict__)
+        self.assertEqual(body.account_no, '4111111111111111')
+        self.assertEqual(body.partial_indicator, '')
+
     def test_buffer_chop(self):
         buffer = b'0 1 2 3 4 5 6 7 8 9'
         digits = list(protocol.buf_chop(buffer, protocol.sep_gen(b' '[0], buffer)))
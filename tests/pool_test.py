@@ -0,0 +1,62 @@
+import asyncio
+import unittest
+import fdms
+import fdms.fdms_protocol as protocol
+
+
+class FdmsConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.connects = 0
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def connect(self):
+        self.connects += 1
+        return fdms.open_memory_connection(lambda: fdms.FdmsProtocol(loop=self.loop), loop=self.loop)
+
+    def make_pool(self, **kwargs) -> fdms.FdmsConnectionPool:
+        pool = fdms.FdmsConnectionPool(self.connect, loop=self.loop, **kwargs)
+        pool.start()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        return pool
+
+    def test_warm(self):
+        pool = self.make_pool(min_size=2)
+        self.assertEqual(pool.metrics()['idle'], 2)
+
+        frames, writer = self.loop.run_until_complete(pool.acquire())
+        self.assertEqual(pool.metrics()['hits'], 1)
+        self.assertEqual(self.loop.run_until_complete(frames.read_packet()), bytes((protocol.ENQ,)))
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(pool.metrics()['idle'], 2)
+        self.assertEqual(self.connects, 3)
+        pool.close()
+
+    def test_return_or_discard(self):
+        pool = self.make_pool(min_size=1, max_size=4)
+        frames, writer = self.loop.run_until_complete(pool.acquire())
+        self.loop.run_until_complete(frames.read_packet())
+        pool.release(frames, writer, True)
+        self.assertEqual(pool.metrics()['returned'], 1)
+
+        frames, writer = self.loop.run_until_complete(pool.acquire())
+        self.assertEqual(self.loop.run_until_complete(frames.read_packet()), bytes((protocol.ENQ,)))
+        pool.release(frames, writer, False)
+        self.assertTrue(writer.transport.is_closing())
+        self.assertEqual(pool.metrics()['discarded'], 1)
+        pool.close()
+
+    def test_expired(self):
+        pool = self.make_pool(min_size=1, max_idle=0.0)
+        self.loop.run_until_complete(pool.acquire())
+        self.assertEqual(pool.metrics()['misses'], 1)
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import hashlib
+import unittest
+from unittest import mock
+import fdms
+import fdms.fdms_processor as processor
+import fdms.fdms_protocol as protocol
+from fdms_test_case import FdmsTestCase
+
+
+class ReplayCacheTest(FdmsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_new_merchant()
+        self.cache = fdms.ReplayCache(max_size=16)
+        fdms.set_replay_cache(self.cache)
+        self.addCleanup(fdms.set_replay_cache, None)
+        self.storage_init = self.count_calls(processor.Storage, '__init__')
+
+    def sale(self, item_no: str, amount: float) -> (processor.FdmsHeader, processor.KeyedMonetaryTransaction):
+        return self.keyed_txn(processor.FdmsTxnCode.Sale, item_no, amount, batch_no='6')
+
+    def send(self, txn: (processor.FdmsHeader, processor.KeyedMonetaryTransaction), frame: bytes) -> bytes:
+        digest = hashlib.sha1(frame)
+        return bytes(protocol.process_session_txns(txn, None, [], digest).response())
+
+    def test_resent_sale(self):
+        txn = self.sale('001', 10.0)
+        original = self.send(txn, b'sale 001')
+        sessions = self.storage_init.call_count
+        self.assertEqual(self.send(txn, b'sale 001'), original)
+        self.assertEqual(self.storage_init.call_count, sessions)
+        metrics = self.cache.metrics()
+        self.assertEqual((metrics['hits'], metrics['misses']), (1, 1))
+
+        # without the cache the sale is applied again and fails the revision check
+        fdms.set_replay_cache(None)
+        self.assertNotEqual(self.send(txn, b'sale 001'), original)
+
+    def test_different_request(self):
+        self.send(self.sale('002', 10.0), b'sale 002')
+        # the same item with other contents is processed, not replayed
+        response = self.send(self.sale('002', 12.0), b'sale 002 changed')
+        self.assertEqual(response[2:3], b'1')
+        self.assertEqual(self.cache.metrics()['conflicts'], 1)
+
+    def test_error_is_not_replayed(self):
+        txn = self.sale('003', 10.0)
+        with mock.patch.object(processor.Storage, 'get_open_batch', side_effect=IOError('disk error')):
+            response = self.send(txn, b'sale 003')
+        self.assertEqual(response[2:3], b'1')
+        self.assertEqual(len(self.cache), 0)
+        # the retry is processed and approved
+        self.assertEqual(self.send(txn, b'sale 003')[2:3], b'0')
+
+    def test_window(self):
+        rs = processor.FdmsTextResponse()
+        rs.response_text = 'APPROVED'
+        key = ('1', '0001', '1', '001', '0')
+        self.cache.put(key, b'digest', rs, now=0.0)
+        self.assertIsNotNone(self.cache.get(key, b'digest', now=self.cache.window - 1))
+        self.assertIsNone(self.cache.get(key, b'digest', now=self.cache.window + 1))
+        self.assertEqual(len(self.cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import fdms.fdms_processor as processor
+import fdms.fdms_protocol as protocol
+
+
+class FdmsResponseTest(unittest.TestCase):
+
+    def test_credit_response(self):
+        rs = processor.CreditResponse()
+        rs.batch_no = '1'
+        rs.item_no = '007'
+        rs.response_text = 'AUTH/TKT 000124'
+        rs.transaction_id = '0000000042'
+        self.assertEqual(bytes(rs.response()), b'\x020010070\x1cAUTH/TKT 000124 0\x1c\x1c0000000042\x1c\x1c\x03t')
+
+    def test_negative_response(self):
+        rs = processor.CreditResponse()
+        rs.set_negative()
+        rs.response_text = processor.INV_BATCH_SEQ
+        self.assertEqual(bytes(rs.response()), b'\x020100000\x1cINV BATCH SEQ   0\x1c\x1c\x1c\x1c\x03t')
+
+    def test_batch_response(self):
+        rs = processor.BatchResponse()
+        rs.batch_no = '1'
+        rs.set_item_number(12)
+        rs.set_batch_id_number(17)
+        rs.response_text = 'CLOSE %8.2f' % 125.5
+        rs.response_text2 = 'FORCE WITH A LONG TEXT'
+        self.assertEqual(bytes(rs.response()),
+                         b'\x020010120\x1cCLOSE   125.50  \x1c000017\x1cFORCE WITH A LON\x033')
+
+    def test_specific_poll_response(self):
+        rs = processor.SpecificPollResponse()
+        rs.action_code = processor.FdmsActionCode.HostSpecificPoll
+        rs.item_no = '004'
+        data = rs.response()
+        self.assertEqual(data[0:10], b'\x021000040\x1c6')
+        self.assertEqual(data[-2], protocol.ETX)
+        self.assertTrue(protocol.validate_frame(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
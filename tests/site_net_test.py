@@ -0,0 +1,54 @@
+import asyncio
+import struct
+import unittest
+import fdms.site_net_protocol as site_net
+from fdms_protocol_test import FakeWriter, DEPOSIT_INQUIRY_REQUEST
+
+INFO_PACKET = struct.pack('!H', 27) + b'01' + b'CUST01,4266962000000048,1,2'
+REQUEST_PACKET = struct.pack('!H', len(DEPOSIT_INQUIRY_REQUEST)) + b'22' + DEPOSIT_INQUIRY_REQUEST
+
+
+class SiteNetSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_fragmented_packets(self):
+        reader = asyncio.StreamReader(loop=self.loop)
+        writer = FakeWriter()
+        fdms_reader = asyncio.StreamReader(loop=self.loop)
+        fdms_writer = FakeWriter()
+        merchants = []
+
+        @asyncio.coroutine
+        def connect(client_info):
+            merchants.append(client_info.merchant_no)
+            return fdms_reader, fdms_writer
+
+        # one byte per loop iteration, so every read sees a partial packet
+        for b in INFO_PACKET + REQUEST_PACKET:
+            self.loop.call_soon(reader.feed_data, bytes((b,)))
+        self.loop.call_soon(fdms_reader.feed_data, DEPOSIT_INQUIRY_REQUEST)
+        self.loop.call_soon(fdms_reader.feed_eof)
+        self.loop.run_until_complete(site_net.site_net_session(reader, writer, connect))
+
+        self.assertEqual(merchants, ['4266962000000048'])
+        self.assertEqual(bytes(fdms_writer.data), DEPOSIT_INQUIRY_REQUEST)
+        self.assertEqual(bytes(writer.data), REQUEST_PACKET)
+        self.assertTrue(fdms_writer.closed)
+
+    def test_protocol_error(self):
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(REQUEST_PACKET)
+        writer = FakeWriter()
+        self.loop.run_until_complete(site_net.site_net_session(reader, writer, None))
+        self.assertEqual(bytes(writer.data[2:]), b'02201 SERVER PROTOCOL ERROR')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import datetime
+import unittest
+from fdms.fdms_model import Authorization, BatchRecord
+from fdms.sql_core_storage import SqlCoreStorage, OpenBatchRow
+
+MERCHANT_NUMBER = '5500000000000024'
+
+
+class SqlCoreStorageTest(unittest.TestCase):
+
+    def new_authorization(self, code: str, captured=True) -> Authorization:
+        auth = Authorization()
+        auth.merchant_number = MERCHANT_NUMBER
+        auth.authorization_code = code
+        auth.card_hash = 'CARD'
+        auth.is_captured = captured
+        auth.amount = 10.0
+        return auth
+
+    def new_record(self, batch_id: int, auth_id: int, item_no: str) -> BatchRecord:
+        record = BatchRecord()
+        record.batch_id = batch_id
+        record.auth_id = auth_id
+        record.item_no = item_no
+        record.revision_no = '0'
+        record.txn_code = '1'
+        record.amount = 10.0
+        return record
+
+    def test_batch(self):
+        with SqlCoreStorage() as storage:
+            batch = storage.create_batch(MERCHANT_NUMBER, '0360', '1')
+            self.assertIsInstance(batch, OpenBatchRow)
+            for item_no in ('001', '002'):
+                auth = self.new_authorization(item_no)
+                storage.put_authorization(auth)
+                record = self.new_record(batch.id, auth.id, item_no)
+                storage.put_batch_record(record)
+                batch.add_record(record)
+                storage.put_batch_record(record, batch)
+            # the kept batch update is run before the batch is read
+            stored = storage.get_open_batch(MERCHANT_NUMBER, '0360')
+            self.assertEqual((stored.credit_count, stored.max_item_no), (2, 2))
+            self.assertTrue(stored.has_item(2))
+            self.assertEqual(len(storage.query_batch_items(batch.id)), 2)
+            storage.save()
+
+        with SqlCoreStorage() as storage:
+            batch = storage.get_open_batch(MERCHANT_NUMBER, '0360')
+            self.assertAlmostEqual(batch.credit_amount, 20.0)
+            record = storage.get_batch_record(batch.id, '002')
+            batch.remove_record(record)
+            record.revision_no = '1'
+            record.txn_code = '5'
+            batch.add_record(record)
+            storage.put_batch_record(record, batch)
+            closed = storage.close_batch(batch, (batch.credit_count, batch.credit_amount), (0, 0.0))
+            storage.save()
+
+        with SqlCoreStorage() as storage:
+            self.assertIsNone(storage.get_open_batch(MERCHANT_NUMBER, '0360'))
+            last = storage.last_closed_batch(MERCHANT_NUMBER, '0360')
+            self.assertEqual(last.id, closed.id)
+            self.assertAlmostEqual(last.credit_amount, 10.0)
+            self.assertEqual(storage.get_batch_record(closed.id, '002').revision_no, '1')
+
+    def test_authorizations(self):
+        with SqlCoreStorage() as storage:
+            auth = self.new_authorization('U00001', captured=False)
+            auth.date = datetime.datetime.now() - datetime.timedelta(days=30)
+            storage.put_authorization(auth)
+            other = self.new_authorization('U00002', captured=False)
+            storage.put_authorization(other)
+            storage.save()
+
+        with SqlCoreStorage() as storage:
+            uncaptured = storage.query_uncaptured_authorizations(MERCHANT_NUMBER, 'U00002')
+            self.assertEqual([a.id for a in uncaptured], [other.id])
+            uncaptured[0].is_captured = True
+            storage.put_authorization(uncaptured[0])
+            self.assertEqual(storage.query_uncaptured_authorizations(MERCHANT_NUMBER, 'U00002'), [])
+            self.assertEqual(storage.expire_authorizations(datetime.datetime.now() - datetime.timedelta(days=7)), 1)
+            self.assertTrue(storage.get_authorization(auth.id).is_expired)
+            self.assertTrue(storage.get_authorization(other.id).is_captured)
+            storage.save()
+
+    def test_unsaved_session(self):
+        with SqlCoreStorage() as storage:
+            storage.create_batch(MERCHANT_NUMBER, '0361', '1')
+            storage.save()
+            batch = storage.create_batch(MERCHANT_NUMBER, '0362', '1')
+        with SqlCoreStorage() as storage:
+            self.assertIsNotNone(storage.get_open_batch(MERCHANT_NUMBER, '0361'))
+            self.assertIsNone(storage.get_open_batch(MERCHANT_NUMBER, '0362'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import create_engine, select, MetaData, Table, Column, Integer, String, DateTime, Index
+from fdms.sqlite_profile import PROFILES, SchemaError, WalCheckpointer, verify_schema
+from fdms.sqlite_storage import fdms_metadata, authorization_table, open_batch_table, batch_record_table, \
+    migrate_database
+
+
+class SqliteProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def create_engine(self, name: str, profile=None):
+        profile = profile if profile is not None else PROFILES['default']
+        engine = create_engine('sqlite:///' + os.path.join(self.path, name), connect_args=profile.connect_args())
+        profile.apply(engine)
+        return engine
+
+    def test_pragmas(self):
+        engine = self.create_engine('fast.sqlite', PROFILES['fast'])
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(connection.execute('PRAGMA synchronous').scalar(), 1)
+            self.assertEqual(connection.execute('PRAGMA cache_size').scalar(), -65536)
+            # the checkpoints are left to the checkpointer
+            self.assertEqual(connection.execute('PRAGMA wal_autocheckpoint').scalar(), 0)
+
+    def test_checkpoint(self):
+        engine = self.create_engine('wal.sqlite', PROFILES['durable'])
+        # the WAL is checkpointed when the last connection closes, so this one stays open
+        with engine.connect() as connection:
+            connection.execute('CREATE TABLE Item (Id INTEGER PRIMARY KEY, Name TEXT)')
+            for i in range(100):
+                connection.execute("INSERT INTO Item (Name) VALUES ('%.8d')" % i)
+            checkpointer = WalCheckpointer(os.path.join(self.path, 'wal.sqlite'), truncate_pages=1)
+            self.assertEqual(checkpointer.checkpoint(), 0)
+        metrics = checkpointer.metrics()
+        self.assertEqual((metrics['checkpoints'], metrics['truncated'], metrics['busy']), (1, 1, 0))
+        self.assertGreater(metrics['pages'], 0)
+        self.assertEqual(os.path.getsize(os.path.join(self.path, 'wal.sqlite-wal')), 0)
+
+    def test_verify_schema(self):
+        engine = self.create_engine('schema.sqlite')
+        self.assertTrue(verify_schema(engine, fdms_metadata))
+        self.assertFalse(verify_schema(engine, fdms_metadata))
+
+    def test_schema_changes(self):
+        metadata = MetaData()
+        Table('Item', metadata, Column('Id', Integer, primary_key=True), Column('Name', String(8)))
+        engine = self.create_engine('changes.sqlite')
+        verify_schema(engine, metadata)
+
+        # a new index is created
+        metadata = MetaData()
+        Table('Item', metadata, Column('Id', Integer, primary_key=True), Column('Name', String(8)),
+              Index('Item_Name_Idx', 'Name'))
+        self.assertFalse(verify_schema(engine, metadata))
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute("SELECT count(*) FROM sqlite_master "
+                                                "WHERE name = 'Item_Name_Idx'").scalar(), 1)
+
+        # a new column is not
+        metadata = MetaData()
+        Table('Item', metadata, Column('Id', Integer, primary_key=True), Column('Name', String(8)),
+              Column('Code', String(8)))
+        with self.assertRaisesRegex(SchemaError, 'column Item.Code'):
+            verify_schema(engine, metadata)
+
+    def test_migrate_open_batches(self):
+        # the OpenBatch table of the first release, without the totals and arrays
+        engine = self.create_engine('migrate.sqlite')
+        metadata = MetaData()
+        Table('OpenBatch', metadata, Column('Id', Integer, primary_key=True), Column('MerchantNumber', String(32)),
+              Column('DeviceId', String(4)), Column('BatchNumber', String(8)), Column('DateOpen', DateTime),
+              Index('OpenBatch_Number_Idx', 'MerchantNumber', 'DeviceId', unique=True))
+        metadata.create_all(engine)
+        fdms_metadata.create_all(engine, tables=[table for table in fdms_metadata.sorted_tables
+                                                 if table is not open_batch_table])
+        with engine.begin() as connection:
+            connection.execute("INSERT INTO OpenBatch VALUES (1, 'M', '0001', '1', '2016-01-01 00:00:00')")
+            for item_no, txn_code, amount in (('001', '1', 10.0), ('003', '1', 2.5)):
+                connection.execute(batch_record_table.insert().values(
+                    BatchId=1, AuthId=int(item_no), ItemNumber=item_no, RevNumber='0', TxnCode=txn_code,
+                    IsCredit=True, Amount=amount))
+        self.assertRaises(SchemaError, verify_schema, engine, fdms_metadata)
+
+        self.assertEqual(migrate_database(engine), 1)
+        self.assertFalse(verify_schema(engine, fdms_metadata))
+        self.assertEqual(migrate_database(engine), 0)
+        with engine.connect() as connection:
+            row = connection.execute(open_batch_table.select()).first()
+        self.assertEqual((row.CreditCount, row.MaxItemNumber), (2, 3))
+        self.assertAlmostEqual(row.CreditAmount, 12.5)
+        self.assertEqual(len(row.ItemBitmap), 125)
+
+    def test_migrate_authorizations(self):
+        # the Authorization table before authorizations were expired rather than deleted
+        engine = self.create_engine('expired.sqlite')
+        metadata = MetaData()
+        table = Table('Authorization', metadata, *[column.copy() for column in authorization_table.columns
+                                                   if column.name != 'IsExpired'])
+        Index('Authorization_Uncaptured_Idx', table.c.MerchantNumber, table.c.AuthorizationCode,
+              sqlite_where=table.c.IsCaptured == False)
+        metadata.create_all(engine)
+        fdms_metadata.create_all(engine, tables=[table for table in fdms_metadata.sorted_tables
+                                                 if table is not authorization_table])
+        with engine.begin() as connection:
+            connection.execute(table.insert().values(MerchantNumber='M', AuthorizationCode='000001', CardHash='',
+                                                     IsCredit=True, IsCaptured=False, Date=datetime.datetime.now(),
+                                                     Amount=10.0))
+        self.assertRaises(SchemaError, verify_schema, engine, fdms_metadata)
+
+        migrate_database(engine)
+        self.assertFalse(verify_schema(engine, fdms_metadata))
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(select([authorization_table.c.IsExpired])).scalar(), False)
+            index = connection.execute("SELECT sql FROM sqlite_master "
+                                       "WHERE name = 'Authorization_Uncaptured_Idx'").scalar()
+        self.assertIn('IsExpired', index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import unittest
+import fdms.fdms_supervisor as supervisor
+
+
+def exit_worker(index, heartbeat_fd):
+    os.write(heartbeat_fd, b'.')
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def test_merchant_shard(self):
+        merchants = ['4266962000%06d' % n for n in range(100)]
+        shards = [supervisor.merchant_shard(m, 4) for m in merchants]
+        self.assertTrue(all(0 <= shard < 4 for shard in shards))
+        self.assertEqual(len(set(shards)), 4)
+        self.assertEqual(shards, [supervisor.merchant_shard(m, 4) for m in merchants])
+        self.assertEqual(supervisor.merchant_shard(merchants[0] + ' ', 4), shards[0])
+
+    def test_restart_exited_worker(self):
+        delay = supervisor.RESTART_DELAY
+        supervisor.RESTART_DELAY = 0
+        sup = supervisor.FdmsSupervisor(1, exit_worker)
+        try:
+            sup._spawn(sup.workers[0])
+            for _ in range(20):
+                sup.check()
+                if sup.workers[0].restarts > 0:
+                    break
+            self.assertGreater(sup.workers[0].restarts, 0)
+        finally:
+            supervisor.RESTART_DELAY = delay
+            sup._reap(sup.workers[0], kill=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
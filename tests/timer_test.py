@@ -0,0 +1,58 @@
+import asyncio
+import unittest
+import fdms.fdms_protocol as protocol
+from fdms.fdms_timer import TimerWheel
+from fdms_protocol_test import FakeWriter, DEPOSIT_INQUIRY_REQUEST
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_not_early(self):
+        wheel = TimerWheel(resolution=0.01, slots=8, loop=self.loop)
+        fired = []
+        start = self.loop.time()
+        for delay in (0.005, 0.03, 0.1):
+            wheel.schedule(delay, lambda d: fired.append((d, self.loop.time() - start)), delay)
+        cancelled = wheel.schedule(0.02, fired.append, 'cancelled')
+        cancelled.cancel()
+        self.loop.call_later(0.2, self.loop.stop)
+        self.loop.run_forever()
+
+        self.assertEqual([d for d, _ in fired], [0.005, 0.03, 0.1])
+        for delay, elapsed in fired:
+            self.assertGreaterEqual(elapsed, delay)
+        self.assertEqual(len(wheel), 0)
+
+    def test_wait(self):
+        wheel = TimerWheel(resolution=0.01, loop=self.loop)
+        reader = asyncio.StreamReader(loop=self.loop)
+        self.assertRaises(asyncio.TimeoutError, self.loop.run_until_complete, wheel.wait(reader.read(1), 0.02))
+
+        reader.feed_data(b'x')
+        self.assertEqual(self.loop.run_until_complete(wheel.wait(reader.read(1), 0.02)), b'x')
+        self.assertEqual(len(wheel), 0)
+
+    def test_terminal_timeout(self):
+        protocol.set_terminal_timeouts('4266962000000048', '0239', request_timeout=0.05)
+        try:
+            reader = asyncio.StreamReader(loop=self.loop)
+            reader.feed_data(DEPOSIT_INQUIRY_REQUEST)
+            writer = FakeWriter()
+            start = self.loop.time()
+            self.loop.run_until_complete(protocol.fdms_session(reader, writer))
+            self.assertLess(self.loop.time() - start, 1.0)
+            self.assertEqual(writer.data, bytes((protocol.ENQ, protocol.ACK)))
+        finally:
+            protocol.TERMINAL_TIMEOUTS.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from unittest import mock
+import fdms.fdms_processor as processor
+from fdms_test_case import FdmsTestCase
+
+
+class UnitOfWorkTest(FdmsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_new_merchant()
+        self.storage_enter = self.count_calls(processor.Storage, '__enter__')
+
+    def offline(self, txn_code: processor.FdmsTxnCode, item_no: str, amount: float, revision_no='0',
+                authorization_code=''):
+        return self.keyed_txn(txn_code, item_no, amount, batch_no='7', revision_no=revision_no,
+                              authorization_code=authorization_code,
+                              txn_type=processor.FdmsTransactionType.OfflinePiggyBack)
+
+    def online(self, txn_code: processor.FdmsTxnCode, item_no: str, amount: float):
+        return self.keyed_txn(txn_code, item_no, amount, batch_no='7')
+
+    def open_batch(self):
+        with processor.Storage() as storage:
+            return storage.get_open_batch(self.header.merchant_number, self.header.device_id)
+
+    def test_one_session(self):
+        offline = [self.offline(processor.FdmsTxnCode.Sale, '%.3d' % i, 10.0) for i in range(1, 6)]
+        rs = processor.process_session(self.online(processor.FdmsTxnCode.Sale, '006', 5.0), None, offline)
+        self.assertEqual(rs.response_code, '0', rs.response_text)
+        self.assertEqual(self.storage_enter.call_count, 1)
+        batch = self.open_batch()
+        self.assertEqual((batch.credit_count, batch.max_item_no), (6, 6))
+        self.assertAlmostEqual(batch.credit_amount, 55.0)
+
+    def test_failed_transaction(self):
+        offline = [self.offline(processor.FdmsTxnCode.Sale, '001', 10.0),
+                   self.offline(processor.FdmsTxnCode.VoidSale, '002', 10.0, revision_no='1')]
+        rs = processor.process_session(self.online(processor.FdmsTxnCode.Sale, '003', 5.0), None, offline)
+        self.assertEqual(rs.response_code, '0', rs.response_text)
+        # the void fails, so the transactions were processed again one at a time
+        self.assertGreater(self.storage_enter.call_count, 1)
+        batch = self.open_batch()
+        self.assertEqual(batch.credit_count, 2)
+        self.assertAlmostEqual(batch.credit_amount, 15.0)
+
+    def test_failed_save(self):
+        save = processor.Storage.save
+        saves = []
+
+        def fail_first_save(storage):
+            saves.append(storage)
+            if len(saves) == 1:
+                raise IOError('disk full')
+            save(storage)
+
+        offline = [self.offline(processor.FdmsTxnCode.Sale, '001', 10.0)]
+        with mock.patch.object(processor.Storage, 'save', fail_first_save):
+            rs = processor.process_session(self.online(processor.FdmsTxnCode.Sale, '002', 5.0), None, offline)
+        self.assertEqual(rs.response_code, '0', rs.response_text)
+        # the unit saved nothing, so both sales were processed and saved again
+        self.assertEqual(len(saves), 3)
+        batch = self.open_batch()
+        self.assertEqual(batch.credit_count, 2)
+        self.assertAlmostEqual(batch.credit_amount, 15.0)
+
+    def test_ticket_onlys_on_one_code(self):
+        rs = processor.process_txn(self.keyed_txn(processor.FdmsTxnCode.AuthOnly, '000', batch_no='0'))
+        self.assertEqual(rs.response_code, '0', rs.response_text)
+        code = rs.response_text.split(' ')[-1]
+        offline = [self.offline(processor.FdmsTxnCode.TicketOnly, '001', 7.0, authorization_code=code),
+                   self.offline(processor.FdmsTxnCode.TicketOnly, '002', 7.0, authorization_code=code)]
+        rs = processor.process_session(self.online(processor.FdmsTxnCode.Sale, '003', 5.0), None, offline)
+        self.assertEqual(rs.response_code, '0', rs.response_text)
+        # the authorization was captured by the first ticket-only of the unit, so the second one fails
+        batch = self.open_batch()
+        self.assertEqual(batch.credit_count, 2)
+        self.assertAlmostEqual(batch.credit_amount, 12.0)
+        self.assertFalse(batch.has_item(2))
+        with processor.Storage() as storage:
+            self.assertIsNone(storage.get_batch_record(batch.id, '002'))
+            self.assertEqual(storage.query_uncaptured_authorizations(self.header.merchant_number, code), [])
+
+
+if __name__ == '__main__':
+    unittest.main()